@@ -0,0 +1,58 @@
+from collections import defaultdict
+from datetime import date, timedelta
+from typing import Dict, Iterable, List
+
+from database import DEFAULT_USER_ID, SessionLocal, DailyMetricRollup
+
+
+def daily_totals(db, metric_types: Iterable[str], since: date,
+                 user_id: int = DEFAULT_USER_ID) -> Dict[str, List[Dict]]:
+    """
+    Per-day sum/count of one user's samples for every requested metric type, read from
+    `daily_metric_rollups` in a single query.
+    """
+    rows = db.query(
+        DailyMetricRollup.metric_type,
+        DailyMetricRollup.day,
+        DailyMetricRollup.value_sum,
+        DailyMetricRollup.sample_count,
+    ).filter(
+        DailyMetricRollup.user_id == user_id,
+        DailyMetricRollup.metric_type.in_(list(metric_types)),
+        DailyMetricRollup.day >= since
+    ).order_by(DailyMetricRollup.day).all()
+
+    result = defaultdict(list)
+    for r in rows:
+        result[r.metric_type].append({"day": r.day, "total": float(r.value_sum), "samples": r.sample_count})
+    return dict(result)
+
+
+def summarize_days(days: List[Dict]) -> Dict:
+    """Reduce per-day totals to the figures the insight prompt and API use."""
+    vals = [d["total"] for d in days]
+    samples = sum(d["samples"] for d in days)
+    return {
+        "daily_avg": sum(vals) / len(vals),
+        "weekly_total": sum(vals),
+        "max_day": max(vals),
+        "days_tracked": len(vals),
+        # 心率这类瞬时值需要按样本平均，而不是按天求和
+        "sample_avg": sum(vals) / samples if samples else None,
+    }
+
+
+def metric_summaries(metric_types: Iterable[str], days: int = 7, db=None,
+                     user_id: int = DEFAULT_USER_ID) -> Dict[str, Dict]:
+    """
+    Summaries for all `metric_types` over the last `days` calendar days (today included);
+    metric types with no data are omitted. Opens its own session unless one is passed in.
+    """
+    own_session = db is None
+    db = db or SessionLocal()
+    try:
+        since = date.today() - timedelta(days=days - 1)
+        return {m: summarize_days(d) for m, d in daily_totals(db, metric_types, since, user_id).items()}
+    finally:
+        if own_session:
+            db.close()
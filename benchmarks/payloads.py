@@ -0,0 +1,84 @@
+"""Deterministic synthetic Health Auto Export V2 payloads for benchmarks."""
+import csv
+import random
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+_DATE_FORMAT = "%Y-%m-%d %H:%M:%S -0800"
+_SLEEP_STAGES = (("sleep_deep", 60, 110), ("sleep_rem", 70, 120), ("sleep_core", 180, 260), ("sleep_awake", 5, 40))
+_WORKOUT_TYPES = ("Running", "Traditional Strength Training", "Cycling", "Walking")
+
+
+def _fmt(ts: datetime) -> str:
+    return ts.strftime(_DATE_FORMAT)
+
+
+def _qty(value, units):
+    return {"qty": value, "units": units}
+
+
+def day_payload(day: datetime, rng: random.Random) -> Dict[str, Any]:
+    """One day of minute-level heart rate and steps, last night's sleep and one workout."""
+    minutes = [day + timedelta(minutes=m) for m in range(24 * 60)]
+
+    heart_rate = [{"date": _fmt(ts), "qty": round(rng.gauss(72 if 7 <= ts.hour < 23 else 55, 6), 1)} for ts in minutes]
+    # 只在白天有步数
+    steps = [{"date": _fmt(ts), "qty": rng.randint(0, 120)} for ts in minutes if 7 <= ts.hour < 23 and rng.random() < 0.6]
+
+    night = day - timedelta(hours=1)
+    sleep = {name: [] for name, _, _ in _SLEEP_STAGES}
+    total = 0.0
+    for name, lo, hi in _SLEEP_STAGES:
+        value = rng.randint(lo, hi)
+        sleep[name].append({"date": _fmt(night), "qty": value})
+        if name != "sleep_awake":
+            total += value
+
+    start = day + timedelta(hours=18, minutes=rng.randint(0, 60))
+    duration = rng.randint(25, 75) * 60
+    hr_avg = rng.randint(120, 155)
+    workout = {
+        "name": rng.choice(_WORKOUT_TYPES),
+        "start": _fmt(start),
+        "end": _fmt(start + timedelta(seconds=duration)),
+        "duration": duration,
+        "activeEnergyBurned": _qty(round(duration / 60 * rng.uniform(6, 12), 1), "kcal"),
+        "heartRate": {
+            "min": _qty(hr_avg - rng.randint(20, 40), "bpm"),
+            "avg": _qty(hr_avg, "bpm"),
+            "max": _qty(hr_avg + rng.randint(15, 35), "bpm"),
+        },
+    }
+
+    metrics = [
+        {"name": "heart_rate", "units": "count/min", "data": heart_rate},
+        {"name": "step_count", "units": "count", "data": steps},
+        {"name": "sleep_analysis", "units": "min", "data": [{"date": _fmt(night), "qty": total}]},
+    ] + [{"name": name, "units": "min", "data": samples} for name, samples in sleep.items()]
+    return {"data": {"metrics": metrics, "workouts": [workout]}}
+
+
+def generate_days(days: int, seed: int = 42, end: datetime = None) -> List[Dict[str, Any]]:
+    """`days` consecutive daily payloads ending yesterday, as HAE would send them one per day."""
+    rng = random.Random(seed)
+    end = (end or datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0)
+    return [day_payload(end - timedelta(days=days - i), rng) for i in range(days)]
+
+
+def sample_count(payload: Dict[str, Any]) -> int:
+    return sum(len(m["data"]) for m in payload["data"]["metrics"])
+
+
+def write_csv(path: str, payloads: List[Dict[str, Any]]) -> int:
+    """Flatten payloads into the import_snapshot.py CSV layout; returns the row count."""
+    rows = 0
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["timestamp", "metric_type", "value", "unit", "source"])
+        for payload in payloads:
+            for m in payload["data"]["metrics"]:
+                for sample in m["data"]:
+                    # 和 webhook 写入的数据错开，避免 CSV 导入只是覆盖同一批行
+                    writer.writerow([sample["date"], f"csv_{m['name']}", sample["qty"], m["units"], "benchmark"])
+                    rows += 1
+    return rows
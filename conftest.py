@@ -0,0 +1,27 @@
+import os
+import tempfile
+
+import pytest
+
+# 所有测试统一使用 SQLite，必须在导入 database 之前设置
+os.environ.setdefault("DATABASE_URL", "sqlite:///./test.db")
+os.environ.setdefault("INGEST_SPOOL_DIR", tempfile.mkdtemp(prefix="health-buddy-spool-"))
+
+
+@pytest.fixture(scope="session", autouse=True)
+def schema():
+    # API 不再在导入时建表，测试开始前建一次
+    from database import init_db
+    init_db()
+
+
+@pytest.fixture(autouse=True)
+def reset_ingest_state(schema):
+    # 测试之间会删掉再重写同一批样本，水位线和载荷指纹不能跨测试保留
+    from database import SessionLocal, IngestWatermark, PayloadFingerprint
+    db = SessionLocal()
+    db.query(IngestWatermark).delete()
+    db.query(PayloadFingerprint).delete()
+    db.commit()
+    db.close()
+    yield
@@ -1,7 +1,12 @@
 import os
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, JSON, UniqueConstraint
+import asyncio
+from sqlalchemy import (
+    create_engine, Boolean, Column, Integer, String, Float, Date, DateTime, Text, JSON, Index, UniqueConstraint,
+)
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker
+from telemetry import instrument_engine
 
 # 自动处理本地和容器内的连接地址
 raw_db_url = os.getenv("DATABASE_URL", "postgresql://health_user:health_pass@db:5432/health_db")
@@ -10,40 +15,268 @@ if os.getenv("IS_LOCAL_DEV") == "true":
 else:
     DATABASE_URL = raw_db_url
 
-engine = create_engine(DATABASE_URL)
+# 可选：在 PostgreSQL 上把 health_metrics 建成按月分区的表（见 partitions.py）
+METRICS_PARTITIONED = os.getenv("HEALTH_METRICS_PARTITIONED") == "true"
+
+# 连接池参数（SQLite 用默认池）
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true") == "true"
+
+# 可选：API 进程里的数据库操作走 asyncpg / aiosqlite 异步引擎（需要安装 async 扩展依赖）
+DATABASE_ASYNC = os.getenv("DATABASE_ASYNC") == "true"
+_ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+# API 启动时自动建表；关掉后需要先运行 `migrate.py schema`
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "true") == "true"
+
+
+def _engine_kwargs(url: str):
+    if url.startswith("sqlite"):
+        return {}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+
+engine = create_engine(DATABASE_URL, **_engine_kwargs(DATABASE_URL))
+instrument_engine(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# 升级前的数据和 WEBHOOK_TOKEN 都归属这个用户
+DEFAULT_USER_ID = 1
+
+
+def _user_id_column(**kwargs):
+    # 不加外键：批量 upsert 时省掉逐行的外键检查
+    return Column(Integer, nullable=False, default=DEFAULT_USER_ID, server_default=str(DEFAULT_USER_ID), **kwargs)
+
+
+class User(Base):
+    """API 用户；token 只存 SHA-256（见 users.py）"""
+    __tablename__ = "users"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True, nullable=False)
+    token_hash = Column(String(64), unique=True)
+    discord_webhook_url = Column(String)  # 为空时默认用户回落到 DISCORD_WEBHOOK_URL
+    active = Column(Boolean, nullable=False, default=True)
+    created_at = Column(DateTime)
+
+
 class HealthMetric(Base):
     __tablename__ = "health_metrics"
 
     id = Column(Integer, primary_key=True, index=True)
+    user_id = _user_id_column()
     timestamp = Column(DateTime, index=True)
-    metric_type = Column(String, index=True)  # 例如: step_count, heart_rate, sleep_analysis
+    metric_type = Column(String)  # 例如: step_count, heart_rate, sleep_analysis
     value = Column(Float)
     unit = Column(String)
     source = Column(String, default="apple_health")
-    raw_data = Column(JSON)  # 存储原始 JSON 以备不时之需
+    # 原始样本里除 date/qty 以外的字段，保存策略见 ingest.RAW_DATA_POLICY；PostgreSQL 上用 JSONB
+    raw_data = Column(JSON(none_as_null=True).with_variant(postgresql.JSONB(none_as_null=True), "postgresql"))
 
-    # 防止重复导入同一时间点的同一指标
-    __table_args__ = (UniqueConstraint('timestamp', 'metric_type', name='_timestamp_metric_uc'),)
+    __table_args__ = (
+        # 防止重复导入同一用户同一时间点的同一指标
+        UniqueConstraint('user_id', 'timestamp', 'metric_type', name='_user_timestamp_metric_uc'),
+        # 几乎所有查询都是 user_id = U AND metric_type = X AND timestamp >= since
+        Index('ix_health_metrics_user_type_timestamp', 'user_id', 'metric_type', 'timestamp'),
+    )
 
 
 class Workout(Base):
     __tablename__ = "workouts"
 
     id = Column(Integer, primary_key=True, index=True)
-    start_timestamp = Column(DateTime, index=True)
+    user_id = _user_id_column()
+    start_timestamp = Column(DateTime)
     end_timestamp = Column(DateTime)
-    workout_type = Column(String, index=True)  # e.g. "Traditional Strength Training", "Running"
+    workout_type = Column(String)  # e.g. "Traditional Strength Training", "Running"
     duration_minutes = Column(Float)
     active_calories = Column(Float)
     avg_heart_rate = Column(Float)
     max_heart_rate = Column(Float)
     raw_data = Column(JSON)
 
-    __table_args__ = (UniqueConstraint('start_timestamp', 'workout_type', name='_workout_start_type_uc'),)
+    # 唯一约束的索引以 (user_id, start_timestamp) 开头，按用户查时间窗口直接用它
+    __table_args__ = (
+        UniqueConstraint('user_id', 'start_timestamp', 'workout_type', name='_user_workout_start_type_uc'),
+    )
+
+
+class MetricAggregate(Base):
+    """超过保留期的原始样本降采样后的分桶聚合，和 health_metrics 一起构成完整历史（见 retention.py）"""
+    __tablename__ = "metric_aggregates"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = _user_id_column()
+    metric_type = Column(String, nullable=False)
+    bucket_start = Column(DateTime, nullable=False)
+    bucket_seconds = Column(Integer, nullable=False)
+    unit = Column(String)
+    value_sum = Column(Float)
+    sample_count = Column(Integer)
+    value_min = Column(Float)
+    value_max = Column(Float)
+    value_avg = Column(Float)
+
+    # 唯一约束的索引同时服务按 (用户, 指标, 时间范围) 的读取
+    __table_args__ = (
+        UniqueConstraint('user_id', 'metric_type', 'bucket_start', name='_aggregate_user_metric_bucket_uc'),
+    )
+
+
+class DailyMetricRollup(Base):
+    """每个用户每天每个指标一行的预聚合，由入库流程增量维护（见 rollups.py）"""
+    __tablename__ = "daily_metric_rollups"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = _user_id_column()
+    day = Column(Date)
+    metric_type = Column(String)
+    value_sum = Column(Float)
+    sample_count = Column(Integer)
+    value_min = Column(Float)
+    value_max = Column(Float)
+    value_avg = Column(Float)
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'metric_type', 'day', name='_rollup_user_metric_day_uc'),
+    )
+
+
+class DataGeneration(Base):
+    """数据版本号：每次有新数据写入就 +1，缓存据此判断是否需要重新计算（见 generations.py）"""
+    __tablename__ = "data_generations"
+
+    user_id = _user_id_column(primary_key=True)
+    name = Column(String, primary_key=True)
+    generation = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime)
+
+
+class MetricBaseline(Base):
+    """每个用户每个指标的 EWMA 状态，只把上次之后完成的日子折算进去（见 trends.py）"""
+    __tablename__ = "metric_baselines"
+
+    user_id = _user_id_column(primary_key=True)
+    metric_type = Column(String, primary_key=True)
+    through_day = Column(Date)  # 已折算到哪一天；NULL 表示需要从窗口重新起算
+    ewma = Column(Float)
+    ewm_var = Column(Float)
+    updated_at = Column(DateTime)
+
+
+class InsightCacheEntry(Base):
+    """已生成的 AI 报告，按用户 + 统计数据 + 提示词模板 + 模型的哈希寻址（见 insight_cache.py）"""
+    __tablename__ = "insight_cache"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = _user_id_column()
+    cache_key = Column(String(64), unique=True, nullable=False)
+    prompt_version = Column(String(64), nullable=False)  # 模板 + 模型的哈希
+    data_generation = Column(Integer)
+    window_day = Column(Date)  # 统计窗口的截止日期
+    response = Column(Text, nullable=False)
+    created_at = Column(DateTime, index=True)
+    last_used_at = Column(DateTime)
+
+
+class IngestWatermark(Base):
+    """每个用户每个 (指标, 来源) 已写入的最新样本时间，早于它的重发样本直接跳过（见 watermarks.py）"""
+    __tablename__ = "ingest_watermarks"
+
+    user_id = _user_id_column(primary_key=True)
+    metric_type = Column(String, primary_key=True)
+    source = Column(String, primary_key=True)
+    high_water = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime)
+
+
+class PayloadFingerprint(Base):
+    """最近处理过的 webhook 载荷的 SHA-256，完全相同的重发不再解析"""
+    __tablename__ = "payload_fingerprints"
+
+    user_id = _user_id_column(primary_key=True)
+    digest = Column(String(64), primary_key=True)
+    samples = Column(Integer)
+    created_at = Column(DateTime, index=True)
+
+
+def dialect_insert(db):
+    """Return the dialect-specific `insert` construct that supports ON CONFLICT (for a Session or Connection)."""
+    dialect = (db.get_bind() if hasattr(db, "get_bind") else db).dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert
+    if dialect == "sqlite":
+        return sqlite.insert
+    raise ValueError(f"Upsert is not supported on dialect '{dialect}'")
+
+
+def async_database_url(url: str) -> str:
+    scheme, rest = url.split("://", 1)
+    backend = scheme.split("+", 1)[0]
+    if backend not in _ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for '{backend}'")
+    return f"{_ASYNC_DRIVERS[backend]}://{rest}"
+
+
+_async_sessionmaker = None
+
+
+def get_async_sessionmaker():
+    """Lazily build the async engine and its `async_sessionmaker`."""
+    global _async_sessionmaker
+    if _async_sessionmaker is None:
+        from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+        url = async_database_url(DATABASE_URL)
+        async_engine = create_async_engine(url, **_engine_kwargs(url))
+        instrument_engine(async_engine.sync_engine)
+        _async_sessionmaker = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    return _async_sessionmaker
+
+
+async def run_db(fn, *args, **kwargs):
+    """
+    Run `fn(session, *args, **kwargs)` from async code without tying up the event loop.
+
+    With DATABASE_ASYNC the sync function runs on an AsyncSession via `run_sync`, so DB
+    waits yield to the loop; otherwise it runs with a SessionLocal on a worker thread.
+    """
+    if DATABASE_ASYNC:
+        async with get_async_sessionmaker()() as session:
+            return await session.run_sync(fn, *args, **kwargs)
+
+    def call():
+        db = SessionLocal()
+        try:
+            return fn(db, *args, **kwargs)
+        finally:
+            db.close()
+
+    return await asyncio.to_thread(call)
 
 
 def init_db():
+    # 单用户版本建的表先补上 user_id 列和新的唯一约束
+    from migrate import add_user_columns
+    add_user_columns(engine)
+    if METRICS_PARTITIONED and engine.dialect.name == "postgresql":
+        from partitions import create_partitioned_table
+        create_partitioned_table()
     Base.metadata.create_all(bind=engine)
+    # create_all 不会给已存在的表补索引，这里单独补上
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+    from users import ensure_default_user
+    ensure_default_user(engine)
@@ -0,0 +1,46 @@
+from datetime import datetime
+from typing import Dict, Iterable
+
+from database import DEFAULT_USER_ID, DataGeneration, dialect_insert
+
+# 任何健康数据写入都会推进这个版本号
+HEALTH_DATA = "health_data"
+WORKOUTS = "workouts"
+
+
+def metric_generation(metric_type: str) -> str:
+    """Name of the per-metric counter bumped whenever samples of `metric_type` are written."""
+    return f"metric:{metric_type}"
+
+
+def bump_generations(db, names: Iterable[str], user_id: int = DEFAULT_USER_ID):
+    """Increment one user's data generation counters inside the caller's transaction."""
+    # 固定顺序加锁，避免并发写入时互相死锁
+    names = sorted(set(names))
+    if not names:
+        return
+    now = datetime.utcnow()
+    stmt = dialect_insert(db)(DataGeneration).values(
+        [{"user_id": user_id, "name": name, "generation": 1, "updated_at": now} for name in names]
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["user_id", "name"],
+        set_={"generation": DataGeneration.generation + 1, "updated_at": stmt.excluded.updated_at},
+    )
+    db.execute(stmt)
+
+
+def bump_generation(db, name: str = HEALTH_DATA, user_id: int = DEFAULT_USER_ID):
+    bump_generations(db, [name], user_id)
+
+
+def get_generations(db, names: Iterable[str], user_id: int = DEFAULT_USER_ID) -> Dict[str, int]:
+    names = list(names)
+    found = dict(db.query(DataGeneration.name, DataGeneration.generation).filter(
+        DataGeneration.user_id == user_id, DataGeneration.name.in_(names),
+    ).all())
+    return {name: found.get(name, 0) for name in names}
+
+
+def get_generation(db, name: str = HEALTH_DATA, user_id: int = DEFAULT_USER_ID) -> int:
+    return get_generations(db, [name], user_id)[name]
@@ -0,0 +1,239 @@
+"""
+Stream a native Apple Health `export.xml` into the database.
+
+    uv run import_apple_health.py ~/Downloads/apple_health_export/export.xml [--source "Apple Watch"]
+
+Quantity records are mapped to the metric names Health Auto Export uses on the webhook,
+sleep analysis records become per-stage durations in minutes, and `Workout` elements are
+mapped onto the workouts table. Everything goes through the same batched upsert path as
+the webhook, so re-importing a newer export only updates what changed.
+"""
+import re
+import sys
+import time
+import argparse
+import xml.etree.ElementTree as ET
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from database import DEFAULT_USER_ID
+from ingest import INGEST_CHUNK_SIZE, ingest_events, metric_row
+from timeparse import TimestampParser
+from users import user_id_for
+
+# 每处理这么多条记录打印一次进度
+PROGRESS_EVERY = 100_000
+
+# export.xml 里所有时间都是 "2024-02-06 14:30:00 -0800" 格式，整个文件共用一个解析器
+_parse_ts = TimestampParser()
+
+_QUANTITY_PREFIX = "HKQuantityTypeIdentifier"
+_WORKOUT_PREFIX = "HKWorkoutActivityType"
+
+# Apple 的类型名 → Health Auto Export 在 webhook 里使用的名字；未列出的按驼峰转下划线
+METRIC_NAMES = {
+    "StepCount": "step_count",
+    "DistanceWalkingRunning": "walking_running_distance",
+    "DistanceCycling": "cycling_distance",
+    "DistanceSwimming": "swimming_distance",
+    "FlightsClimbed": "flights_climbed",
+    "ActiveEnergyBurned": "active_energy",
+    "BasalEnergyBurned": "basal_energy_burned",
+    "AppleExerciseTime": "apple_exercise_time",
+    "AppleStandTime": "apple_stand_time",
+    "HeartRate": "heart_rate",
+    "RestingHeartRate": "resting_heart_rate",
+    "WalkingHeartRateAverage": "walking_heart_rate_average",
+    "HeartRateVariabilitySDNN": "heart_rate_variability",
+    "OxygenSaturation": "blood_oxygen_saturation",
+    "RespiratoryRate": "respiratory_rate",
+    "VO2Max": "vo2_max",
+    "BodyMass": "weight_body_mass",
+    "BodyMassIndex": "body_mass_index",
+    "BodyFatPercentage": "body_fat_percentage",
+    "LeanBodyMass": "lean_body_mass",
+    "DietaryWater": "dietary_water",
+    "EnvironmentalAudioExposure": "environmental_audio_exposure",
+    "HeadphoneAudioExposure": "headphone_audio_exposure",
+    "TimeInDaylight": "time_in_daylight",
+}
+
+_SLEEP_TYPE = "HKCategoryTypeIdentifierSleepAnalysis"
+# 睡眠阶段 → metric_type；所有 "Asleep*" 阶段同时计入 sleep_analysis（总睡眠）
+SLEEP_STAGES = {
+    "HKCategoryValueSleepAnalysisAsleepDeep": "sleep_deep",
+    "HKCategoryValueSleepAnalysisAsleepREM": "sleep_rem",
+    "HKCategoryValueSleepAnalysisAsleepCore": "sleep_core",
+    "HKCategoryValueSleepAnalysisAwake": "sleep_awake",
+    "HKCategoryValueSleepAnalysisInBed": "sleep_in_bed",
+    "HKCategoryValueSleepAnalysisAsleepUnspecified": None,
+    "HKCategoryValueSleepAnalysisAsleep": None,
+}
+
+_CAMEL_RE = re.compile(r"(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])")
+
+
+def metric_name(record_type: str) -> str:
+    name = record_type[len(_QUANTITY_PREFIX):]
+    return METRIC_NAMES.get(name) or _CAMEL_RE.sub("_", name).lower()
+
+
+def workout_name(activity_type: str) -> str:
+    # HKWorkoutActivityTypeTraditionalStrengthTraining → "Traditional Strength Training"
+    return _CAMEL_RE.sub(" ", activity_type.replace(_WORKOUT_PREFIX, "", 1))
+
+
+def _minutes_between(start: str, end: str) -> float:
+    return round((_parse_ts(end) - _parse_ts(start)).total_seconds() / 60, 2)
+
+
+def _duration_seconds(value: str, unit: str) -> float:
+    factor = {"min": 60, "hr": 3600, "s": 1}.get(unit or "min", 60)
+    return float(value) * factor
+
+
+def record_rows(attrs: Dict[str, str]) -> Iterator[Dict[str, Any]]:
+    """Map one `<Record>` element's attributes to health_metrics rows."""
+    record_type = attrs.get("type", "")
+    start = attrs.get("startDate")
+    if not start:
+        return
+
+    if record_type.startswith(_QUANTITY_PREFIX):
+        try:
+            qty = float(attrs.get("value"))
+        except (TypeError, ValueError):
+            return
+        sample = {"date": start, "qty": qty, "end": attrs.get("endDate"), "sourceName": attrs.get("sourceName")}
+        yield metric_row(metric_name(record_type), attrs.get("unit"), sample, _parse_ts)
+
+    elif record_type == _SLEEP_TYPE and attrs.get("value") in SLEEP_STAGES and attrs.get("endDate"):
+        stage = attrs["value"]
+        sample = {
+            "date": start,
+            "qty": _minutes_between(start, attrs["endDate"]),
+            "end": attrs["endDate"],
+            "value": stage,
+            "sourceName": attrs.get("sourceName"),
+        }
+        if SLEEP_STAGES[stage]:
+            yield metric_row(SLEEP_STAGES[stage], "min", sample, _parse_ts)
+        if "Asleep" in stage:
+            yield metric_row("sleep_analysis", "min", sample, _parse_ts)
+
+
+def workout_payload(elem: ET.Element) -> Optional[Dict[str, Any]]:
+    """Translate a `<Workout>` element into the Health Auto Export workout shape."""
+    attrs = elem.attrib
+    if not attrs.get("startDate"):
+        return None
+    workout = {
+        "name": workout_name(attrs.get("workoutActivityType", "Unknown")),
+        "start": attrs["startDate"],
+        "end": attrs.get("endDate"),
+        "sourceName": attrs.get("sourceName"),
+    }
+    if attrs.get("duration"):
+        workout["duration"] = _duration_seconds(attrs["duration"], attrs.get("durationUnit"))
+    if attrs.get("totalEnergyBurned"):
+        workout["activeEnergyBurned"] = {"qty": float(attrs["totalEnergyBurned"]),
+                                         "units": attrs.get("totalEnergyBurnedUnit")}
+    if attrs.get("totalDistance"):
+        workout["distance"] = {"qty": float(attrs["totalDistance"]), "units": attrs.get("totalDistanceUnit")}
+
+    # 新版导出把能量/心率放在 <WorkoutStatistics> 子元素里
+    for stat in elem.iter("WorkoutStatistics"):
+        stat_type = stat.get("type", "")
+        if stat_type.endswith("ActiveEnergyBurned") and stat.get("sum"):
+            workout["activeEnergyBurned"] = {"qty": float(stat.get("sum")), "units": stat.get("unit")}
+        elif stat_type.endswith("HeartRate"):
+            workout["heartRate"] = {
+                key: {"qty": float(stat.get(attr)), "units": stat.get("unit")}
+                for key, attr in (("avg", "average"), ("min", "minimum"), ("max", "maximum"))
+                if stat.get(attr)
+            }
+    return workout
+
+
+def iter_export(source, sources: List[str] = None) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Yield ("metric", row) / ("workout", workout) events from an export.xml path or file object.
+
+    Each top-level element is cleared from the tree once handled, so memory stays flat no
+    matter how large the export is. `sources`, if given, keeps only records whose
+    `sourceName` contains one of the strings (e.g. to avoid counting iPhone and Watch steps twice).
+    """
+    depth = 0
+    root = None
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth != 1:
+            continue
+        if sources and not any(s in (elem.get("sourceName") or "") for s in sources):
+            root.clear()
+            continue
+
+        if elem.tag == "Record":
+            for row in record_rows(elem.attrib):
+                if row is not None:
+                    yield "metric", row
+        elif elem.tag == "Workout":
+            workout = workout_payload(elem)
+            if workout is not None:
+                yield "workout", workout
+        # 处理完的顶层元素（连同子元素）从根节点上摘掉
+        root.clear()
+
+
+def _with_progress(events, started: float, counts: Dict[str, int]):
+    for kind, item in events:
+        counts[kind] += 1
+        total = counts["metric"] + counts["workout"]
+        if total % PROGRESS_EVERY == 0:
+            elapsed = time.perf_counter() - started
+            print(f"✅ Parsed {total} rows ({total / max(elapsed, 1e-9):.0f} rows/s)...")
+        yield kind, item
+
+
+def import_export(path, sources: List[str] = None, chunk_size: int = INGEST_CHUNK_SIZE,
+                  user_id: int = DEFAULT_USER_ID):
+    print(f"📖 Streaming {path}...")
+    started = time.perf_counter()
+    counts = {"metric": 0, "workout": 0}
+    # 导出文件是全部历史数据，不受 webhook 水位线限制
+    result = ingest_events(_with_progress(iter_export(path, sources), started, counts), chunk_size=chunk_size,
+                           backfill=True, user_id=user_id)
+
+    elapsed = time.perf_counter() - started
+    total = counts["metric"] + counts["workout"]
+    print(
+        f"🚀 Imported {counts['metric']} samples "
+        f"({result['metrics']['inserted']} new, {result['metrics']['updated']} updated) and "
+        f"{counts['workout']} workouts in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} rows/s)."
+    )
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import an Apple Health export.xml into the database.")
+    parser.add_argument("xml_path", help="path to export.xml from the Health app's 'Export All Health Data'")
+    parser.add_argument("--source", action="append", dest="sources",
+                        help="only import records whose sourceName contains this string (repeatable)")
+    parser.add_argument("--chunk-size", type=int, default=INGEST_CHUNK_SIZE, help="rows per upsert batch")
+    parser.add_argument("--user", help="import into this user's data (default: the default user)")
+    args = parser.parse_args()
+
+    try:
+        import_export(args.xml_path, sources=args.sources, chunk_size=args.chunk_size,
+                      user_id=user_id_for(args.user))
+    except FileNotFoundError:
+        print(f"File not found: {args.xml_path}")
+        sys.exit(1)
+    except Exception as e:
+        print(f"❌ Error during import: {e}")
+        sys.exit(1)
@@ -1,41 +1,142 @@
+import io
+import sys
+import time
+import argparse
 import pandas as pd
-from database import SessionLocal, HealthMetric
-from datetime import datetime
-import os
+from sqlalchemy import text
+from database import DEFAULT_USER_ID, SessionLocal
+from ingest import RAW_DATA_POLICY, upsert_metrics
+from rollups import refresh_rollups
+from generations import HEALTH_DATA, bump_generations, metric_generation
+from timeparse import parse_column
+from users import user_id_for
 
-def import_csv(file_path):
+# 每次从 CSV 读入的行数，决定导入时的内存上限
+CHUNK_ROWS = 100_000
+
+_COLUMNS = ["timestamp", "metric_type", "value", "unit", "source", "raw_data"]
+# CSV 快照里没有 timestamp/value 之外的原始字段，只留一个来源标记（RAW_DATA_POLICY=none 时不保存）
+_RAW_DATA = None if RAW_DATA_POLICY == "none" else '{"imported": true}'
+
+_STAGING_DDL = """
+CREATE TEMP TABLE health_metrics_staging (
+    seq BIGSERIAL,
+    timestamp TIMESTAMP WITHOUT TIME ZONE,
+    metric_type VARCHAR,
+    value DOUBLE PRECISION,
+    unit VARCHAR,
+    source VARCHAR,
+    raw_data JSONB
+) ON COMMIT DROP
+"""
+
+# 同一个 (timestamp, metric_type) 在文件里出现多次时，以最后一次为准
+_MERGE_SQL = """
+INSERT INTO health_metrics (user_id, timestamp, metric_type, value, unit, source, raw_data)
+SELECT DISTINCT ON (timestamp, metric_type) :user_id, timestamp, metric_type, value, unit, source, raw_data
+FROM health_metrics_staging
+ORDER BY timestamp, metric_type, seq DESC
+ON CONFLICT (user_id, timestamp, metric_type) DO UPDATE SET
+    value = EXCLUDED.value, unit = EXCLUDED.unit, source = EXCLUDED.source, raw_data = EXCLUDED.raw_data
+"""
+
+
+def normalize_chunk(df: pd.DataFrame) -> pd.DataFrame:
+    """Column-wise cleanup of one CSV chunk into health_metrics columns."""
+    out = pd.DataFrame({
+        # 按第一行探测出的格式整列解析，统一换算成 naive UTC
+        "timestamp": parse_column(df["timestamp"]),
+        "metric_type": df["metric_type"],
+        "value": pd.to_numeric(df["value"], errors="coerce"),
+        "unit": df["unit"].fillna("count") if "unit" in df else "count",
+        "source": df["source"].fillna("apple_health") if "source" in df else "apple_health",
+        "raw_data": _RAW_DATA,
+    })
+    return out.dropna(subset=["timestamp", "metric_type", "value"])
+
+
+def _copy_chunk(db, df: pd.DataFrame):
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False, columns=_COLUMNS, date_format="%Y-%m-%d %H:%M:%S.%f")
+    buf.seek(0)
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY health_metrics_staging ({', '.join(_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buf
+        )
+    finally:
+        cursor.close()
+
+
+def _import_postgres(db, chunks, user_id):
+    db.execute(text(_STAGING_DDL))
+    count = 0
+    for df in chunks:
+        _copy_chunk(db, df)
+        count += len(df)
+        print(f"✅ Staged {count} rows...")
+
+    db.execute(text(_MERGE_SQL), {"user_id": user_id})
+    touched = db.execute(text(
+        "SELECT DISTINCT metric_type, CAST(timestamp AS DATE) FROM health_metrics_staging"
+    )).all()
+    refresh_rollups(db, touched, user_id)
+    return count, {m for m, _ in touched}
+
+
+def _import_generic(db, chunks, user_id):
+    count = 0
+    touched = set()
+    for df in chunks:
+        records = df.to_dict("records")
+        for r in records:
+            r["timestamp"] = r["timestamp"].to_pydatetime()
+            r["raw_data"] = None if _RAW_DATA is None else {"imported": True}
+            touched.add((r["metric_type"], r["timestamp"].date()))
+        upsert_metrics(db, records, user_id=user_id)
+        count += len(records)
+        print(f"✅ Processed {count} rows...")
+    refresh_rollups(db, touched, user_id)
+    return count, {m for m, _ in touched}
+
+
+def import_csv(file_path, chunk_rows=CHUNK_ROWS, user_id=DEFAULT_USER_ID):
     print(f"📖 Reading {file_path}...")
-    df = pd.read_csv(file_path)
-    
+    started = time.perf_counter()
+    chunks = (normalize_chunk(df) for df in pd.read_csv(file_path, chunksize=chunk_rows))
+
     db = SessionLocal()
-    count = 0
     try:
-        for idx, row in df.iterrows():
-            ts = datetime.fromisoformat(row['timestamp'].replace(" -0800", "-08:00"))
-            metric = HealthMetric(
-                timestamp=ts,
-                metric_type=row['metric_type'],
-                value=float(row['value']),
-                unit=row.get('unit', 'count'),
-                source=row.get('source', 'apple_health'),
-                raw_data={"imported": True}
-            )
-            db.merge(metric)
-            count += 1
-            if count % 100 == 0:
-                print(f"✅ Processed {count} rows...")
-        
+        # PostgreSQL 上走 COPY → 临时表 → 一条 INSERT ... SELECT ... ON CONFLICT
+        if db.get_bind().dialect.name == "postgresql":
+            count, metric_types = _import_postgres(db, chunks, user_id)
+        else:
+            count, metric_types = _import_generic(db, chunks, user_id)
+        if count:
+            bump_generations(db, {HEALTH_DATA} | {metric_generation(m) for m in metric_types}, user_id)
         db.commit()
-        print(f"🚀 Successfully imported {count} data points to local database.")
+        elapsed = time.perf_counter() - started
+        print(f"🚀 Successfully imported {count} data points in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.0f} rows/s).")
+        return count
     except Exception as e:
         print(f"❌ Error during import: {e}")
         db.rollback()
+        raise
     finally:
         db.close()
 
+
 if __name__ == "__main__":
-    csv_path = "/Users/agent_bobo/.openclaw/media/inbound/f4ed3c9a-48db-4d42-8915-bceb298ab374.csv"
-    if os.path.exists(csv_path):
-        import_csv(csv_path)
-    else:
-        print(f"File not found: {csv_path}")
+    parser = argparse.ArgumentParser(description="Import a flattened Apple Health CSV snapshot into health_metrics.")
+    parser.add_argument("csv_path", help="CSV with timestamp, metric_type, value[, unit, source] columns")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="rows read per chunk (bounds memory)")
+    parser.add_argument("--user", help="import into this user's data (default: the default user)")
+    args = parser.parse_args()
+
+    try:
+        import_csv(args.csv_path, chunk_rows=args.chunk_rows, user_id=user_id_for(args.user))
+    except FileNotFoundError:
+        print(f"File not found: {args.csv_path}")
+        sys.exit(1)
+    except Exception:
+        sys.exit(1)
@@ -0,0 +1,494 @@
+import os
+import asyncio
+import logging
+import threading
+from itertools import islice
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Tuple
+
+import ijson
+from sqlalchemy import func, literal_column, tuple_
+from sqlalchemy.util import await_only
+
+import database
+
+from database import DEFAULT_USER_ID, SessionLocal, HealthMetric, Workout, dialect_insert, run_db
+from partitions import is_partitioned
+from rollups import refresh_rollups
+from telemetry import INGEST_SAMPLES, StageTimer
+from generations import HEALTH_DATA, WORKOUTS, bump_generations, metric_generation
+from timeparse import TimestampParser, parse_timestamp
+from watermarks import (
+    advance_watermarks, file_fingerprint, payload_fingerprint, record_fingerprint, seen_recently, skip_cutoffs,
+)
+
+logger = logging.getLogger(__name__)
+
+# 每批写入的样本数，可通过环境变量调整
+INGEST_CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", "5000"))
+
+# 单条语句允许的绑定参数上限（PostgreSQL 协议限制 / SQLite 编译期默认值）
+_MAX_BIND_PARAMS = {"postgresql": 65535, "sqlite": 32766}
+
+# health_metrics.raw_data 的保存策略：
+#   none    - 不保存
+#   compact - 只保存 timestamp/value 之外的字段（默认）
+#   full    - 原样保存整个样本
+RAW_DATA_POLICY = os.getenv("RAW_DATA_POLICY", "compact")
+RAW_DATA_POLICIES = ("none", "compact", "full")
+# 样本没带设备名时的来源
+DEFAULT_SOURCE = "apple_health"
+# 已经落在 timestamp / value 列里的样本字段
+DERIVED_SAMPLE_KEYS = ("date", "qty")
+
+_METRIC_UPDATE_COLUMNS = ("value", "unit", "source", "raw_data")
+_WORKOUT_UPDATE_COLUMNS = (
+    "end_timestamp", "duration_minutes", "active_calories", "avg_heart_rate", "max_heart_rate", "raw_data",
+)
+
+_partitioned_tables: Dict[str, bool] = {}
+
+# 异步入库时解析线程每次交给事件循环的事件数，以及最多排队的批数
+ASYNC_PARSE_BATCH = int(os.getenv("ASYNC_PARSE_BATCH", "1000"))
+# 异步引擎下每批写入的行数：每批的参数处理都在事件循环上，批小一些其它请求等得就短
+ASYNC_INGEST_CHUNK_SIZE = int(os.getenv("ASYNC_INGEST_CHUNK_SIZE", "1000"))
+_ASYNC_PARSE_QUEUE = 4
+
+# 流式解析时关心的 JSON 路径（ijson prefix 语法）
+_METRIC_PREFIX = "data.metrics.item"
+_SAMPLE_PREFIX = "data.metrics.item.data.item"
+_WORKOUT_PREFIX = "data.workouts.item"
+
+
+def _chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _is_partitioned(db, table: str) -> bool:
+    # 分区布局只会在停机迁移时改变，每个进程查一次即可
+    if table not in _partitioned_tables:
+        _partitioned_tables[table] = is_partitioned(db.connection(), table)
+    return _partitioned_tables[table]
+
+
+def _effective_chunk_size(db, chunk_size, column_count: int) -> int:
+    size = chunk_size or INGEST_CHUNK_SIZE
+    limit = _MAX_BIND_PARAMS.get(db.get_bind().dialect.name)
+    if limit:
+        size = min(size, limit // column_count)
+    return max(size, 1)
+
+
+def metric_rows(metrics: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """Flatten Health Auto Export `data.metrics` into health_metrics row dicts."""
+    for m in metrics:
+        metric_type = m.get("name")
+        unit = m.get("units")
+        # 每个指标序列只探测一次时间格式
+        parse_ts = TimestampParser()
+        for sample in m.get("data", []):
+            row = metric_row(metric_type, unit, sample, parse_ts)
+            if row is not None:
+                yield row
+
+
+def sample_raw_data(sample: Dict[str, Any], policy: str = None):
+    """Apply the raw_data storage policy to one sample; returns None when nothing is kept."""
+    policy = policy or RAW_DATA_POLICY
+    if policy == "full":
+        return sample
+    if policy == "compact":
+        extra = {k: v for k, v in sample.items() if k not in DERIVED_SAMPLE_KEYS and v is not None}
+        return extra or None
+    if policy == "none":
+        return None
+    raise ValueError(f"Unknown RAW_DATA_POLICY '{policy}', expected one of {RAW_DATA_POLICIES}")
+
+
+def sample_source(sample: Dict[str, Any]) -> str:
+    """Device that recorded the sample: HAE `source`, or `sourceName` from the Health export XML."""
+    source = sample.get("source") or sample.get("sourceName")
+    source = str(source).strip() if source is not None else ""
+    return source or DEFAULT_SOURCE
+
+
+def metric_row(metric_type: str, unit: str, sample: Dict[str, Any],
+               parse_ts: Callable[[str], Any] = parse_timestamp):
+    ts_str = sample.get("date")
+    val = sample.get("qty")
+    if not ts_str or val is None:
+        return None
+    return {
+        "timestamp": parse_ts(ts_str),
+        "metric_type": metric_type,
+        "value": float(val),
+        "unit": unit,
+        # 水位线按 (指标, 来源) 记录，每台设备各自推进
+        "source": sample_source(sample),
+        "raw_data": sample_raw_data(sample),
+    }
+
+
+def _upsert(db, model, rows: Iterable[Dict[str, Any]], key_columns: Tuple[str, ...],
+            update_columns: Tuple[str, ...], constraint: str, chunk_size: int = None) -> Dict[str, Any]:
+    insert = dialect_insert(db)
+    is_pg = db.get_bind().dialect.name == "postgresql"
+    use_xmax = is_pg and not _is_partitioned(db, model.__tablename__)
+    size = _effective_chunk_size(db, chunk_size, len(key_columns) + len(update_columns))
+    key_attrs = [getattr(model, c) for c in key_columns]
+
+    # 语句只构造一次，按 executemany 执行：编译结果走缓存，驱动层再拼成多行 VALUES，
+    # 每批只剩绑定参数的处理，不会在异步引擎的事件循环上长时间编译大语句
+    stmt = insert(model.__table__)
+    if is_pg:
+        stmt = stmt.on_conflict_do_update(
+            constraint=constraint,
+            set_={c: stmt.excluded[c] for c in update_columns},
+        )
+    else:
+        # SQLite 不支持 ON CONSTRAINT
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(key_columns),
+            set_={c: stmt.excluded[c] for c in update_columns},
+        )
+    if use_xmax:
+        # xmax = 0 表示这一行是新插入的，而不是被更新的
+        stmt = stmt.returning(literal_column("(xmax = 0)").label("inserted"))
+    conn = db.connection()
+
+    batches = []
+    for chunk in _chunked(rows, size):
+        # 同一语句里同一个键出现两次时 PostgreSQL 会报错，后到的记录覆盖前面的
+        deduped = {tuple(r[c] for c in key_columns): r for r in chunk}
+        values = list(deduped.values())
+
+        if use_xmax:
+            inserted = sum(1 for r in conn.execute(stmt, values) if r.inserted)
+        else:
+            # SQLite 和分区表上取不到 xmax，先用一条查询数出已存在的键
+            existing = db.query(func.count()).select_from(model).filter(
+                tuple_(*key_attrs).in_(list(deduped.keys()))
+            ).scalar()
+            conn.execute(stmt, values)
+            inserted = len(values) - existing
+
+        batches.append({"rows": len(values), "inserted": inserted, "updated": len(values) - inserted})
+
+    return {
+        "inserted": sum(b["inserted"] for b in batches),
+        "updated": sum(b["updated"] for b in batches),
+        "batches": batches,
+    }
+
+
+def _owned_by(rows: Iterable[Dict[str, Any]], user_id: int) -> Iterator[Dict[str, Any]]:
+    # 行里没带 user_id 的归到调用方指定的用户
+    for row in rows:
+        row.setdefault("user_id", user_id)
+        yield row
+
+
+def upsert_metrics(db, rows: Iterable[Dict[str, Any]], chunk_size: int = None,
+                   user_id: int = DEFAULT_USER_ID) -> Dict[str, Any]:
+    """
+    Write metric rows with one multi-row INSERT ... ON CONFLICT (user_id, timestamp,
+    metric_type) DO UPDATE per chunk. The caller owns the transaction.
+
+    Returns totals plus a per-batch breakdown of inserted/updated counts.
+    """
+    return _upsert(db, HealthMetric, _owned_by(rows, user_id), ("user_id", "timestamp", "metric_type"),
+                   _METRIC_UPDATE_COLUMNS, "_user_timestamp_metric_uc", chunk_size=chunk_size)
+
+
+def upsert_workouts(db, rows: Iterable[Dict[str, Any]], chunk_size: int = None,
+                    user_id: int = DEFAULT_USER_ID) -> Dict[str, Any]:
+    """
+    Write workout rows with one INSERT ... ON CONFLICT ON CONSTRAINT _user_workout_start_type_uc
+    DO UPDATE per chunk. Same return shape as `upsert_metrics`.
+    """
+    return _upsert(db, Workout, _owned_by(rows, user_id), ("user_id", "start_timestamp", "workout_type"),
+                   _WORKOUT_UPDATE_COLUMNS, "_user_workout_start_type_uc", chunk_size=chunk_size)
+
+
+def iter_payload_dict(payload: Dict[str, Any]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Yield ("metric", row) / ("workout", workout) events from an already-parsed payload."""
+    data = payload.get("data", {})
+    for row in metric_rows(data.get("metrics", [])):
+        yield "metric", row
+    for w in data.get("workouts", []):
+        yield "workout", w
+
+
+def iter_payload(fp: BinaryIO) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Incrementally parse a Health Auto Export body from a file object.
+
+    Only one sample (or one workout) is materialized at a time, so memory stays flat
+    regardless of payload size. Samples that appear before their metric's `name`/`units`
+    keys are buffered until the metric header is known.
+    """
+    metric_type = unit = None
+    parse_ts = TimestampParser()
+    pending = []
+    builder = None
+    builder_prefix = None
+
+    for prefix, event, value in ijson.parse(fp, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == builder_prefix and event == "end_map":
+                item = builder.value
+                builder = None
+                if builder_prefix == _WORKOUT_PREFIX:
+                    yield "workout", item
+                elif metric_type is None or unit is None:
+                    pending.append(item)
+                else:
+                    row = metric_row(metric_type, unit, item, parse_ts)
+                    if row is not None:
+                        yield "metric", row
+            continue
+
+        if event == "start_map" and prefix in (_SAMPLE_PREFIX, _WORKOUT_PREFIX):
+            builder = ijson.ObjectBuilder()
+            builder_prefix = prefix
+            builder.event(event, value)
+        elif prefix == _METRIC_PREFIX and event == "start_map":
+            metric_type = unit = None
+            parse_ts = TimestampParser()
+            pending = []
+        elif prefix == _METRIC_PREFIX + ".name":
+            metric_type = value
+        elif prefix == _METRIC_PREFIX + ".units":
+            unit = value
+        elif prefix == _METRIC_PREFIX and event == "end_map":
+            for sample in pending:
+                row = metric_row(metric_type, unit, sample, parse_ts)
+                if row is not None:
+                    yield "metric", row
+            pending = []
+
+
+def workout_row(w: Dict[str, Any]):
+    start_str = w.get("start")
+    end_str = w.get("end")
+    if not start_str:
+        return None
+
+    # Duration can be provided in seconds or minutes depending on the export format
+    duration_raw = w.get("duration")
+    duration_minutes = None
+    if duration_raw is not None:
+        # Health Auto Export sends duration in seconds
+        duration_minutes = round(float(duration_raw) / 60, 2)
+
+    active_cal_raw = w.get("activeEnergyBurned") or w.get("totalEnergy")
+    active_calories = active_cal_raw.get("qty") if isinstance(active_cal_raw, dict) else None
+
+    hr = w.get("heartRate") or {}
+
+    return {
+        "start_timestamp": parse_timestamp(start_str),
+        "end_timestamp": parse_timestamp(end_str) if end_str else None,
+        "workout_type": w.get("name", "Unknown"),
+        "duration_minutes": duration_minutes,
+        "active_calories": active_calories,
+        "avg_heart_rate": hr.get("avg", {}).get("qty"),
+        "max_heart_rate": hr.get("max", {}).get("qty"),
+        "raw_data": w,
+    }
+
+
+def _merge_summary(summary: Dict[str, Any], result: Dict[str, Any]):
+    summary["inserted"] += result["inserted"]
+    summary["updated"] += result["updated"]
+    summary["batches"].extend(result["batches"])
+
+
+def _empty_summary() -> Dict[str, Any]:
+    return {"inserted": 0, "updated": 0, "skipped": 0, "batches": []}
+
+
+def ingest_into(db, events: Iterable[Tuple[str, Dict[str, Any]]], chunk_size: int = None,
+                fingerprint: str = None, backfill: bool = False, user_id: int = DEFAULT_USER_ID):
+    """
+    Write a stream of ("metric", row) / ("workout", workout) events for `user_id` in
+    batches, refresh the touched daily rollups and commit once at the end.
+
+    Unless `backfill` is set, a payload whose `fingerprint` was seen recently is skipped
+    outright and samples older than their (metric_type, source) watermark minus the grace
+    window are dropped (see watermarks.py); they are counted under `skipped`.
+    """
+    # 各阶段耗时（解析、写入、汇总、提交）累加后按每个载荷上报一次
+    timer = StageTimer()
+    try:
+        metric_summary = _empty_summary()
+        workout_summary = _empty_summary()
+        if fingerprint and not backfill and seen_recently(db, fingerprint, user_id):
+            logger.info(f"Payload {fingerprint[:12]} already ingested; skipping.")
+            return {"metrics": metric_summary, "workouts": workout_summary, "duplicate": True}
+
+        size = chunk_size or INGEST_CHUNK_SIZE
+        metric_buffer = []
+        workout_buffer = []
+        touched_days = set()
+        samples = 0
+        cutoffs = {} if backfill else skip_cutoffs(db, user_id)
+        newest = {}
+
+        # 样本和训练记录按批次攒够就写入，内存占用只和批大小有关
+        for kind, item in timer.wrap_iter(events, "parse"):
+            if kind == "metric":
+                samples += 1
+                key = (item["metric_type"], item["source"])
+                ts = item["timestamp"]
+                cutoff = cutoffs.get(key)
+                if cutoff is not None and ts < cutoff:
+                    metric_summary["skipped"] += 1
+                    continue
+                if key not in newest or ts > newest[key]:
+                    newest[key] = ts
+                metric_buffer.append(item)
+                touched_days.add((item["metric_type"], ts.date()))
+                if len(metric_buffer) >= size:
+                    with timer("upsert_metrics"):
+                        _merge_summary(metric_summary, upsert_metrics(db, metric_buffer, chunk_size, user_id))
+                    metric_buffer.clear()
+            else:
+                with timer("parse"):
+                    row = workout_row(item)
+                if row is None:
+                    continue
+                workout_buffer.append(row)
+                if len(workout_buffer) >= size:
+                    with timer("upsert_workouts"):
+                        _merge_summary(workout_summary, upsert_workouts(db, workout_buffer, chunk_size, user_id))
+                    workout_buffer.clear()
+        if metric_buffer:
+            with timer("upsert_metrics"):
+                _merge_summary(metric_summary, upsert_metrics(db, metric_buffer, chunk_size, user_id))
+        if workout_buffer:
+            with timer("upsert_workouts"):
+                _merge_summary(workout_summary, upsert_workouts(db, workout_buffer, chunk_size, user_id))
+
+        # 只重算本次涉及到的 (指标, 日期) 的日汇总
+        with timer("rollups"):
+            refresh_rollups(db, touched_days, user_id)
+
+        count = metric_summary["inserted"] + metric_summary["updated"]
+        workout_count = workout_summary["inserted"] + workout_summary["updated"]
+        if count or workout_count:
+            # 推进数据版本号，让其他进程里的统计缓存和报告缓存失效
+            changed = {HEALTH_DATA} | {metric_generation(m) for m, _ in touched_days}
+            if workout_count:
+                changed.add(WORKOUTS)
+            with timer("generations"):
+                bump_generations(db, changed, user_id)
+
+        with timer("watermarks"):
+            advance_watermarks(db, newest, user_id)
+            if fingerprint:
+                record_fingerprint(db, fingerprint, samples, user_id)
+
+        with timer("commit"):
+            db.commit()
+        timer.observe()
+        INGEST_SAMPLES.observe(samples)
+        logger.info(
+            f"Successfully processed {count} metric samples "
+            f"({metric_summary['inserted']} inserted, {metric_summary['updated']} updated, "
+            f"{metric_summary['skipped']} below watermark) and {workout_count} workouts."
+        )
+        return {"metrics": metric_summary, "workouts": workout_summary, "duplicate": False}
+    except Exception as e:
+        logger.error(f"Error processing webhook: {e}")
+        db.rollback()
+        raise
+
+
+def ingest_events(events: Iterable[Tuple[str, Dict[str, Any]]], chunk_size: int = None,
+                  fingerprint: str = None, backfill: bool = False, user_id: int = DEFAULT_USER_ID):
+    db = SessionLocal()
+    try:
+        return ingest_into(db, events, chunk_size=chunk_size, fingerprint=fingerprint, backfill=backfill,
+                           user_id=user_id)
+    finally:
+        db.close()
+
+
+def process_health_data(payload: Dict[str, Any], chunk_size: int = None, backfill: bool = False,
+                        user_id: int = DEFAULT_USER_ID):
+    return ingest_events(iter_payload_dict(payload), chunk_size=chunk_size,
+                         fingerprint=payload_fingerprint(payload), backfill=backfill, user_id=user_id)
+
+
+def process_health_stream(fp: BinaryIO, chunk_size: int = None, backfill: bool = False,
+                          user_id: int = DEFAULT_USER_ID):
+    """Ingest a body from a seekable file object (it is hashed once before parsing)."""
+    return ingest_events(iter_payload(fp), chunk_size=chunk_size,
+                         fingerprint=file_fingerprint(fp), backfill=backfill, user_id=user_id)
+
+
+def process_health_file(path: str, chunk_size: int = None, backfill: bool = False,
+                        user_id: int = DEFAULT_USER_ID):
+    """Stream a spooled webhook body from disk into the database."""
+    with open(path, "rb") as fp:
+        return process_health_stream(fp, chunk_size=chunk_size, backfill=backfill, user_id=user_id)
+
+
+def _parse_into(fp: BinaryIO, loop, queue: asyncio.Queue, stop: threading.Event):
+    """Producer thread: parse `fp` and hand the events to the loop in batches, then None (or the error)."""
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    try:
+        for batch in _chunked(iter_payload(fp), ASYNC_PARSE_BATCH):
+            if stop.is_set():
+                return
+            put(batch)
+    except Exception as e:
+        put(e)
+        return
+    put(None)
+
+
+def _queued_events(queue: asyncio.Queue) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    # 在 run_sync 的 greenlet 里执行：等下一批时把控制权交还事件循环
+    while True:
+        batch = await_only(queue.get())
+        if batch is None:
+            return
+        if isinstance(batch, Exception):
+            raise batch
+        yield from batch
+
+
+async def process_health_file_async(path: str, chunk_size: int = None, backfill: bool = False,
+                                    user_id: int = DEFAULT_USER_ID):
+    """
+    `process_health_file` for the event loop. With DATABASE_ASYNC the file is read and
+    parsed on a worker thread and only the database work runs on the loop; otherwise the
+    whole ingest runs on a worker thread through `database.run_db`.
+    """
+    with open(path, "rb") as fp:
+        fingerprint = await asyncio.to_thread(file_fingerprint, fp)
+        options = dict(chunk_size=chunk_size, fingerprint=fingerprint, backfill=backfill, user_id=user_id)
+        if not database.DATABASE_ASYNC:
+            return await run_db(ingest_into, iter_payload(fp), **options)
+
+        options["chunk_size"] = chunk_size or ASYNC_INGEST_CHUNK_SIZE
+        queue = asyncio.Queue(maxsize=_ASYNC_PARSE_QUEUE)
+        stop = threading.Event()
+        producer = asyncio.create_task(asyncio.to_thread(_parse_into, fp, asyncio.get_running_loop(), queue, stop))
+        try:
+            return await run_db(ingest_into, _queued_events(queue), **options)
+        finally:
+            # 写入失败或载荷重复时解析线程可能还卡在 put 上：先让它停，再腾出队列
+            stop.set()
+            while not queue.empty():
+                queue.get_nowait()
+            await producer
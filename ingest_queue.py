@@ -0,0 +1,307 @@
+import os
+import json
+import asyncio
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional
+
+from telemetry import INGEST_JOBS
+
+logger = logging.getLogger(__name__)
+
+# 落盘目录需要挂载到持久卷，容器重启后未处理的任务会被继续消费
+SPOOL_DIR = os.getenv("INGEST_SPOOL_DIR", "./spool")
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_QUEUE_MAX = int(os.getenv("INGEST_QUEUE_MAX", "50"))
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "3"))
+INGEST_RETRY_DELAY = float(os.getenv("INGEST_RETRY_DELAY", "5"))
+# running 任务的租约：处理期间定期续期，超过这么久没续期说明领取它的进程已经退出
+INGEST_JOB_LEASE_SECONDS = float(os.getenv("INGEST_JOB_LEASE_SECONDS", "300"))
+
+# 已完成任务的状态保留时间，之后清理掉
+_DONE_RETENTION_SECONDS = 7 * 24 * 3600
+_POLL_INTERVAL = 1.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    path TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    next_attempt_at REAL NOT NULL,
+    error TEXT,
+    result TEXT,
+    options TEXT
+)
+"""
+
+
+class QueueFull(Exception):
+    pass
+
+
+def _options(job: sqlite3.Row) -> Dict[str, Any]:
+    return json.loads(job["options"]) if job["options"] else {}
+
+
+class IngestQueue:
+    """
+    SQLite-backed journal of accepted webhook payloads.
+
+    Payload bodies live as files under `<spool_dir>/payloads`; the journal tracks their
+    status (pending → running → done / failed) so work survives restarts and is retried.
+    A running job holds a lease that its worker renews; once the lease lapses the job is
+    handed out again, so several processes can share one spool.
+    """
+
+    def __init__(self, spool_dir: str = SPOOL_DIR, max_pending: int = INGEST_QUEUE_MAX,
+                 max_attempts: int = INGEST_MAX_ATTEMPTS, retry_delay: float = INGEST_RETRY_DELAY,
+                 lease_seconds: float = INGEST_JOB_LEASE_SECONDS):
+        self.spool_dir = spool_dir
+        self.payload_dir = os.path.join(spool_dir, "payloads")
+        self.db_path = os.path.join(spool_dir, "queue.db")
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease_seconds = lease_seconds
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._tasks: List[asyncio.Task] = []
+
+        os.makedirs(self.payload_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(_SCHEMA)
+            # 旧版本创建的日志表没有 options 列
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "options" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN options TEXT")
+            # 租约已过期的 running 任务重新排队；还在续期的可能正由另一个进程处理
+            conn.execute(
+                "UPDATE jobs SET status = 'pending' WHERE status = 'running' AND updated_at < ?",
+                (time.time() - self.lease_seconds,),
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def new_payload_path(self) -> str:
+        return os.path.join(self.payload_dir, f"{uuid.uuid4().hex}.json")
+
+    def depth(self) -> int:
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT count(*) FROM jobs WHERE status IN ('pending', 'running')"
+            ).fetchone()[0]
+
+    def is_full(self) -> bool:
+        return self.depth() >= self.max_pending
+
+    def enqueue(self, path: str, options: Dict[str, Any] = None) -> str:
+        """Queue a spooled payload; `options` are passed to the handler as keyword arguments."""
+        if self.is_full():
+            raise QueueFull(f"Ingestion queue is full ({self.max_pending} jobs pending)")
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, status, path, created_at, updated_at, next_attempt_at, options) "
+                "VALUES (?, 'pending', ?, ?, ?, ?, ?)",
+                (job_id, path, now, now, now, json.dumps(options) if options else None),
+            )
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id, status, attempts, created_at, updated_at, error, result, options FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        job["options"] = _options(row)
+        return job
+
+    def claim(self) -> Optional[sqlite3.Row]:
+        now = time.time()
+        with self._connect() as conn:
+            # IMMEDIATE 事务保证多个 worker 不会领到同一个任务
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # 运行中途退出的进程留下的任务，租约过期后也可以领取
+                row = conn.execute(
+                    "SELECT id, path, attempts, options FROM jobs "
+                    "WHERE (status = 'pending' AND next_attempt_at <= ?) OR (status = 'running' AND updated_at < ?) "
+                    "ORDER BY created_at LIMIT 1",
+                    (now, now - self.lease_seconds),
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                        (now, row["id"]),
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return row
+
+    def renew(self, job_id: str):
+        """Extend the lease of a running job."""
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET updated_at = ? WHERE id = ? AND status = 'running'", (time.time(), job_id))
+
+    @contextmanager
+    def _lease(self, job_id: str) -> Iterator[None]:
+        # 续期放在独立线程里，异步 worker 的处理过程不用关心它
+        done = threading.Event()
+
+        def keep_alive():
+            while not done.wait(self.lease_seconds / 3):
+                try:
+                    self.renew(job_id)
+                except sqlite3.Error as e:
+                    logger.warning(f"Could not renew lease of ingest job {job_id}: {e}")
+
+        t = threading.Thread(target=keep_alive, name=f"ingest-lease-{job_id[:8]}", daemon=True)
+        t.start()
+        try:
+            yield
+        finally:
+            done.set()
+            t.join()
+
+    def complete(self, job_id: str, path: str, result: Any):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'done', updated_at = ?, error = NULL, result = ? WHERE id = ?",
+                (now, json.dumps(result, default=str), job_id),
+            )
+            conn.execute(
+                "DELETE FROM jobs WHERE status = 'done' AND updated_at < ?",
+                (now - _DONE_RETENTION_SECONDS,),
+            )
+        INGEST_JOBS.labels("done").inc()
+        if os.path.exists(path):
+            os.remove(path)
+
+    def fail(self, job_id: str, attempts: int, error: str):
+        now = time.time()
+        with self._connect() as conn:
+            if attempts < self.max_attempts:
+                # 指数退避后重试
+                delay = self.retry_delay * (2 ** (attempts - 1))
+                conn.execute(
+                    "UPDATE jobs SET status = 'pending', updated_at = ?, next_attempt_at = ?, error = ? WHERE id = ?",
+                    (now, now + delay, error, job_id),
+                )
+                INGEST_JOBS.labels("retry").inc()
+            else:
+                # 失败的载荷文件保留在磁盘上，便于排查后手动重放
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', updated_at = ?, error = ? WHERE id = ?",
+                    (now, error, job_id),
+                )
+                INGEST_JOBS.labels("failed").inc()
+
+    def _record_failure(self, job: sqlite3.Row, error: Exception):
+        attempts = job["attempts"] + 1
+        logger.error(f"Ingest job {job['id']} failed (attempt {attempts}/{self.max_attempts}): {error}")
+        self.fail(job["id"], attempts, str(error))
+
+    def run_once(self, handler: Callable[[str], Any]) -> bool:
+        """Claim and process a single job. Returns False when nothing is ready."""
+        job = self.claim()
+        if job is None:
+            return False
+        try:
+            with self._lease(job["id"]):
+                result = handler(job["path"], **_options(job))
+        except Exception as e:
+            self._record_failure(job, e)
+        else:
+            self.complete(job["id"], job["path"], result)
+        return True
+
+    async def run_once_async(self, handler: Callable[[str], Awaitable[Any]]) -> bool:
+        """`run_once` for a coroutine handler; the journal is touched from a worker thread."""
+        job = await asyncio.to_thread(self.claim)
+        if job is None:
+            return False
+        try:
+            with self._lease(job["id"]):
+                result = await handler(job["path"], **_options(job))
+        except Exception as e:
+            await asyncio.to_thread(self._record_failure, job, e)
+        else:
+            await asyncio.to_thread(self.complete, job["id"], job["path"], result)
+        return True
+
+    def drain(self, handler: Callable[[str], Any]) -> int:
+        processed = 0
+        while self.run_once(handler):
+            processed += 1
+        return processed
+
+    def _worker(self, handler: Callable[[str], Any]):
+        while not self._stop.is_set():
+            try:
+                if not self.run_once(handler):
+                    self._stop.wait(_POLL_INTERVAL)
+            except Exception as e:
+                logger.error(f"Ingest worker error: {e}")
+                self._stop.wait(_POLL_INTERVAL)
+
+    def start(self, handler: Callable[[str], Any], workers: int = INGEST_WORKERS):
+        self._stop.clear()
+        for i in range(workers):
+            t = threading.Thread(target=self._worker, args=(handler,), name=f"ingest-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        logger.info(f"Started {workers} ingest workers (spool: {self.spool_dir})")
+
+    def stop(self, timeout: float = 30):
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    async def _async_worker(self, handler: Callable[[str], Awaitable[Any]]):
+        while not self._stop.is_set():
+            try:
+                if not await self.run_once_async(handler):
+                    await asyncio.sleep(_POLL_INTERVAL)
+            except Exception as e:
+                logger.error(f"Ingest worker error: {e}")
+                await asyncio.sleep(_POLL_INTERVAL)
+
+    def start_async(self, handler: Callable[[str], Awaitable[Any]], workers: int = INGEST_WORKERS):
+        """Consume the journal with asyncio tasks on the running loop instead of threads."""
+        self._stop.clear()
+        for i in range(workers):
+            self._tasks.append(asyncio.create_task(self._async_worker(handler), name=f"ingest-worker-{i}"))
+        logger.info(f"Started {workers} async ingest workers (spool: {self.spool_dir})")
+
+    async def stop_async(self, timeout: float = 30):
+        self._stop.set()
+        if self._tasks:
+            # 正在处理的任务超时没完成就取消，租约过期后会重新排队
+            _, pending = await asyncio.wait(self._tasks, timeout=timeout)
+            for t in pending:
+                t.cancel()
+        self._tasks = []
@@ -0,0 +1,93 @@
+import os
+import json
+import hashlib
+import logging
+from datetime import date, datetime, timedelta
+from typing import Any, Optional
+
+from database import DEFAULT_USER_ID, InsightCacheEntry
+
+logger = logging.getLogger(__name__)
+
+INSIGHT_CACHE_TTL_HOURS = float(os.getenv("INSIGHT_CACHE_TTL_HOURS", "24"))
+INSIGHT_CACHE_MAX_ENTRIES = int(os.getenv("INSIGHT_CACHE_MAX_ENTRIES", "200"))
+
+
+def _sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def prompt_version(template: str, model: str) -> str:
+    return _sha256(json.dumps({"template": template, "model": model}, sort_keys=True))
+
+
+def cache_key(template: str, model: str, data: Any, user_id: int = DEFAULT_USER_ID) -> str:
+    """Canonical hash of the stats payload together with the prompt template, model and owner."""
+    canonical = json.dumps(
+        {"version": prompt_version(template, model), "user": user_id, "data": data},
+        sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str,
+    )
+    return _sha256(canonical)
+
+
+def _fresh(query):
+    cutoff = datetime.utcnow() - timedelta(hours=INSIGHT_CACHE_TTL_HOURS)
+    return query.filter(InsightCacheEntry.created_at >= cutoff)
+
+
+def _touch(db, entry: InsightCacheEntry) -> str:
+    entry.last_used_at = datetime.utcnow()
+    db.commit()
+    return entry.response
+
+
+def lookup(db, key: str) -> Optional[str]:
+    entry = _fresh(db.query(InsightCacheEntry)).filter(InsightCacheEntry.cache_key == key).first()
+    return _touch(db, entry) if entry else None
+
+
+def lookup_unchanged(db, version: str, generation: int, window_day: date = None,
+                     user_id: int = DEFAULT_USER_ID) -> Optional[str]:
+    """
+    The user's last report for this prompt version if none of their data has been ingested
+    since it was generated and the stats window has not moved; lets callers skip the stats queries.
+    """
+    entry = _fresh(db.query(InsightCacheEntry)).filter(
+        InsightCacheEntry.user_id == user_id,
+        InsightCacheEntry.prompt_version == version,
+        InsightCacheEntry.data_generation == generation,
+        InsightCacheEntry.window_day == (window_day or date.today()),
+    ).order_by(InsightCacheEntry.created_at.desc()).first()
+    return _touch(db, entry) if entry else None
+
+
+def store(db, key: str, version: str, generation: int, response: str, window_day: date = None,
+          user_id: int = DEFAULT_USER_ID):
+    now = datetime.utcnow()
+    entry = db.query(InsightCacheEntry).filter(InsightCacheEntry.cache_key == key).first()
+    if entry is None:
+        entry = InsightCacheEntry(cache_key=key, prompt_version=version, user_id=user_id)
+        db.add(entry)
+    entry.data_generation = generation
+    entry.window_day = window_day or date.today()
+    entry.response = response
+    entry.created_at = now
+    entry.last_used_at = now
+    db.flush()
+    evicted = evict(db)
+    db.commit()
+    if evicted:
+        logger.info(f"Evicted {evicted} insight cache entries.")
+
+
+def evict(db, max_entries: int = None) -> int:
+    """Drop expired entries, then the least recently used ones beyond `max_entries`."""
+    max_entries = INSIGHT_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+    cutoff = datetime.utcnow() - timedelta(hours=INSIGHT_CACHE_TTL_HOURS)
+    removed = db.query(InsightCacheEntry).filter(InsightCacheEntry.created_at < cutoff).delete()
+
+    keep = db.query(InsightCacheEntry.id).order_by(InsightCacheEntry.last_used_at.desc()).limit(max_entries)
+    removed += db.query(InsightCacheEntry).filter(InsightCacheEntry.id.not_in(keep.scalar_subquery())).delete(
+        synchronize_session=False
+    )
+    return removed
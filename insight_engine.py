@@ -1,9 +1,24 @@
 import os
+import copy
+import time
+import asyncio
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from google import genai
-from sqlalchemy import func
-from database import SessionLocal, HealthMetric, Workout
-from datetime import datetime, timedelta
+from google.genai import types
+from database import DEFAULT_USER_ID, SessionLocal
+from aggregates import metric_summaries
+from generations import WORKOUTS, get_generation, get_generations, metric_generation
+import insight_cache
+from trends import TREND_METRICS, trend_report
+from workout_analytics import workout_summary
+from telemetry import DISCORD_SECONDS, LLM_SECONDS
+from datetime import date, datetime
 import requests
+from requests.adapters import HTTPAdapter
 import logging
 from dotenv import load_dotenv
 
@@ -13,139 +28,158 @@ load_dotenv()
 logger = logging.getLogger(__name__)
 
 
-def get_recent_stats(days=7):
-    db = SessionLocal()
-    try:
-        since = datetime.now() - timedelta(days=days)
-
-        # 针对步数、距离等累加型指标，先进行按天求和，再算平均
-        metrics_to_sum = ['step_count', 'walking_running_distance', 'flights_climbed', 'active_energy']
-
-        result = {}
-        for m_type in metrics_to_sum:
-            daily_sums = db.query(
-                func.date_trunc('day', HealthMetric.timestamp).label('day'),
-                func.sum(HealthMetric.value).label('daily_val')
-            ).filter(
-                HealthMetric.metric_type == m_type,
-                HealthMetric.timestamp >= since
-            ).group_by('day').all()
-
-            if daily_sums:
-                vals = [float(d.daily_val) for d in daily_sums]
-                result[m_type] = {
-                    "daily_avg": round(sum(vals) / len(vals), 2),
-                    "weekly_total": round(sum(vals), 2),
-                    "max_day": max(vals)
-                }
-
-        # 针对心率这种不需要求和的，保持原样或取日均值
-        hr_stats = db.query(
-            func.avg(HealthMetric.value).label('avg_val')
-        ).filter(
-            HealthMetric.metric_type == 'heart_rate',
-            HealthMetric.timestamp >= since
-        ).first()
-
-        if hr_stats and hr_stats.avg_val:
-            result['heart_rate'] = {"avg": round(float(hr_stats.avg_val), 2)}
-
-        return result
-    finally:
-        db.close()
+GEMINI_MODEL = 'gemini-3.1-pro-preview'
+# 超过这个时间还没拿到 Gemini 的回复就发兜底消息
+INSIGHT_LLM_TIMEOUT = float(os.getenv("INSIGHT_LLM_TIMEOUT", "90"))
+INSIGHT_STATS_WORKERS = int(os.getenv("INSIGHT_STATS_WORKERS", "4"))
+
+DISCORD_TIMEOUT = float(os.getenv("DISCORD_TIMEOUT", "10"))
+DISCORD_MAX_RETRIES = 3
+# Discord 要求等待超过这个时间时不再重试
+_DISCORD_MAX_RETRY_AFTER = 60
+
+# 统计结果的进程内 LRU 缓存，按数据版本号失效（版本号存在库里，cron 容器和 API 进程看到的一致）
+STATS_CACHE_SIZE = int(os.getenv("STATS_CACHE_SIZE", "64"))
+
+# 各项统计查询各自开 Session，在有界线程池里并发执行
+_stats_pool = ThreadPoolExecutor(max_workers=INSIGHT_STATS_WORKERS, thread_name_prefix="insight-stats")
+
+# 复用连接的 Discord HTTP 会话
+_discord_session = requests.Session()
+_discord_session.mount("https://", HTTPAdapter(pool_maxsize=4))
+
+PROMPT_TEMPLATE = """
+    你是一个毒舌但专业的健康助手 Bobo。以下是用户近 7 天的多维度健康数据：
+
+    {combined_data}
+
+    请根据上述数据给出一份综合分析报告（250字以内）。
+    要求：
+    1. 风格要专业、简洁、带点幽默或微毒舌。
+    2. 必须进行跨维度分析——例如：睡眠质量如何影响当天训练表现，心率区间能否反映训练强度，步数和训练是否互补。
+    3. 如果数据显示问题（睡眠不足、训练过少、心率异常），直接指出，别客气。
+    4. 如果有训练记录，请评价训练强度（结合心率区间与消耗卡路里），并与睡眠和恢复情况关联。
+    5. 以用户自己的基线为准：z 分数绝对值 ≥2 或周环比变化大的指标重点点评，本来就是常态的别当成问题。
+    6. 最后给出下周一条硬核、可执行的建议。
+    """
+
+# 针对步数、距离等累加型指标，先进行按天求和，再算平均
+SUM_METRICS = ['step_count', 'walking_running_distance', 'flights_climbed', 'active_energy']
 
+# Sleep stage metric types exported by Health Auto Export
+SLEEP_STAGE_TYPES = {
+    'sleep_deep': 'deep_sleep_minutes',
+    'sleep_rem': 'rem_sleep_minutes',
+    'sleep_core': 'core_sleep_minutes',
+    'sleep_awake': 'awake_minutes',
+    'sleep_analysis': 'total_sleep_minutes',
+}
 
-def get_sleep_stats(days=7):
+
+_stats_cache = OrderedDict()
+_stats_cache_lock = threading.Lock()
+
+
+def clear_stats_cache():
+    with _stats_cache_lock:
+        _stats_cache.clear()
+
+
+def stats_cached(generation_names):
+    """
+    Cache a `fn(days, user_id)` stats query per (function, user, days, calendar day, data
+    generations). Any ingest touching one of the user's `generation_names` changes the key,
+    so stale entries are never served and simply age out of the LRU.
+    """
+    names = list(generation_names)
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(days=7, user_id=DEFAULT_USER_ID):
+            db = SessionLocal()
+            try:
+                generations = get_generations(db, names, user_id)
+            finally:
+                db.close()
+            key = (fn.__name__, user_id, days, date.today(), tuple(generations[n] for n in names))
+
+            with _stats_cache_lock:
+                if key in _stats_cache:
+                    _stats_cache.move_to_end(key)
+                    return copy.deepcopy(_stats_cache[key])
+
+            result = fn(days, user_id)
+            with _stats_cache_lock:
+                _stats_cache[key] = copy.deepcopy(result)
+                while len(_stats_cache) > STATS_CACHE_SIZE:
+                    _stats_cache.popitem(last=False)
+            return result
+        return wrapper
+    return decorator
+
+
+@stats_cached(metric_generation(m) for m in SUM_METRICS + ['heart_rate'])
+def get_recent_stats(days=7, user_id=DEFAULT_USER_ID):
+    summaries = metric_summaries(SUM_METRICS + ['heart_rate'], days=days, user_id=user_id)
+
+    result = {}
+    for m_type in SUM_METRICS:
+        s = summaries.get(m_type)
+        if s:
+            result[m_type] = {
+                "daily_avg": round(s["daily_avg"], 2),
+                "weekly_total": round(s["weekly_total"], 2),
+                "max_day": s["max_day"]
+            }
+
+    # 针对心率这种不需要求和的，取所有样本的均值
+    hr = summaries.get('heart_rate')
+    if hr and hr["sample_avg"]:
+        result['heart_rate'] = {"avg": round(hr["sample_avg"], 2)}
+
+    return result
+
+
+@stats_cached(metric_generation(m) for m in SLEEP_STAGE_TYPES)
+def get_sleep_stats(days=7, user_id=DEFAULT_USER_ID):
     """Query sleep-related metrics from the health_metrics table."""
+    summaries = metric_summaries(SLEEP_STAGE_TYPES.keys(), days=days, user_id=user_id)
+
+    result = {}
+    for metric_type, label in SLEEP_STAGE_TYPES.items():
+        s = summaries.get(metric_type)
+        if s:
+            result[label] = {
+                "daily_avg_minutes": round(s["daily_avg"], 1),
+                "days_tracked": s["days_tracked"],
+            }
+
+    return result if result else None
+
+
+@stats_cached([WORKOUTS])
+def get_workout_stats(days=7, user_id=DEFAULT_USER_ID):
+    """Workout summary for the prompt, aggregated in SQL (see workout_analytics.py)."""
     db = SessionLocal()
     try:
-        since = datetime.now() - timedelta(days=days)
-
-        # Sleep stage metric types exported by Health Auto Export
-        sleep_stage_types = {
-            'sleep_deep': 'deep_sleep_minutes',
-            'sleep_rem': 'rem_sleep_minutes',
-            'sleep_core': 'core_sleep_minutes',
-            'sleep_awake': 'awake_minutes',
-            'sleep_analysis': 'total_sleep_minutes',
-        }
-
-        result = {}
-        for metric_type, label in sleep_stage_types.items():
-            daily_sums = db.query(
-                func.date_trunc('day', HealthMetric.timestamp).label('day'),
-                func.sum(HealthMetric.value).label('daily_val')
-            ).filter(
-                HealthMetric.metric_type == metric_type,
-                HealthMetric.timestamp >= since
-            ).group_by('day').all()
-
-            if daily_sums:
-                vals = [float(d.daily_val) for d in daily_sums]
-                result[label] = {
-                    "daily_avg_minutes": round(sum(vals) / len(vals), 1),
-                    "days_tracked": len(vals),
-                }
-
-        return result if result else None
+        return workout_summary(db, days, user_id=user_id)
     finally:
         db.close()
 
 
-def get_workout_stats(days=7):
-    """Query recent workouts from the workouts table."""
+@stats_cached(metric_generation(m) for m in TREND_METRICS)
+def get_trend_stats(days=7, user_id=DEFAULT_USER_ID):
+    """This week against the user's own 28/90-day baselines and EWMA (see trends.py)."""
     db = SessionLocal()
     try:
-        since = datetime.now() - timedelta(days=days)
-
-        workouts = db.query(Workout).filter(
-            Workout.start_timestamp >= since
-        ).order_by(Workout.start_timestamp.desc()).all()
-
-        if not workouts:
-            return None
-
-        workout_list = []
-        for w in workouts:
-            entry = {
-                "type": w.workout_type,
-                "date": w.start_timestamp.strftime("%Y-%m-%d %H:%M") if w.start_timestamp else None,
-                "duration_minutes": w.duration_minutes,
-                "active_calories": w.active_calories,
-                "avg_heart_rate": w.avg_heart_rate,
-                "max_heart_rate": w.max_heart_rate,
-            }
-            workout_list.append(entry)
-
-        # Aggregate summary
-        total_workouts = len(workouts)
-        type_counts = {}
-        for w in workouts:
-            type_counts[w.workout_type] = type_counts.get(w.workout_type, 0) + 1
-
-        return {
-            "total_workouts": total_workouts,
-            "workout_types": type_counts,
-            "sessions": workout_list,
-        }
+        report = trend_report(db, user_id, week_days=days)
+        db.commit()
+        return report
     finally:
         db.close()
 
 
-def generate_insight():
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        return "Missing GEMINI_API_KEY"
-
-    stats = get_recent_stats()
-    sleep_stats = get_sleep_stats()
-    workout_stats = get_workout_stats()
-
-    if not stats and not sleep_stats and not workout_stats:
-        return "还没攒够数据，再运动两天吧。"
-
-    client = genai.Client(api_key=api_key)
-
+def _data_sections(stats, sleep_stats, workout_stats, trend_stats=None):
     # Build a rich, multi-dimensional context block
     data_sections = []
 
@@ -158,43 +192,140 @@ def generate_insight():
         data_sections.append("【睡眠数据】暂无数据。")
 
     if workout_stats:
-        data_sections.append(f"【训练记录（近7天，共{workout_stats['total_workouts']}次）】\n{workout_stats}")
+        data_sections.append(
+            f"【训练记录（近{workout_stats['days']}天，共{workout_stats['total_workouts']}次）】\n{workout_stats}"
+        )
     else:
         data_sections.append("【训练记录】近7天无记录。")
 
-    combined_data = "\n\n".join(data_sections)
+    if trend_stats:
+        data_sections.append(f"【个人基线对比（已结束的近7天 vs 之前28/90天；z = 偏离几个标准差）】\n{trend_stats}")
 
-    prompt = f"""
-    你是一个毒舌但专业的健康助手 Bobo。以下是用户近 7 天的多维度健康数据：
+    return "\n\n".join(data_sections)
 
-    {combined_data}
 
-    请根据上述数据给出一份综合分析报告（250字以内）。
-    要求：
-    1. 风格要专业、简洁、带点幽默或微毒舌。
-    2. 必须进行跨维度分析——例如：睡眠质量如何影响当天训练表现，心率区间能否反映训练强度，步数和训练是否互补。
-    3. 如果数据显示问题（睡眠不足、训练过少、心率异常），直接指出，别客气。
-    4. 如果有训练记录，请评价训练强度（结合心率区间与消耗卡路里），并与睡眠和恢复情况关联。
-    5. 最后给出下周一条硬核、可执行的建议。
-    """
+def build_prompt(stats, sleep_stats, workout_stats, trend_stats=None):
+    return PROMPT_TEMPLATE.format(combined_data=_data_sections(stats, sleep_stats, workout_stats, trend_stats))
 
-    logger.info(f"Insight prompt:\n{prompt}")
+
+def fallback_insight(stats, sleep_stats, workout_stats, timeout, trend_stats=None):
+    sections = _data_sections(stats, sleep_stats, workout_stats, trend_stats)
+    return f"⏱️ AI 在 {timeout:.0f} 秒内没憋出报告，先看看本周的原始数据：\n\n{sections}"
+
+
+@contextmanager
+def _timed(timings, stage):
+    started = time.perf_counter()
     try:
-        response = client.models.generate_content(
-            model='gemini-3.1-pro-preview',
-            contents=prompt
-        )
-        return response.text
-    except Exception as e:
-        logger.error(f"Gemini error: {e}")
-        return f"AI 离家出走了: {e}"
+        yield
+    finally:
+        if timings is not None:
+            timings[stage] = round(time.perf_counter() - started, 3)
+
 
+def _in_session(fn, *args):
+    db = SessionLocal()
+    try:
+        return fn(db, *args)
+    finally:
+        db.close()
+
+
+def _unchanged_report(db, version, user_id):
+    generation = get_generation(db, user_id=user_id)
+    return generation, insight_cache.lookup_unchanged(db, version, generation, user_id=user_id)
 
-def send_to_discord(content):
-    webhook_url = os.getenv("DISCORD_WEBHOOK_URL")
+
+async def gather_stats(days=7, user_id=DEFAULT_USER_ID):
+    """Run the stats queries concurrently on the bounded stats pool."""
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(
+        loop.run_in_executor(_stats_pool, get_recent_stats, days, user_id),
+        loop.run_in_executor(_stats_pool, get_sleep_stats, days, user_id),
+        loop.run_in_executor(_stats_pool, get_workout_stats, days, user_id),
+        loop.run_in_executor(_stats_pool, get_trend_stats, days, user_id),
+    )
+
+
+def gemini_client(timeout=None):
+    """Gemini client with an HTTP timeout, or None when GEMINI_API_KEY is not set."""
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        return None
+    timeout = timeout or INSIGHT_LLM_TIMEOUT
+    return genai.Client(api_key=api_key, http_options=types.HttpOptions(timeout=int(timeout * 1000)))
+
+
+async def generate_insight_async(client=None, use_cache=True, timings=None, timeout=None, user_id=DEFAULT_USER_ID):
+    """
+    Build a user's 7-day report and ask Gemini for an insight. Responses are cached by
+    the hash of the stats, prompt template, model and user; when nothing has been
+    ingested since the last report, the stats queries are skipped too. The LLM call gets
+    `timeout` seconds before a data-only fallback is returned. Per-stage durations are
+    written into `timings` if given. `client` defaults to a Gemini client.
+    """
+    timeout = timeout or INSIGHT_LLM_TIMEOUT
+    if client is None:
+        client = gemini_client(timeout)
+        if client is None:
+            return "Missing GEMINI_API_KEY"
+
+    version = insight_cache.prompt_version(PROMPT_TEMPLATE, GEMINI_MODEL)
+    with _timed(timings, "watermark"):
+        generation, cached = await asyncio.to_thread(_in_session, _unchanged_report, version, user_id)
+    if use_cache and cached is not None:
+        logger.info("No new data since the last report; reusing cached insight.")
+        return cached
+
+    with _timed(timings, "stats"):
+        stats, sleep_stats, workout_stats, trend_stats = await gather_stats(user_id=user_id)
+
+    if not stats and not sleep_stats and not workout_stats:
+        return "还没攒够数据，再运动两天吧。"
+
+    key = insight_cache.cache_key(PROMPT_TEMPLATE, GEMINI_MODEL, [stats, sleep_stats, workout_stats, trend_stats], user_id)
+    if use_cache:
+        with _timed(timings, "cache_lookup"):
+            cached = await asyncio.to_thread(_in_session, insight_cache.lookup, key)
+        if cached is not None:
+            logger.info("Stats unchanged; reusing cached insight.")
+            return cached
+
+    prompt = build_prompt(stats, sleep_stats, workout_stats, trend_stats)
+    logger.info(f"Insight prompt:\n{prompt}")
+    with _timed(timings, "llm"):
+        started = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(
+                asyncio.to_thread(client.models.generate_content, model=GEMINI_MODEL, contents=prompt),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            LLM_SECONDS.labels("timeout").observe(time.perf_counter() - started)
+            logger.error(f"Gemini did not answer within {timeout}s; sending fallback.")
+            return fallback_insight(stats, sleep_stats, workout_stats, timeout, trend_stats)
+        except Exception as e:
+            LLM_SECONDS.labels("error").observe(time.perf_counter() - started)
+            logger.error(f"Gemini error: {e}")
+            return f"AI 离家出走了: {e}"
+        LLM_SECONDS.labels("ok").observe(time.perf_counter() - started)
+
+    # 只缓存成功的回复
+    await asyncio.to_thread(_in_session, insight_cache.store, key, version, generation, response.text, None, user_id)
+    return response.text
+
+
+def generate_insight(client=None, use_cache=True, timings=None, timeout=None, user_id=DEFAULT_USER_ID):
+    """Blocking wrapper around `generate_insight_async` for scripts and the scheduler."""
+    return asyncio.run(generate_insight_async(client, use_cache=use_cache, timings=timings, timeout=timeout,
+                                              user_id=user_id))
+
+
+def send_to_discord(content, webhook_url=None):
+    webhook_url = webhook_url or os.getenv("DISCORD_WEBHOOK_URL")
     if not webhook_url:
         logger.warning("DISCORD_WEBHOOK_URL not set")
-        return
+        return False
 
     payload = {
         "embeds": [{
@@ -204,7 +335,39 @@ def send_to_discord(content):
             "timestamp": datetime.utcnow().isoformat()
         }]
     }
-    requests.post(webhook_url, json=payload)
+    for attempt in range(DISCORD_MAX_RETRIES + 1):
+        started = time.perf_counter()
+        response = _discord_session.post(webhook_url, json=payload, timeout=DISCORD_TIMEOUT)
+        DISCORD_SECONDS.labels(str(response.status_code)).observe(time.perf_counter() - started)
+        if response.status_code != 429:
+            if not response.ok:
+                logger.error(f"Discord webhook returned {response.status_code}: {response.text[:200]}")
+            return response.ok
+
+        # 被限流时 Discord 会在 body 的 retry_after（秒）或 Retry-After 头里告诉我们要等多久
+        try:
+            retry_after = float(response.json().get("retry_after"))
+        except (ValueError, TypeError, AttributeError):
+            retry_after = float(response.headers.get("Retry-After", 1))
+        if retry_after > _DISCORD_MAX_RETRY_AFTER or attempt == DISCORD_MAX_RETRIES:
+            break
+        logger.warning(f"Discord rate limited; retrying in {retry_after:.2f}s")
+        time.sleep(retry_after)
+
+    logger.error("Discord webhook still rate limited; giving up.")
+    return False
+
+
+async def run_insight_pipeline(client=None, timings=None, user_id=DEFAULT_USER_ID):
+    """Generate a user's insight and deliver it to their Discord webhook, recording per-stage timings."""
+    from users import discord_webhook_for
+
+    with _timed(timings, "total"):
+        content = await generate_insight_async(client, timings=timings, user_id=user_id)
+        with _timed(timings, "discord"):
+            webhook_url = await asyncio.to_thread(_in_session, discord_webhook_for, user_id)
+            delivered = await asyncio.to_thread(send_to_discord, content, webhook_url)
+    return {"content": content, "delivered": delivered}
 
 
 if __name__ == "__main__":
@@ -1,151 +1,252 @@
 import os
+import time
+import asyncio
+import uuid
 import logging
+from collections import OrderedDict
 from datetime import datetime
-from typing import List, Dict, Any
-from fastapi import FastAPI, HTTPException, Security, Depends, BackgroundTasks
-from fastapi.security.api_key import APIKeyQuery, APIKey
+from contextlib import asynccontextmanager
+from typing import Dict, Any, List, Optional, Tuple
+from fastapi import FastAPI, HTTPException, Security, Depends, BackgroundTasks, Query, Request
+from fastapi.responses import Response, StreamingResponse
+from fastapi.security.api_key import APIKeyQuery
 from pydantic import BaseModel
-from database import SessionLocal, HealthMetric, Workout, init_db
-from insight_engine import generate_insight, send_to_discord
-
-# 初始化数据库
-init_db()
-
-app = FastAPI(title="Health Buddy API")
+from dotenv import load_dotenv
+from database import init_db, run_db, AUTO_MIGRATE, DATABASE_ASYNC, DEFAULT_USER_ID
+from ingest import process_health_data, process_health_file, process_health_file_async
+from ingest_queue import IngestQueue, QueueFull
+import series
+import export
+from workout_analytics import workout_summary
+from users import resolve_token
+from telemetry import CONTENT_TYPE_LATEST, INGEST_PAYLOAD_BYTES, QUEUE_DEPTH, generate_latest
+
+# 加载环境变量（insight_engine 改为按需导入，这里不再顺带加载）
+load_dotenv()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 建表放在启动钩子里；AUTO_MIGRATE=false 时由部署流程先跑 `migrate.py schema`
+    if AUTO_MIGRATE:
+        init_db()
+    # 异步引擎下用 asyncio 任务消费队列，不占用线程池
+    if DATABASE_ASYNC:
+        ingest_queue.start_async(process_health_file_async)
+    else:
+        ingest_queue.start(process_health_file)
+    yield
+    ingest_queue.stop()
+    await ingest_queue.stop_async()
+
+app = FastAPI(title="Health Buddy API", lifespan=lifespan)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 API_KEY_NAME = "token"
 webhook_token = os.getenv("WEBHOOK_TOKEN", "super-secret-token")
 api_key_query = APIKeyQuery(name=API_KEY_NAME, auto_error=False)
-
-async def get_api_key(api_key: str = Depends(api_key_query)):
-    logger.info(f"Checking token. Received token length: {len(api_key) if api_key else 0}")
+# 用户 token 解析结果在进程内缓存一小会儿，webhook 高频推送时不必每次查库
+TOKEN_CACHE_SECONDS = float(os.getenv("TOKEN_CACHE_SECONDS", "60"))
+_token_cache: Dict[str, Tuple[int, float]] = {}
+
+# Webhook 载荷先写入持久化队列，再由 worker 池消费
+ingest_queue = IngestQueue()
+# 只在被抓取时才查询队列深度
+QUEUE_DEPTH.set_function(ingest_queue.depth)
+# 请求体攒够这么多字节再交给线程写盘，磁盘 IO 不占用事件循环
+SPOOL_FLUSH_BYTES = 1 << 20
+
+# 分析任务的状态只保存在内存里，保留最近的 ANALYSIS_JOBS_MAX 个
+ANALYSIS_JOBS_MAX = 100
+analysis_jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+async def get_user_id(api_key: str = Depends(api_key_query)) -> int:
+    """Resolve the request token to a user id; WEBHOOK_TOKEN is the default user's token."""
+    logger.debug(f"Checking token. Received token length: {len(api_key) if api_key else 0}")
+    if not api_key:
+        raise HTTPException(status_code=403, detail="Invalid token.")
     if api_key == webhook_token:
-        return api_key
-    raise HTTPException(status_code=403, detail="Invalid token.")
-
-def _parse_timestamp(ts_str: str) -> datetime:
-    try:
-        return datetime.fromisoformat(ts_str.replace("Z", "+00:00"))
-    except ValueError:
-        return datetime.strptime(ts_str, "%Y-%m-%d %H:%M:%S")
-
-
-def process_health_data(payload: Dict[str, Any]):
-    db = SessionLocal()
-    try:
-        data = payload.get("data", {})
-        metrics = data.get("metrics", [])
-        workouts = data.get("workouts", [])
-
-        # Process standard health metrics
-        count = 0
-        for m in metrics:
-            metric_type = m.get("name")
-            unit = m.get("units")
-            samples = m.get("data", [])
-
-            for sample in samples:
-                ts_str = sample.get("date")
-                val = sample.get("qty")
-
-                if ts_str and val is not None:
-                    ts = _parse_timestamp(ts_str)
-                    metric_entry = HealthMetric(
-                        timestamp=ts,
-                        metric_type=metric_type,
-                        value=float(val),
-                        unit=unit,
-                        raw_data=sample
-                    )
-                    db.merge(metric_entry)
-                    count += 1
-
-        # Process workout data
-        workout_count = 0
-        for w in workouts:
-            start_str = w.get("start")
-            end_str = w.get("end")
-            if not start_str:
-                continue
-
-            start_ts = _parse_timestamp(start_str)
-            end_ts = _parse_timestamp(end_str) if end_str else None
-
-            # Duration can be provided in seconds or minutes depending on the export format
-            duration_raw = w.get("duration")
-            duration_minutes = None
-            if duration_raw is not None:
-                # Health Auto Export sends duration in seconds
-                duration_minutes = round(float(duration_raw) / 60, 2)
-
-            active_cal_raw = w.get("activeEnergyBurned") or w.get("totalEnergy")
-            active_calories = active_cal_raw.get("qty") if isinstance(active_cal_raw, dict) else None
-
-            hr = w.get("heartRate") or {}
-            avg_heart_rate = hr.get("avg", {}).get("qty")
-            max_heart_rate = hr.get("max", {}).get("qty")
-
-            workout_type = w.get("name", "Unknown")
-            existing = db.query(Workout).filter(
-                Workout.start_timestamp == start_ts,
-                Workout.workout_type == workout_type
-            ).first()
-
-            if existing:
-                existing.end_timestamp = end_ts
-                existing.duration_minutes = duration_minutes
-                existing.active_calories = active_calories
-                existing.avg_heart_rate = avg_heart_rate
-                existing.max_heart_rate = max_heart_rate
-                existing.raw_data = w
-            else:
-                db.add(Workout(
-                    start_timestamp=start_ts,
-                    end_timestamp=end_ts,
-                    workout_type=workout_type,
-                    duration_minutes=duration_minutes,
-                    active_calories=active_calories,
-                    avg_heart_rate=avg_heart_rate,
-                    max_heart_rate=max_heart_rate,
-                    raw_data=w
-                ))
-            workout_count += 1
-
-        db.commit()
-        logger.info(f"Successfully processed {count} metric samples and {workout_count} workouts.")
-    except Exception as e:
-        logger.error(f"Error processing webhook: {e}")
-        db.rollback()
-    finally:
-        db.close()
+        return DEFAULT_USER_ID
+    cached = _token_cache.get(api_key)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    user_id = await run_db(resolve_token, api_key)
+    if user_id is None:
+        _token_cache.pop(api_key, None)
+        raise HTTPException(status_code=403, detail="Invalid token.")
+    _token_cache[api_key] = (user_id, time.monotonic() + TOKEN_CACHE_SECONDS)
+    return user_id
 
 @app.get("/health")
 def health_check():
     return {"status": "alive", "timestamp": datetime.now()}
 
+@app.get("/metrics")
+def prometheus_metrics(user_id: int = Depends(get_user_id)):
+    # 指标是全局的，只对默认（管理员）用户开放
+    if user_id != DEFAULT_USER_ID:
+        raise HTTPException(status_code=403, detail="Metrics are only available to the default user.")
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+async def spool_request(request: Request, path: str) -> int:
+    """Stream the request body into `path` and return its size; writes run on a worker thread in batches."""
+    size = 0
+    batch: List[bytes] = []
+    batched = 0
+    spool = await asyncio.to_thread(open, path, "wb")
+    try:
+        async for chunk in request.stream():
+            batch.append(chunk)
+            batched += len(chunk)
+            if batched >= SPOOL_FLUSH_BYTES:
+                await asyncio.to_thread(spool.writelines, batch)
+                size += batched
+                batch, batched = [], 0
+        if batch:
+            await asyncio.to_thread(spool.writelines, batch)
+            size += batched
+    finally:
+        await asyncio.to_thread(spool.close)
+    return size
+
 @app.post("/api/health/webhook")
 async def health_webhook(
-    payload: Dict[str, Any], 
-    background_tasks: BackgroundTasks,
-    token: APIKey = Depends(get_api_key)
+    request: Request,
+    backfill: bool = False,
+    user_id: int = Depends(get_user_id)
 ):
-    # 使用 BackgroundTasks 异步处理，防止 Webhook 超时
-    background_tasks.add_task(process_health_data, payload)
-    return {"status": "accepted", "message": "Processing in background"}
+    # 队列满了直接拒绝，让 Health Auto Export 稍后重试，而不是在 API 进程里堆积
+    if ingest_queue.is_full():
+        raise HTTPException(status_code=429, detail="Ingestion queue is full.", headers={"Retry-After": "60"})
+
+    # 请求体边读边落盘，不在内存里构建整个 JSON，几百 MB 的导出也不会撑爆内存
+    path = ingest_queue.new_payload_path()
+    try:
+        size = await spool_request(request, path)
+        # backfill=true 时不跳过重复载荷和水位线之前的样本，用于补传历史数据
+        options = {"user_id": user_id}
+        if backfill:
+            options["backfill"] = True
+        job_id = ingest_queue.enqueue(path, options)
+        INGEST_PAYLOAD_BYTES.observe(size)
+    except QueueFull:
+        os.remove(path)
+        raise HTTPException(status_code=429, detail="Ingestion queue is full.", headers={"Retry-After": "60"})
+    except Exception:
+        os.remove(path)
+        raise
+
+    return {"status": "accepted", "message": "Queued for processing", "job_id": job_id}
+
+@app.get("/api/health/jobs/{job_id}")
+async def ingest_job_status(job_id: str, user_id: int = Depends(get_user_id)):
+    job = ingest_queue.get(job_id)
+    # 别人的任务和不存在的任务一样返回 404
+    if job is None or job["options"].get("user_id", DEFAULT_USER_ID) != user_id:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
+
+async def run_analysis_job(job_id: str, user_id: int = DEFAULT_USER_ID):
+    job = analysis_jobs[job_id]
+    job["status"] = "running"
+    try:
+        # Gemini SDK 导入很慢，webhook 路径用不到，第一次分析时才加载
+        from insight_engine import run_insight_pipeline
+        result = await run_insight_pipeline(timings=job["timings"], user_id=user_id)
+        job["delivered"] = result["delivered"]
+        job["status"] = "done"
+    except Exception as e:
+        logger.error(f"Analysis job {job_id} failed: {e}")
+        job["error"] = str(e)
+        job["status"] = "failed"
+    job["finished_at"] = datetime.now()
 
 @app.post("/api/health/analyze")
-async def trigger_analysis(background_tasks: BackgroundTasks, token: APIKey = Depends(get_api_key)):
+async def trigger_analysis(background_tasks: BackgroundTasks, user_id: int = Depends(get_user_id)):
+    """
+    手动触发 AI 分析并发送到 Discord，返回的 job_id 可用来查询各阶段耗时
+    """
+    job_id = uuid.uuid4().hex
+    analysis_jobs[job_id] = {
+        "id": job_id, "user_id": user_id, "status": "pending", "created_at": datetime.now(), "finished_at": None,
+        "timings": {}, "delivered": None, "error": None,
+    }
+    while len(analysis_jobs) > ANALYSIS_JOBS_MAX:
+        analysis_jobs.popitem(last=False)
+
+    background_tasks.add_task(run_analysis_job, job_id, user_id)
+    return {"status": "analysis_started", "job_id": job_id}
+
+@app.get("/api/health/analyze/{job_id}")
+async def analysis_job_status(job_id: str, user_id: int = Depends(get_user_id)):
+    job = analysis_jobs.get(job_id)
+    if job is None or job["user_id"] != user_id:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
+
+@app.get("/api/metrics/{metric_type}/series")
+async def metric_series(
+    metric_type: str,
+    start: datetime,
+    end: Optional[datetime] = None,
+    bucket: str = "auto",
+    agg: str = "avg",
+    points: int = series.SERIES_DEFAULT_POINTS,
+    format: str = "json",
+    user_id: int = Depends(get_user_id),
+):
+    """
+    按桶聚合的时间序列（sum/avg/min/max/count），用 LTTB 降采样到最多 `points` 个点；
+    format 可选 json / ndjson / arrow
+    """
+    if format not in series.FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {series.FORMATS}")
+    try:
+        result = await run_db(series.load_series, metric_type, start, end or datetime.utcnow(), bucket, agg, points,
+                              user_id=user_id)
+    except series.SeriesError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if format == "ndjson":
+        return StreamingResponse(series.iter_ndjson(result), media_type="application/x-ndjson")
+    if format == "arrow":
+        return StreamingResponse(series.iter_arrow(result), media_type=series.ARROW_MEDIA_TYPE)
+    return result
+
+@app.get("/api/workouts/summary")
+async def workouts_summary(days: int = 7, limit: Optional[int] = None, user_id: int = Depends(get_user_id)):
+    """按训练类型汇总最近 `days` 天的训练（次数、时长、热量、心率区间），最多返回 `limit` 条明细"""
+    if not 1 <= days <= 366:
+        raise HTTPException(status_code=400, detail="days must be between 1 and 366")
+    if limit is not None and not 0 <= limit <= 500:
+        raise HTTPException(status_code=400, detail="limit must be between 0 and 500")
+    result = await run_db(workout_summary, days, limit, user_id=user_id)
+    return result or {"days": days, "total_workouts": 0}
+
+@app.get("/api/export/{dataset}")
+async def export_data(
+    dataset: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    metric_type: Optional[List[str]] = Query(None),
+    format: str = "parquet",
+    raw_data: bool = False,
+    user_id: int = Depends(get_user_id),
+):
     """
-    手动触发 AI 分析并发送到 Discord
+    导出 metrics / workouts / aggregates 为 Parquet 或 Arrow IPC 文件，服务端游标分批读取，
+    每批写一个 row group 就发出去，内存占用和历史长短无关
     """
-    def run_and_send():
-        content = generate_insight()
-        send_to_discord(content)
-        
-    background_tasks.add_task(run_and_send)
-    return {"status": "analysis_started"}
+    if dataset not in export.DATASETS:
+        raise HTTPException(status_code=404, detail=f"dataset must be one of {tuple(export.DATASETS)}")
+    if format not in export.FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {export.FORMATS}")
+    media_type = export.PARQUET_MEDIA_TYPE if format == "parquet" else export.ARROW_MEDIA_TYPE
+    return StreamingResponse(
+        export.iter_export(dataset, format, start, end, metric_type, include_raw=raw_data, user_id=user_id),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{dataset}.{format}"'},
+    )
 
 if __name__ == "__main__":
     import uvicorn
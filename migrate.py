@@ -0,0 +1,232 @@
+"""
+One-off data migrations.
+
+    uv run migrate.py schema
+    uv run migrate.py strip-raw-data [--policy compact|none] [--batch-size 50000] [--vacuum]
+
+`schema` creates missing tables and indexes (what the API does on startup unless
+AUTO_MIGRATE=false). Tables created before multi-user support get a `user_id` column
+(existing rows belong to the default user) and user-scoped unique constraints; the
+derived state tables (generations, insight cache, watermarks, fingerprints) are
+recreated empty instead.
+
+`strip-raw-data` rewrites existing `health_metrics.raw_data` to match RAW_DATA_POLICY:
+`compact` drops the keys already stored in `timestamp`/`value` (and NULLs rows left empty),
+`none` clears the column. On PostgreSQL a legacy `json` column is converted to `jsonb` in
+the same pass.
+"""
+import argparse
+import logging
+
+from sqlalchemy import UniqueConstraint, inspect, text
+
+from database import Base, DEFAULT_USER_ID, engine, init_db
+from ingest import DERIVED_SAMPLE_KEYS
+from partitions import is_partitioned
+
+logger = logging.getLogger(__name__)
+
+TABLE = "health_metrics"
+DEFAULT_BATCH_SIZE = 50_000
+
+_PG_COMPACT = "NULLIF(jsonb_strip_nulls(raw_data::jsonb {strip}), '{{}}'::jsonb)".format(
+    strip=" ".join(f"- '{k}'" for k in DERIVED_SAMPLE_KEYS)
+)
+_SQLITE_COMPACT = "NULLIF(json_remove(raw_data, {paths}), '{{}}')".format(
+    paths=", ".join(f"'$.{k}'" for k in DERIVED_SAMPLE_KEYS)
+)
+
+
+def _mb(n: int) -> str:
+    return f"{n / 1024 / 1024:.1f} MB"
+
+
+def _raw_data_bytes(conn) -> int:
+    if conn.dialect.name == "postgresql":
+        sql = f"SELECT coalesce(sum(pg_column_size(raw_data)), 0) FROM {TABLE}"
+    else:
+        sql = f"SELECT coalesce(sum(length(raw_data)), 0) FROM {TABLE}"
+    return int(conn.execute(text(sql)).scalar())
+
+
+def _storage_bytes(conn) -> int:
+    if conn.dialect.name == "postgresql":
+        if is_partitioned(conn, TABLE):
+            # 分区表的父表本身没有存储，要把所有分区加起来
+            return int(conn.execute(text(
+                f"SELECT coalesce(sum(pg_total_relation_size(relid)), 0) FROM pg_partition_tree('{TABLE}')"
+            )).scalar())
+        return int(conn.execute(text(f"SELECT pg_total_relation_size('{TABLE}')")).scalar())
+    # SQLite 只能看整个数据库文件
+    return int(conn.execute(text(
+        "SELECT page_count * page_size FROM pragma_page_count(), pragma_page_size()"
+    )).scalar())
+
+
+def _pg_column_type(conn) -> str:
+    return conn.execute(text(
+        "SELECT data_type FROM information_schema.columns "
+        "WHERE table_name = :t AND column_name = 'raw_data' AND table_schema = current_schema()"
+    ), {"t": TABLE}).scalar()
+
+
+def _update_in_batches(expr: str, batch_size: int) -> int:
+    with engine.connect() as conn:
+        lo, hi = conn.execute(text(f"SELECT min(id), max(id) FROM {TABLE}")).one()
+    if lo is None:
+        return 0
+
+    updated = 0
+    # 按 id 区间分批提交，避免一个超大事务长时间持锁
+    for start in range(lo, hi + 1, batch_size):
+        with engine.begin() as conn:
+            updated += conn.execute(text(
+                f"UPDATE {TABLE} SET raw_data = {expr} "
+                f"WHERE id >= :lo AND id < :hi AND raw_data IS NOT NULL"
+            ), {"lo": start, "hi": start + batch_size}).rowcount
+        logger.info(f"Rewrote raw_data up to id {min(start + batch_size - 1, hi)} / {hi}")
+    return updated
+
+
+def strip_raw_data(policy: str = "compact", batch_size: int = DEFAULT_BATCH_SIZE, vacuum: bool = False):
+    """Rewrite existing raw_data to `policy` and report how many bytes it freed."""
+    if policy not in ("compact", "none"):
+        raise ValueError("policy must be 'compact' or 'none'")
+    is_pg = engine.dialect.name == "postgresql"
+
+    with engine.connect() as conn:
+        column_before = _raw_data_bytes(conn)
+        storage_before = _storage_bytes(conn)
+
+    if is_pg:
+        expr = _PG_COMPACT if policy == "compact" else "NULL"
+        with engine.begin() as conn:
+            column_type = _pg_column_type(conn)
+            if column_type == "json":
+                # ALTER TYPE 会整表重写，顺便完成精简，旧的行版本直接释放
+                conn.execute(text(f"ALTER TABLE {TABLE} ALTER COLUMN raw_data TYPE JSONB USING {expr}"))
+        if column_type != "json":
+            _update_in_batches(expr, batch_size)
+    else:
+        _update_in_batches(_SQLITE_COMPACT if policy == "compact" else "NULL", batch_size)
+
+    if vacuum:
+        # UPDATE 留下的死元组要 VACUUM FULL（SQLite 上是 VACUUM）才会把空间还给操作系统
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text(f"VACUUM (FULL, ANALYZE) {TABLE}" if is_pg else "VACUUM"))
+
+    with engine.connect() as conn:
+        column_after = _raw_data_bytes(conn)
+        storage_after = _storage_bytes(conn)
+
+    report = {
+        "raw_data_bytes_before": column_before,
+        "raw_data_bytes_after": column_after,
+        "storage_bytes_before": storage_before,
+        "storage_bytes_after": storage_after,
+        "reclaimed_bytes": storage_before - storage_after,
+    }
+    print(f"🧹 raw_data: {_mb(column_before)} → {_mb(column_after)} "
+          f"({_mb(column_before - column_after)} less payload)")
+    print(f"💾 on-disk: {_mb(storage_before)} → {_mb(storage_after)} "
+          f"({_mb(report['reclaimed_bytes'])} reclaimed)")
+    if not vacuum and storage_after >= storage_before and column_after < column_before:
+        print("ℹ️  Run again with --vacuum (or wait for autovacuum) to return the freed space to the OS.")
+    return report
+
+
+# 单用户版本里要替换掉的唯一约束和索引
+_TENANT_TABLES = {
+    # 单独的 metric_type 索引已被复合索引覆盖，留着只会拖慢每次写入
+    "health_metrics": (
+        ["_timestamp_metric_uc"], ["ix_health_metrics_type_timestamp", "ix_health_metrics_metric_type"],
+    ),
+    "workouts": (["_workout_start_type_uc"], ["ix_workouts_start_timestamp", "ix_workouts_workout_type"]),
+    "daily_metric_rollups": (
+        ["_rollup_day_metric_uc"], ["ix_daily_metric_rollups_day", "ix_daily_metric_rollups_metric_type"],
+    ),
+}
+# 可以从原始数据重新算出来的表，直接重建
+_DERIVED_TABLES = ("data_generations", "insight_cache", "ingest_watermarks", "payload_fingerprints")
+
+
+def _unique_constraints(table_name: str):
+    table = Base.metadata.tables[table_name]
+    return [c for c in table.constraints if isinstance(c, UniqueConstraint)]
+
+
+def _upgrade_pg(conn, table: str, constraints, indexes):
+    # ADD COLUMN 带常量默认值在 PostgreSQL 11+ 不重写表；对分区表的父表操作会传递到所有分区
+    conn.execute(text(
+        f"ALTER TABLE {table} ADD COLUMN user_id INTEGER NOT NULL DEFAULT {DEFAULT_USER_ID}"
+    ))
+    for name in constraints:
+        conn.execute(text(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {name}"))
+    for name in indexes:
+        conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    for uc in _unique_constraints(table):
+        columns = ", ".join(c.name for c in uc.columns)
+        conn.execute(text(f"ALTER TABLE {table} ADD CONSTRAINT {uc.name} UNIQUE ({columns})"))
+
+
+def _upgrade_sqlite(conn, table: str, columns):
+    # SQLite 改不了约束，只能建新表把数据搬过去
+    legacy = f"{table}_pre_users"
+    conn.execute(text(f"ALTER TABLE {table} RENAME TO {legacy}"))
+    for index in inspect(conn).get_indexes(legacy):
+        conn.execute(text(f'DROP INDEX "{index["name"]}"'))
+    Base.metadata.tables[table].create(bind=conn)
+    names = ", ".join(columns)
+    conn.execute(text(
+        f"INSERT INTO {table} ({names}, user_id) SELECT {names}, {DEFAULT_USER_ID} FROM {legacy}"
+    ))
+    conn.execute(text(f"DROP TABLE {legacy}"))
+
+
+def add_user_columns(bind=engine) -> list:
+    """Upgrade single-user tables in place; returns the names of the tables changed and legacy indexes dropped."""
+    changed = []
+    with bind.begin() as conn:
+        inspector = inspect(conn)
+        existing = set(inspector.get_table_names())
+        for table in _DERIVED_TABLES:
+            if table in existing and "user_id" not in {c["name"] for c in inspector.get_columns(table)}:
+                conn.execute(text(f"DROP TABLE {table}"))
+                changed.append(table)
+        for table, (constraints, indexes) in _TENANT_TABLES.items():
+            if table not in existing:
+                continue
+            columns = [c["name"] for c in inspector.get_columns(table)]
+            if "user_id" in columns:
+                # 已经升级过的库也清掉还残留的旧索引
+                leftover = {i["name"] for i in inspector.get_indexes(table)} & set(indexes)
+                for name in sorted(leftover):
+                    conn.execute(text(f'DROP INDEX "{name}"'))
+                    changed.append(name)
+                continue
+            if conn.dialect.name == "postgresql":
+                _upgrade_pg(conn, table, constraints, indexes)
+            else:
+                _upgrade_sqlite(conn, table, columns)
+            changed.append(table)
+    if changed:
+        logger.info(f"Added user_id to {', '.join(changed)}.")
+    return changed
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="One-off data migrations.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("schema", help="create missing tables and indexes")
+    p = sub.add_parser("strip-raw-data", help="drop derived keys from health_metrics.raw_data")
+    p.add_argument("--policy", choices=("compact", "none"), default="compact")
+    p.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    p.add_argument("--vacuum", action="store_true", help="VACUUM afterwards to return space to the OS")
+    args = parser.parse_args()
+
+    if args.command == "schema":
+        init_db()
+        print(f"✅ Schema is up to date ({engine.url.render_as_string(hide_password=True)})")
+    elif args.command == "strip-raw-data":
+        strip_raw_data(args.policy, batch_size=args.batch_size, vacuum=args.vacuum)
@@ -0,0 +1,246 @@
+"""
+Opt-in monthly range partitioning of `health_metrics` on PostgreSQL.
+
+    uv run partitions.py create              # fresh database, same as HEALTH_METRICS_PARTITIONED=true
+    uv run partitions.py convert             # migrate an existing plain table in place
+    uv run partitions.py ensure --months-ahead 3
+    uv run partitions.py detach --older-than-months 24 [--drop]
+
+Partitions are named `health_metrics_yYYYYmMM`; rows outside every partition land in
+`health_metrics_default` and are moved out when their month's partition is created.
+Detached partitions are moved to the `archive` schema (or dropped); the daily rollups
+for those months are kept.
+"""
+import re
+import argparse
+import logging
+from datetime import date
+
+from sqlalchemy import text
+
+from database import engine, HealthMetric
+
+logger = logging.getLogger(__name__)
+
+PARENT = "health_metrics"
+DEFAULT_PARTITION = "health_metrics_default"
+ARCHIVE_SCHEMA = "archive"
+DEFAULT_MONTHS_AHEAD = 3
+
+_PARTITION_RE = re.compile(r"^health_metrics_y(\d{4})m(\d{2})$")
+_COLUMNS = "id, user_id, timestamp, metric_type, value, unit, source, raw_data"
+
+# 分区表的唯一约束和主键都必须包含分区键 timestamp
+_PARENT_DDL = f"""
+CREATE TABLE {PARENT} (
+    id INTEGER NOT NULL DEFAULT nextval('{{seq}}'),
+    user_id INTEGER NOT NULL DEFAULT 1,
+    timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    metric_type VARCHAR,
+    value DOUBLE PRECISION,
+    unit VARCHAR,
+    source VARCHAR,
+    raw_data JSONB,
+    PRIMARY KEY (id, timestamp),
+    CONSTRAINT _user_timestamp_metric_uc UNIQUE (user_id, timestamp, metric_type)
+) PARTITION BY RANGE (timestamp)
+"""
+
+
+def _month_start(d: date) -> date:
+    return d.replace(day=1)
+
+
+def _add_months(d: date, n: int) -> date:
+    years, month = divmod(d.month - 1 + n, 12)
+    return date(d.year + years, month + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"health_metrics_y{month.year}m{month.month:02d}"
+
+
+def _table_exists(conn, name: str) -> bool:
+    return conn.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name}).scalar()
+
+
+def is_partitioned(conn, table: str = PARENT) -> bool:
+    return conn.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+        "WHERE c.relname = :name AND pg_table_is_visible(c.oid))"
+    ), {"name": table}).scalar()
+
+
+def _create_parent(conn, seq: str):
+    conn.execute(text(_PARENT_DDL.format(seq=seq)))
+    conn.execute(text(f"ALTER SEQUENCE {seq} OWNED BY {PARENT}.id"))
+    conn.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {PARENT} DEFAULT"))
+
+
+def _create_indexes(conn):
+    for index in HealthMetric.__table__.indexes:
+        index.create(bind=conn, checkfirst=True)
+
+
+def _create_month(conn, month: date) -> bool:
+    name = partition_name(month)
+    if _table_exists(conn, name):
+        return False
+    lower, upper = month.isoformat(), _add_months(month, 1).isoformat()
+
+    # 默认分区里如果已经有这个月的数据，PostgreSQL 不允许直接建新分区，需要先摘下来搬数据
+    stray = conn.execute(text(
+        f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE timestamp >= :lo AND timestamp < :hi)"
+    ), {"lo": lower, "hi": upper}).scalar()
+    if stray:
+        conn.execute(text(f"ALTER TABLE {PARENT} DETACH PARTITION {DEFAULT_PARTITION}"))
+
+    conn.execute(text(
+        f"CREATE TABLE {name} PARTITION OF {PARENT} FOR VALUES FROM ('{lower}') TO ('{upper}')"
+    ))
+
+    if stray:
+        conn.execute(text(
+            f"INSERT INTO {PARENT} ({_COLUMNS}) SELECT {_COLUMNS} FROM {DEFAULT_PARTITION} "
+            f"WHERE timestamp >= :lo AND timestamp < :hi"
+        ), {"lo": lower, "hi": upper})
+        conn.execute(text(
+            f"DELETE FROM {DEFAULT_PARTITION} WHERE timestamp >= :lo AND timestamp < :hi"
+        ), {"lo": lower, "hi": upper})
+        conn.execute(text(f"ALTER TABLE {PARENT} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"))
+    return True
+
+
+def _ensure(conn, first: date, last: date):
+    created = []
+    month = _month_start(first)
+    while month <= last:
+        if _create_month(conn, month):
+            created.append(partition_name(month))
+        month = _add_months(month, 1)
+    return created
+
+
+def create_partitioned_table(months_ahead: int = DEFAULT_MONTHS_AHEAD) -> bool:
+    """Create an empty partitioned health_metrics table. No-op if the table already exists."""
+    with engine.begin() as conn:
+        if _table_exists(conn, PARENT):
+            return False
+        seq = f"{PARENT}_id_seq"
+        conn.execute(text(f"CREATE SEQUENCE IF NOT EXISTS {seq}"))
+        _create_parent(conn, seq)
+        today = date.today()
+        _ensure(conn, today, _add_months(today, months_ahead))
+        _create_indexes(conn)
+    logger.info("Created partitioned health_metrics table.")
+    return True
+
+
+def convert_existing_table(months_ahead: int = DEFAULT_MONTHS_AHEAD) -> int:
+    """
+    Rebuild an existing plain health_metrics table as a partitioned one in a single
+    transaction. Holds an exclusive lock for the duration of the copy.
+    """
+    with engine.begin() as conn:
+        if is_partitioned(conn):
+            logger.info("health_metrics is already partitioned.")
+            return 0
+
+        conn.execute(text(f"LOCK TABLE {PARENT} IN ACCESS EXCLUSIVE MODE"))
+        seq = conn.execute(text(f"SELECT pg_get_serial_sequence('{PARENT}', 'id')")).scalar()
+        legacy = f"{PARENT}_legacy"
+
+        # 旧表和它的索引/约束改名，给新表腾出名字
+        conn.execute(text(f"ALTER TABLE {PARENT} RENAME TO {legacy}"))
+        indexes = conn.execute(text(
+            "SELECT indexname FROM pg_indexes WHERE tablename = :t AND schemaname = current_schema()"
+        ), {"t": legacy}).scalars().all()
+        for index in indexes:
+            conn.execute(text(f'ALTER INDEX "{index}" RENAME TO "{index}_legacy"'))
+        conn.execute(text(f"ALTER SEQUENCE {seq} OWNED BY NONE"))
+
+        _create_parent(conn, seq)
+        lo, hi = conn.execute(text(f"SELECT min(timestamp), max(timestamp) FROM {legacy}")).one()
+        today = date.today()
+        _ensure(conn, min(lo.date(), today) if lo else today, _add_months(max(hi.date(), today) if hi else today, months_ahead))
+
+        moved = conn.execute(text(
+            f"INSERT INTO {PARENT} ({_COLUMNS}) SELECT {_COLUMNS} FROM {legacy} WHERE timestamp IS NOT NULL"
+        )).rowcount
+        conn.execute(text(f"DROP TABLE {legacy}"))
+        # 数据导入后再建索引更快
+        _create_indexes(conn)
+    logger.info(f"Converted health_metrics to monthly partitions ({moved} rows).")
+    return moved
+
+
+def ensure_partitions(months_ahead: int = DEFAULT_MONTHS_AHEAD):
+    """Create partitions for the current month and the next `months_ahead` months."""
+    with engine.begin() as conn:
+        if not is_partitioned(conn):
+            logger.info("health_metrics is not partitioned; nothing to do.")
+            return []
+        today = date.today()
+        created = _ensure(conn, today, _add_months(today, months_ahead))
+    if created:
+        logger.info(f"Created partitions: {', '.join(created)}")
+    return created
+
+
+def list_partitions(conn):
+    names = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = :parent ORDER BY c.relname"
+    ), {"parent": PARENT}).scalars().all()
+    result = []
+    for name in names:
+        match = _PARTITION_RE.match(name)
+        if match:
+            result.append((name, date(int(match.group(1)), int(match.group(2)), 1)))
+    return result
+
+
+def detach_partitions(older_than_months: int, drop: bool = False):
+    """Detach monthly partitions entirely older than the cutoff; archive or drop them."""
+    cutoff = _add_months(_month_start(date.today()), -older_than_months)
+    detached = []
+    with engine.begin() as conn:
+        if not is_partitioned(conn):
+            logger.info("health_metrics is not partitioned; nothing to do.")
+            return []
+        for name, month in list_partitions(conn):
+            if _add_months(month, 1) > cutoff:
+                continue
+            conn.execute(text(f"ALTER TABLE {PARENT} DETACH PARTITION {name}"))
+            if drop:
+                conn.execute(text(f"DROP TABLE {name}"))
+            else:
+                conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}"))
+                conn.execute(text(f"ALTER TABLE {name} SET SCHEMA {ARCHIVE_SCHEMA}"))
+            detached.append(name)
+    if detached:
+        logger.info(f"{'Dropped' if drop else 'Archived'} partitions: {', '.join(detached)}")
+    return detached
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Manage monthly partitions of health_metrics (PostgreSQL only).")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("create", "convert", "ensure"):
+        p = sub.add_parser(name)
+        p.add_argument("--months-ahead", type=int, default=DEFAULT_MONTHS_AHEAD)
+    p = sub.add_parser("detach")
+    p.add_argument("--older-than-months", type=int, required=True)
+    p.add_argument("--drop", action="store_true", help="drop instead of moving to the archive schema")
+    args = parser.parse_args()
+
+    if args.command == "create":
+        create_partitioned_table(args.months_ahead)
+    elif args.command == "convert":
+        convert_existing_table(args.months_ahead)
+    elif args.command == "ensure":
+        ensure_partitions(args.months_ahead)
+    else:
+        detach_partitions(args.older_than_months, drop=args.drop)
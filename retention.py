@@ -0,0 +1,211 @@
+"""
+Tiered retention for high-frequency samples.
+
+    uv run retention.py [--older-than-days 30] [--bucket 5m|1h] [--metric heart_rate ...] [--dry-run]
+
+Raw `health_metrics` samples of RETENTION_METRICS older than RETENTION_RAW_DAYS days are
+folded into `metric_aggregates` buckets (sum/count/min/max/avg) and deleted. Every
+(user, metric, day) is moved in its own short transaction: the raw rows are deleted with
+RETURNING and the buckets are built from exactly what was removed, so a concurrent ingest
+is never lost. Daily rollups, and through them the insight engine, as well as the series
+API read both tiers, so totals and averages do not change.
+
+Buckets are never overwritten. History re-imported later (e.g. `import_apple_health.py`)
+is compacted again on the next run: raw samples that fall inside an already-compacted
+bucket were summarized before and are dropped instead of being counted twice, and the
+rest are added. A day keeps a single bucket width; when it already has buckets of another
+width, they are merged into the coarser of the two.
+"""
+import os
+import time
+import argparse
+import logging
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import delete, func
+
+from database import SessionLocal, HealthMetric, MetricAggregate, User, dialect_insert
+from generations import HEALTH_DATA, bump_generations, metric_generation
+from rollups import refresh_rollups
+
+logger = logging.getLogger(__name__)
+
+RETENTION_RAW_DAYS = int(os.getenv("RETENTION_RAW_DAYS", "30"))
+RETENTION_BUCKET = os.getenv("RETENTION_BUCKET", "5m")
+# 分钟级甚至秒级上报的指标；睡眠、体重这类低频指标保持原样
+RETENTION_METRICS = [m.strip() for m in os.getenv(
+    "RETENTION_METRICS", "heart_rate,active_energy,basal_energy_burned,step_count,walking_running_distance",
+).split(",") if m.strip()]
+
+BUCKETS = {"5m": 300, "1h": 3600}
+
+_EPOCH = datetime(1970, 1, 1)
+# 每条 INSERT 的行数，10 列 × 2000 行在 SQLite 和 PostgreSQL 的绑定参数上限之内
+_UPSERT_ROWS = 2000
+_AGGREGATE_COLUMNS = ("bucket_seconds", "unit", "value_sum", "sample_count", "value_min", "value_max", "value_avg")
+
+
+def retention_cutoff(older_than_days: int = None, now: datetime = None) -> datetime:
+    """Start of the oldest UTC day still kept at full resolution."""
+    days = RETENTION_RAW_DAYS if older_than_days is None else older_than_days
+    now = now or datetime.utcnow()
+    return datetime.combine(now.date() - timedelta(days=days), datetime.min.time())
+
+
+def bucket_start(ts: datetime, seconds: int) -> datetime:
+    epoch = int((ts - _EPOCH).total_seconds())
+    return _EPOCH + timedelta(seconds=epoch - epoch % seconds)
+
+
+def _bucket_rows(user_id: int, metric_type: str, parts: Iterable, seconds: int) -> List[Dict]:
+    """Merge (timestamp, sum, count, min, max, unit) parts, raw samples or finer buckets, into `seconds` buckets."""
+    buckets = {}
+    for ts, value_sum, count, value_min, value_max, unit in parts:
+        if value_sum is None or not count:
+            continue
+        start = bucket_start(ts, seconds)
+        b = buckets.get(start)
+        if b is None:
+            buckets[start] = {
+                "user_id": user_id, "metric_type": metric_type, "bucket_start": start, "bucket_seconds": seconds,
+                "unit": unit, "value_sum": value_sum, "sample_count": count, "value_min": value_min,
+                "value_max": value_max,
+            }
+        else:
+            b["value_sum"] += value_sum
+            b["sample_count"] += count
+            b["value_min"] = min(b["value_min"], value_min)
+            b["value_max"] = max(b["value_max"], value_max)
+    for b in buckets.values():
+        b["value_avg"] = b["value_sum"] / b["sample_count"]
+    return list(buckets.values())
+
+
+def _next_raw_day(db, user_id: int, metric_type: str, since: datetime, cutoff: datetime) -> Optional[date]:
+    # 走 (user_id, metric_type, timestamp) 索引，只取一个值
+    ts = db.query(func.min(HealthMetric.timestamp)).filter(
+        HealthMetric.user_id == user_id,
+        HealthMetric.metric_type == metric_type,
+        HealthMetric.timestamp >= since,
+        HealthMetric.timestamp < cutoff,
+    ).scalar()
+    return ts.date() if ts else None
+
+
+def compact_day(db, user_id: int, metric_type: str, day: date, seconds: int) -> Dict[str, int]:
+    """Move one user's raw `metric_type` samples of `day` into buckets; the caller commits."""
+    start = datetime.combine(day, datetime.min.time())
+    end = start + timedelta(days=1)
+    window = (
+        MetricAggregate.user_id == user_id,
+        MetricAggregate.metric_type == metric_type,
+        MetricAggregate.bucket_start >= start,
+        MetricAggregate.bucket_start < end,
+    )
+    existing = db.query(MetricAggregate).filter(*window).all()
+    # 已压缩过的时间段：(桶宽, 起点) 集合
+    covered = {(a.bucket_seconds, a.bucket_start) for a in existing}
+    widths = {a.bucket_seconds for a in existing}
+    # 一天只保留一种桶宽，已有更粗的桶时跟着它走
+    seconds = max(widths | {seconds})
+
+    samples = db.execute(
+        delete(HealthMetric).where(
+            HealthMetric.user_id == user_id,
+            HealthMetric.metric_type == metric_type,
+            HealthMetric.timestamp >= start,
+            HealthMetric.timestamp < end,
+        ).returning(HealthMetric.timestamp, HealthMetric.value, HealthMetric.unit),
+        execution_options={"synchronize_session": False},
+    ).all()
+    # 落在已压缩桶里的原始样本是重新导入的历史，桶里已经算过，不能再加一遍
+    fresh = [s for s in samples if not any((w, bucket_start(s.timestamp, w)) in covered for w in widths)]
+    rows = []
+    if fresh or widths - {seconds}:
+        parts = [(ts, value, 1, value, value, unit) for ts, value, unit in fresh]
+        parts += [(a.bucket_start, a.value_sum, a.sample_count, a.value_min, a.value_max, a.unit) for a in existing]
+        rows = _bucket_rows(user_id, metric_type, parts, seconds)
+        if existing:
+            # 其它桶宽的桶已合并进 rows，整天重写
+            db.execute(delete(MetricAggregate).where(*window), execution_options={"synchronize_session": False})
+
+        insert = dialect_insert(db)
+        for i in range(0, len(rows), _UPSERT_ROWS):
+            stmt = insert(MetricAggregate).values(rows[i:i + _UPSERT_ROWS])
+            db.execute(stmt.on_conflict_do_update(
+                index_elements=["user_id", "metric_type", "bucket_start"],
+                set_={c: stmt.excluded[c] for c in _AGGREGATE_COLUMNS},
+            ))
+
+    if existing:
+        # 这一天之前压缩过，又被重新导入了原始样本：日汇总里这段时间曾被算了两次
+        refresh_rollups(db, [(metric_type, day)], user_id)
+        bump_generations(db, [HEALTH_DATA, metric_generation(metric_type)], user_id)
+    return {"samples": len(samples), "buckets": len(rows), "skipped": len(samples) - len(fresh)}
+
+
+def compact(metric_types: Iterable[str] = None, older_than_days: int = None, bucket: str = None,
+            dry_run: bool = False) -> Dict:
+    """Compact every user's raw samples older than the cutoff, one (user, metric, day) per transaction."""
+    metric_types = list(metric_types or RETENTION_METRICS)
+    bucket = bucket or RETENTION_BUCKET
+    if bucket not in BUCKETS:
+        raise ValueError(f"bucket must be one of {tuple(BUCKETS)}")
+    seconds = BUCKETS[bucket]
+    cutoff = retention_cutoff(older_than_days)
+    started = time.perf_counter()
+    report = {"cutoff": cutoff.isoformat(), "bucket": bucket, "dry_run": dry_run, "metrics": {}}
+
+    db = SessionLocal()
+    try:
+        user_ids = [user_id for (user_id,) in db.query(User.id).order_by(User.id)]
+        for metric_type in metric_types:
+            totals = report["metrics"][metric_type] = {"days": 0, "samples": 0, "buckets": 0, "skipped": 0}
+            for user_id in user_ids:
+                if dry_run:
+                    totals["samples"] += db.query(func.count(HealthMetric.id)).filter(
+                        HealthMetric.user_id == user_id,
+                        HealthMetric.metric_type == metric_type,
+                        HealthMetric.timestamp < cutoff,
+                    ).scalar()
+                    continue
+                day = _next_raw_day(db, user_id, metric_type, _EPOCH, cutoff)
+                while day is not None:
+                    try:
+                        moved = compact_day(db, user_id, metric_type, day, seconds)
+                        db.commit()
+                    except Exception:
+                        db.rollback()
+                        raise
+                    totals["days"] += 1
+                    totals["samples"] += moved["samples"]
+                    totals["buckets"] += moved["buckets"]
+                    totals["skipped"] += moved["skipped"]
+                    next_day = datetime.combine(day + timedelta(days=1), datetime.min.time())
+                    day = _next_raw_day(db, user_id, metric_type, next_day, cutoff)
+            outcome = "would be compacted" if dry_run else (
+                f"compacted into {totals['buckets']} buckets over {totals['days']} days"
+                f" ({totals['skipped']} already compacted before)"
+            )
+            logger.info(f"{metric_type}: {totals['samples']} raw samples older than {cutoff:%Y-%m-%d} {outcome}.")
+    finally:
+        db.close()
+
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    return report
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Downsample old high-frequency samples into metric_aggregates.")
+    parser.add_argument("--older-than-days", type=int, default=RETENTION_RAW_DAYS,
+                        help="keep this many days of raw samples")
+    parser.add_argument("--bucket", choices=tuple(BUCKETS), default=RETENTION_BUCKET)
+    parser.add_argument("--metric", action="append", dest="metrics",
+                        help="metric type to compact (repeatable; default: RETENTION_METRICS)")
+    parser.add_argument("--dry-run", action="store_true", help="only count what would be compacted")
+    args = parser.parse_args()
+
+    result = compact(args.metrics, older_than_days=args.older_than_days, bucket=args.bucket, dry_run=args.dry_run)
+    logger.info(f"Retention finished in {result['seconds']}s.")
@@ -0,0 +1,153 @@
+import sys
+import logging
+from collections import defaultdict
+from datetime import date, timedelta
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import BigInteger, Date, and_, cast, exists, func, select, union_all
+
+from database import (
+    DEFAULT_USER_ID, SessionLocal, HealthMetric, MetricAggregate, DailyMetricRollup, MetricBaseline, dialect_insert,
+)
+from trends import rewind_baselines
+
+logger = logging.getLogger(__name__)
+
+_ROLLUP_COLUMNS = ("value_sum", "sample_count", "value_min", "value_max", "value_avg")
+
+
+def _day_of(ts_column):
+    # 标成 Date 类型：SQLite 上按 'YYYY-MM-DD' 文本比较，asyncpg 也能正确绑定 date 参数
+    return func.date(ts_column, type_=Date)
+
+
+def _tier_select(model, ts_column, value_sum, sample_count, value_min, value_max,
+                 user_id: Optional[int], metric_type: Optional[str], days: Optional[List[date]]):
+    day = _day_of(ts_column)
+    filters = [ts_column.isnot(None)]
+    if user_id is not None:
+        filters.append(model.user_id == user_id)
+    if metric_type is not None:
+        filters.append(model.metric_type == metric_type)
+    if days:
+        # 时间范围条件让查询能走 (user_id, metric_type, 时间) 索引
+        filters += [ts_column >= days[0], ts_column < days[-1] + timedelta(days=1), day.in_(days)]
+    return select(
+        model.user_id.label("user_id"),
+        day.label("day"),
+        model.metric_type.label("metric_type"),
+        value_sum.label("value_sum"),
+        sample_count.label("sample_count"),
+        value_min.label("value_min"),
+        value_max.label("value_max"),
+    ).where(*filters).group_by(model.user_id, day, model.metric_type)
+
+
+def _aggregate_select(user_id: int = None, metric_type: str = None, days: List[date] = None):
+    """Per-day figures over both tiers: raw `health_metrics` and downsampled `metric_aggregates`."""
+    raw = _tier_select(
+        HealthMetric, HealthMetric.timestamp,
+        func.sum(HealthMetric.value), func.count(HealthMetric.value),
+        func.min(HealthMetric.value), func.max(HealthMetric.value),
+        user_id, metric_type, days,
+    )
+    compacted = _tier_select(
+        MetricAggregate, MetricAggregate.bucket_start,
+        func.sum(MetricAggregate.value_sum), func.sum(MetricAggregate.sample_count),
+        func.min(MetricAggregate.value_min), func.max(MetricAggregate.value_max),
+        user_id, metric_type, days,
+    )
+    tiers = union_all(raw, compacted).subquery()
+    total = func.sum(tiers.c.value_sum)
+    # PostgreSQL 上 sum(bigint) 是 numeric，转回整数
+    count = cast(func.sum(tiers.c.sample_count), BigInteger)
+    return select(
+        tiers.c.user_id,
+        tiers.c.day,
+        tiers.c.metric_type,
+        total,
+        count,
+        func.min(tiers.c.value_min),
+        func.max(tiers.c.value_max),
+        total / func.nullif(count, 0),
+    ).group_by(tiers.c.user_id, tiers.c.day, tiers.c.metric_type)
+
+
+def _upsert_from_select(db, stmt):
+    insert = dialect_insert(db)(DailyMetricRollup).from_select(
+        ("user_id", "day", "metric_type") + _ROLLUP_COLUMNS, stmt,
+    )
+    insert = insert.on_conflict_do_update(
+        index_elements=["user_id", "metric_type", "day"],
+        set_={c: insert.excluded[c] for c in _ROLLUP_COLUMNS},
+    )
+    db.execute(insert)
+
+
+def _same_day(model, ts_column):
+    return and_(
+        model.user_id == DailyMetricRollup.user_id,
+        model.metric_type == DailyMetricRollup.metric_type,
+        ts_column >= DailyMetricRollup.day,
+        func.date(ts_column) == func.date(DailyMetricRollup.day),
+    )
+
+
+def refresh_rollups(db, touched: Iterable[Tuple[str, date]], user_id: int = DEFAULT_USER_ID) -> int:
+    """
+    Recompute one user's rollup rows for the given (metric_type, day) pairs from raw
+    samples and their downsampled aggregates.
+
+    Only the touched days are re-aggregated, so the cost is proportional to what an
+    ingest changed rather than to the table size. EWMA baselines that already include a
+    touched day are rewound. The caller owns the transaction.
+    """
+    by_type = defaultdict(set)
+    for metric_type, day in touched:
+        by_type[metric_type].add(day)
+    if not by_type:
+        return 0
+
+    count = 0
+    for metric_type, days in by_type.items():
+        days = sorted(days)
+        _upsert_from_select(db, _aggregate_select(user_id, metric_type, days))
+
+        # 两层里都已没有样本的日期，对应的汇总也要去掉
+        db.query(DailyMetricRollup).filter(
+            DailyMetricRollup.user_id == user_id,
+            DailyMetricRollup.metric_type == metric_type,
+            DailyMetricRollup.day.in_(days),
+            ~exists().where(_same_day(HealthMetric, HealthMetric.timestamp)),
+            ~exists().where(_same_day(MetricAggregate, MetricAggregate.bucket_start)),
+        ).delete(synchronize_session=False)
+        count += len(days)
+    # 改写了已折算进 EWMA 的日期，让 trends.py 下次重新起算
+    rewind_baselines(db, {metric_type: min(days) for metric_type, days in by_type.items()}, user_id)
+    return count
+
+
+def rebuild_rollups():
+    """Regenerate the whole rollup table from health_metrics and metric_aggregates."""
+    db = SessionLocal()
+    try:
+        db.query(DailyMetricRollup).delete()
+        db.query(MetricBaseline).delete()
+        _upsert_from_select(db, _aggregate_select())
+        db.commit()
+        total = db.query(func.count(DailyMetricRollup.id)).scalar()
+        logger.info(f"Rebuilt daily_metric_rollups: {total} rows.")
+        return total
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] != ["rebuild"]:
+        print("Usage: python rollups.py rebuild")
+        sys.exit(1)
+    rebuild_rollups()
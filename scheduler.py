@@ -1,12 +1,85 @@
-from insight_engine import generate_insight, send_to_discord
+"""
+Daily insight run.
+
+    uv run scheduler.py               # the default user
+    uv run scheduler.py --user alice
+    uv run scheduler.py --all-users   # every active user, SCHEDULER_CONCURRENCY at a time
+
+One user's failure does not stop the others; the run ends with a summary and exits
+non-zero if any user failed.
+"""
 import os
+import sys
+import time
+import asyncio
+import argparse
 import logging
+from typing import Any, Dict, Iterable
+
+from database import SessionLocal
+from insight_engine import gemini_client, run_insight_pipeline
+from users import active_user_ids, user_id_for
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("daily_task")
 
+# 同时生成报告的用户数；统计查询还受 INSIGHT_STATS_WORKERS 线程池限制
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "4"))
+
+
+async def _run_user(user_id: int, client, semaphore: asyncio.Semaphore) -> Dict[str, Any]:
+    async with semaphore:
+        timings = {}
+        try:
+            result = await run_insight_pipeline(client, timings=timings, user_id=user_id)
+        except Exception as e:
+            logger.exception(f"Insight run for user {user_id} failed")
+            return {"user_id": user_id, "error": str(e), "timings": timings}
+        logger.info(f"User {user_id}: delivered={result['delivered']} timings={timings}")
+        return {"user_id": user_id, "delivered": result["delivered"], "timings": timings}
+
+
+async def run_all(user_ids: Iterable[int], concurrency: int = None, client=None) -> Dict[str, Any]:
+    """Generate and deliver reports for `user_ids` with bounded concurrency; returns a run summary."""
+    semaphore = asyncio.Semaphore(concurrency or SCHEDULER_CONCURRENCY)
+    # 所有用户共用一个 Gemini 客户端（和它的连接池）
+    client = client or gemini_client()
+    started = time.perf_counter()
+    results = await asyncio.gather(*(_run_user(user_id, client, semaphore) for user_id in user_ids))
+    failures = {r["user_id"]: r["error"] for r in results if "error" in r}
+    return {
+        "users": len(results),
+        "delivered": sum(1 for r in results if r.get("delivered")),
+        "undelivered": sum(1 for r in results if r.get("delivered") is False),
+        "failed": len(failures),
+        "seconds": round(time.perf_counter() - started, 3),
+        "failures": failures,
+    }
+
+
+def _all_user_ids():
+    db = SessionLocal()
+    try:
+        return active_user_ids(db)
+    finally:
+        db.close()
+
+
 if __name__ == "__main__":
-    logger.info("Starting scheduled health analysis...")
-    content = generate_insight()
-    send_to_discord(content)
-    logger.info("Analysis report sent to Discord.")
+    parser = argparse.ArgumentParser(description="Generate and deliver the daily health insight.")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--user", help="run for this user only (default: the default user)")
+    target.add_argument("--all-users", action="store_true", help="run for every active user")
+    parser.add_argument("--concurrency", type=int, default=SCHEDULER_CONCURRENCY, help="users processed at once")
+    args = parser.parse_args()
+
+    user_ids = _all_user_ids() if args.all_users else [user_id_for(args.user)]
+    logger.info(f"Starting scheduled health analysis for {len(user_ids)} user(s)...")
+    summary = asyncio.run(run_all(user_ids, concurrency=args.concurrency))
+    logger.info(
+        f"Run finished in {summary['seconds']}s: {summary['delivered']} delivered, "
+        f"{summary['undelivered']} not delivered, {summary['failed']} failed."
+    )
+    for user_id, error in summary["failures"].items():
+        logger.error(f"User {user_id} failed: {error}")
+    sys.exit(1 if summary["failed"] else 0)
@@ -0,0 +1,249 @@
+"""
+Bucketed time-series reads for `/api/metrics/{metric_type}/series`.
+
+Sub-day buckets are aggregated in SQL from `health_metrics` together with the
+downsampled `metric_aggregates` tier; `1d` / `1w` come from `daily_metric_rollups`.
+The result is optionally reduced to a target point count with
+largest-triangle-three-buckets (LTTB), so response size is bounded for any range.
+"""
+import io
+import json
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Dict, Iterator, List
+
+from sqlalchemy import BigInteger, cast, func, literal_column, select, union_all
+
+from database import DEFAULT_USER_ID, HealthMetric, MetricAggregate, DailyMetricRollup
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# 桶名 → 秒数；raw 表示不聚合
+BUCKETS = {
+    "raw": None,
+    "1m": 60,
+    "5m": 300,
+    "15m": 900,
+    "1h": 3600,
+    "6h": 6 * 3600,
+    "1d": 86400,
+    "1w": 7 * 86400,
+}
+AGGREGATES = ("avg", "sum", "min", "max", "count")
+FORMATS = ("json", "ndjson", "arrow")
+
+SERIES_DEFAULT_POINTS = 1000
+SERIES_MAX_POINTS = 10_000
+# raw 模式下最多读这么多行，再多请改用聚合桶
+SERIES_MAX_RAW_ROWS = 500_000
+# auto 模式挑桶时允许的过采样倍数，剩下的交给 LTTB
+_AUTO_OVERSAMPLE = 4
+
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+_ARROW_BATCH_ROWS = 10_000
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+class SeriesError(ValueError):
+    pass
+
+
+def to_naive_utc(ts: datetime) -> datetime:
+    # 库里的时间戳是 naive UTC（PostgreSQL 会话时区为 UTC）
+    if ts.tzinfo is not None:
+        return ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def pick_bucket(start: datetime, end: datetime, points: int) -> str:
+    """Smallest aggregate bucket that keeps the series within a few multiples of `points`."""
+    span = (end - start).total_seconds()
+    for name, seconds in BUCKETS.items():
+        if seconds and span / seconds <= points * _AUTO_OVERSAMPLE:
+            return name
+    return "1w"
+
+
+def _row(t: datetime, total, avg, lo, hi, count) -> Dict:
+    return {"t": t, "sum": total, "avg": avg, "min": lo, "max": hi, "count": count}
+
+
+def _raw_rows(db, user_id: int, metric_type: str, start: datetime, end: datetime) -> List[Dict]:
+    query = db.query(HealthMetric.timestamp, HealthMetric.value).filter(
+        HealthMetric.user_id == user_id,
+        HealthMetric.metric_type == metric_type,
+        HealthMetric.timestamp >= start,
+        HealthMetric.timestamp < end,
+    ).order_by(HealthMetric.timestamp).limit(SERIES_MAX_RAW_ROWS + 1)
+    rows = [_row(ts, v, v, v, v, 1) for ts, v in query.yield_per(10_000)]
+    if len(rows) > SERIES_MAX_RAW_ROWS:
+        raise SeriesError(f"More than {SERIES_MAX_RAW_ROWS} raw samples in range; use an aggregate bucket.")
+    return rows
+
+
+def _epoch(db, ts_column):
+    if db.get_bind().dialect.name == "postgresql":
+        return func.extract("epoch", ts_column)
+    return func.strftime("%s", ts_column) + 0
+
+
+def _sql_bucket_rows(db, user_id: int, metric_type: str, start: datetime, end: datetime, seconds: int) -> List[Dict]:
+    # 常量直接写进 SQL，保证 SELECT 和 GROUP BY 里是同一个表达式
+    width = literal_column(str(seconds))
+
+    def tier(model, ts_column, total, count, lo, hi):
+        epoch = _epoch(db, ts_column)
+        bucket = (epoch - epoch % width).label("bucket")
+        return select(
+            bucket, total.label("total"), count.label("count"), lo.label("lo"), hi.label("hi"),
+        ).where(
+            model.user_id == user_id,
+            model.metric_type == metric_type,
+            ts_column >= start,
+            ts_column < end,
+        ).group_by(bucket)
+
+    # 超过保留期的样本已降采样进 metric_aggregates（见 retention.py），两层合并后再分桶；
+    # 比降采样粒度更细的桶在旧数据上只会有每个聚合桶一个点
+    tiers = union_all(
+        tier(HealthMetric, HealthMetric.timestamp, func.sum(HealthMetric.value), func.count(HealthMetric.value),
+             func.min(HealthMetric.value), func.max(HealthMetric.value)),
+        tier(MetricAggregate, MetricAggregate.bucket_start, func.sum(MetricAggregate.value_sum),
+             func.sum(MetricAggregate.sample_count), func.min(MetricAggregate.value_min),
+             func.max(MetricAggregate.value_max)),
+    ).subquery()
+    stmt = select(
+        tiers.c.bucket,
+        func.sum(tiers.c.total),
+        # PostgreSQL 上 sum(bigint) 是 numeric，转回整数
+        cast(func.sum(tiers.c.count), BigInteger),
+        func.min(tiers.c.lo),
+        func.max(tiers.c.hi),
+    ).group_by(tiers.c.bucket).order_by(tiers.c.bucket)
+
+    return [
+        _row(_EPOCH + timedelta(seconds=float(b)), s, s / c if c else None, lo, hi, c)
+        for b, s, c, lo, hi in db.execute(stmt)
+    ]
+
+
+def _rollup_rows(db, user_id: int, metric_type: str, start: datetime, end: datetime, weekly: bool) -> List[Dict]:
+    # 日汇总按整天计，起止日期所在的整天都会包含进来
+    rows = db.query(
+        DailyMetricRollup.day, DailyMetricRollup.value_sum, DailyMetricRollup.sample_count,
+        DailyMetricRollup.value_min, DailyMetricRollup.value_max,
+    ).filter(
+        DailyMetricRollup.user_id == user_id,
+        DailyMetricRollup.metric_type == metric_type,
+        DailyMetricRollup.day >= start.date(),
+        DailyMetricRollup.day <= end.date(),
+    ).order_by(DailyMetricRollup.day).all()
+
+    groups: Dict = {}
+    for day, total, count, lo, hi in rows:
+        key = day - timedelta(days=day.weekday()) if weekly else day
+        g = groups.setdefault(key, [0.0, 0, lo, hi])
+        g[0] += total
+        g[1] += count
+        g[2] = min(g[2], lo)
+        g[3] = max(g[3], hi)
+    return [
+        _row(datetime(k.year, k.month, k.day), total, total / count if count else None, lo, hi, count)
+        for k, (total, count, lo, hi) in groups.items()
+    ]
+
+
+def lttb(x: "np.ndarray", y: "np.ndarray", threshold: int) -> "np.ndarray":
+    """Indices of the points kept by largest-triangle-three-buckets downsampling."""
+    import numpy as np
+
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    every = (n - 2) / (threshold - 2)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = a = 0
+    for i in range(threshold - 2):
+        lo = int(i * every) + 1
+        hi = int((i + 1) * every) + 1
+        next_hi = min(int((i + 2) * every) + 1, n)
+        # 下一个桶的重心作为三角形的第三个顶点
+        avg_x = x[hi:next_hi].mean()
+        avg_y = y[hi:next_hi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(area.argmax())
+        selected[i + 1] = a
+    selected[-1] = n - 1
+    return selected
+
+
+def downsample(rows: List[Dict], points: int, agg: str) -> List[Dict]:
+    if len(rows) <= points:
+        return rows
+    # NumPy 只在需要降采样时才导入，不拖慢 API 启动
+    import numpy as np
+
+    x = np.array([(r["t"] - _EPOCH).total_seconds() for r in rows], dtype=np.float64)
+    y = np.array([r[agg] for r in rows], dtype=np.float64)
+    return [rows[i] for i in lttb(x, y, points)]
+
+
+def load_series(db, metric_type: str, start: datetime, end: datetime, bucket: str = "auto",
+                agg: str = "avg", points: int = SERIES_DEFAULT_POINTS, user_id: int = DEFAULT_USER_ID) -> Dict:
+    """Bucketed aggregates of one user's `metric_type` in [start, end), LTTB-reduced to at most `points`."""
+    start, end = to_naive_utc(start), to_naive_utc(end)
+    if end <= start:
+        raise SeriesError("end must be after start")
+    if agg not in AGGREGATES:
+        raise SeriesError(f"agg must be one of {AGGREGATES}")
+    points = max(3, min(points, SERIES_MAX_POINTS))
+    if bucket == "auto":
+        bucket = pick_bucket(start, end, points)
+    if bucket not in BUCKETS:
+        raise SeriesError(f"bucket must be 'auto' or one of {tuple(BUCKETS)}")
+
+    seconds = BUCKETS[bucket]
+    if seconds is None:
+        rows = _raw_rows(db, user_id, metric_type, start, end)
+    elif seconds >= 86400:
+        rows = _rollup_rows(db, user_id, metric_type, start, end, weekly=bucket == "1w")
+    else:
+        rows = _sql_bucket_rows(db, user_id, metric_type, start, end, seconds)
+
+    total = len(rows)
+    rows = downsample(rows, points, agg)
+    return {
+        "metric_type": metric_type,
+        "bucket": bucket,
+        "agg": agg,
+        "source_points": total,
+        "points": rows,
+    }
+
+
+def iter_ndjson(series: Dict) -> Iterator[bytes]:
+    for r in series["points"]:
+        yield (json.dumps(dict(r, t=r["t"].isoformat())) + "\n").encode()
+
+
+def iter_arrow(series: Dict) -> Iterator[bytes]:
+    """Arrow IPC stream of the points, written in record batches."""
+    import pyarrow as pa
+
+    schema = pa.schema([
+        ("t", pa.timestamp("us")),
+        ("sum", pa.float64()), ("avg", pa.float64()), ("min", pa.float64()), ("max", pa.float64()),
+        ("count", pa.int64()),
+    ])
+    sink = io.BytesIO()
+    rows = series["points"]
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for i in range(0, len(rows), _ARROW_BATCH_ROWS):
+            chunk = rows[i:i + _ARROW_BATCH_ROWS]
+            writer.write_batch(pa.RecordBatch.from_pylist(chunk, schema=schema))
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    yield sink.getvalue()
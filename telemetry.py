@@ -0,0 +1,112 @@
+"""
+Prometheus instrumentation, served by `GET /metrics`.
+
+Everything here is a counter/histogram update or a `perf_counter()` call, cheap enough to
+stay on in production. Per-ingest stage durations are accumulated in a `StageTimer` and
+observed once per payload rather than per batch.
+"""
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from sqlalchemy import event
+
+__all__ = ["CONTENT_TYPE_LATEST", "generate_latest"]
+
+_BYTES_BUCKETS = (1e3, 1e4, 1e5, 1e6, 5e6, 1e7, 5e7, 1e8, 5e8)
+_COUNT_BUCKETS = (1, 10, 100, 1e3, 1e4, 5e4, 1e5, 5e5, 1e6)
+_SQL_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+_REMOTE_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120)
+
+INGEST_PAYLOAD_BYTES = Histogram(
+    "health_ingest_payload_bytes", "Size of accepted webhook bodies.", buckets=_BYTES_BUCKETS,
+)
+INGEST_SAMPLES = Histogram(
+    "health_ingest_samples", "Metric samples per ingested payload.", buckets=_COUNT_BUCKETS,
+)
+INGEST_STAGE_SECONDS = Histogram(
+    "health_ingest_stage_seconds", "Time per ingest stage, summed over one payload.", ["stage"],
+)
+INGEST_JOBS = Counter("health_ingest_jobs_total", "Processed ingest queue jobs.", ["status"])
+QUEUE_DEPTH = Gauge("health_ingest_queue_depth", "Pending and running ingest jobs.")
+
+SQL_QUERY_SECONDS = Histogram(
+    "health_sql_query_seconds", "SQL statement latency by statement type.", ["operation"], buckets=_SQL_BUCKETS,
+)
+
+LLM_SECONDS = Histogram(
+    "health_llm_request_seconds", "Gemini generate_content latency.", ["outcome"], buckets=_REMOTE_BUCKETS,
+)
+DISCORD_SECONDS = Histogram(
+    "health_discord_request_seconds", "Discord webhook POST latency.", ["status"], buckets=_REMOTE_BUCKETS,
+)
+
+_SQL_OPERATIONS = {"SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "COPY"}
+
+
+class StageTimer:
+    """Accumulates wall time per stage over one ingest; `observe()` records the totals."""
+
+    def __init__(self):
+        self.totals: Dict[str, float] = defaultdict(float)
+
+    @contextmanager
+    def __call__(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.totals[stage] += time.perf_counter() - started
+
+    def wrap_iter(self, items: Iterable, stage: str) -> Iterator:
+        """Charge the time spent producing each item (e.g. parsing) to `stage`."""
+        it = iter(items)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.totals[stage] += time.perf_counter() - started
+                return
+            self.totals[stage] += time.perf_counter() - started
+            yield item
+
+    def observe(self):
+        for stage, seconds in self.totals.items():
+            INGEST_STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+def _operation(statement: str) -> str:
+    words = statement.split(None, 1)
+    verb = words[0].upper() if words else ""
+    return verb if verb in _SQL_OPERATIONS else "OTHER"
+
+
+def instrument_engine(engine):
+    """Time every cursor execution on `engine` (a sync Engine; pass `.sync_engine` for async)."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+        if context is not None:
+            # 记下这条语句还有几个计时没结束，出错时据此清理
+            context._pending_timers = getattr(context, "_pending_timers", 0) + 1
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_start"].pop()
+        if context is not None:
+            context._pending_timers -= 1
+        SQL_QUERY_SECONDS.labels(_operation(statement)).observe(time.perf_counter() - started)
+
+    @event.listens_for(engine, "handle_error")
+    def _error(exception_context):
+        # 语句失败时 after_cursor_execute 不会触发，不清理的话连接池里的连接会一直攒着旧的开始时间
+        context = exception_context.execution_context
+        conn = exception_context.connection
+        pending = getattr(context, "_pending_timers", 0) if context is not None else 0
+        if conn is not None and pending:
+            del conn.info["query_start"][-pending:]
+            context._pending_timers = 0
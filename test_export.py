@@ -0,0 +1,70 @@
+import io
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from fastapi.testclient import TestClient
+
+from database import SessionLocal, HealthMetric, Workout, DailyMetricRollup
+from ingest import process_health_data
+from main import app, webhook_token
+import export
+
+client = TestClient(app)
+_METRIC = "test_export_hr"
+_WORKOUT = "Test Export Row"
+_DAY = datetime(2023, 5, 1, 8, 0)
+
+
+@pytest.fixture
+def history():
+    def cleanup():
+        db = SessionLocal()
+        for model in (HealthMetric, DailyMetricRollup):
+            db.query(model).filter(model.metric_type == _METRIC).delete()
+        db.query(Workout).filter(Workout.workout_type == _WORKOUT).delete()
+        db.commit()
+        db.close()
+
+    cleanup()
+    process_health_data({"data": {
+        "metrics": [{"name": _METRIC, "units": "count/min", "data": [
+            {"qty": 60 + i, "date": (_DAY + timedelta(minutes=i)).strftime("%Y-%m-%d %H:%M:%S +0000"), "source": "Watch"}
+            for i in range(5)
+        ]}],
+        "workouts": [{"name": _WORKOUT, "start": _DAY.strftime("%Y-%m-%d %H:%M:%S +0000"), "duration": 1800}],
+    }}, backfill=True)
+    yield
+    cleanup()
+
+
+def test_export_to_parquet_in_row_groups(history, tmp_path):
+    path = str(tmp_path / "hr.parquet")
+    rows = export.export_to_file(path, "metrics", metric_types=[_METRIC], batch_rows=2,
+                                 start=_DAY, end=_DAY + timedelta(minutes=4))
+    assert rows == 4
+    assert pq.ParquetFile(path).metadata.num_row_groups == 2
+
+    df = pd.read_parquet(path)
+    assert list(df.columns) == ["timestamp", "metric_type", "value", "unit", "source"]
+    assert df["value"].tolist() == [60, 61, 62, 63]
+    assert df["timestamp"].iloc[0] == pd.Timestamp(_DAY)
+
+
+def test_export_endpoint_streams_parquet_and_arrow(history):
+    query = f"metric_type={_METRIC}&start=2023-05-01T00:00:00&token={webhook_token}"
+    response = client.get(f"/api/export/metrics?{query}&raw_data=true")
+    assert response.status_code == 200
+    table = pq.read_table(io.BytesIO(response.content))
+    assert table.num_rows == 5
+    assert '"source":"Watch"' in table.column("raw_data")[0].as_py()
+
+    response = client.get(f"/api/export/workouts?format=arrow&metric_type={_WORKOUT}&token={webhook_token}")
+    table = pa.ipc.open_stream(response.content).read_all()
+    assert table.column("duration_minutes").to_pylist() == [30]
+    assert "raw_data" not in table.column_names
+
+    assert client.get(f"/api/export/nope?token={webhook_token}").status_code == 404
+    assert client.get(f"/api/export/metrics?format=csv&token={webhook_token}").status_code == 400
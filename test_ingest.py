@@ -0,0 +1,395 @@
+import io
+import json
+
+import pytest
+
+from database import SessionLocal, HealthMetric, DailyMetricRollup, IngestWatermark, Workout, init_db
+from ingest import iter_payload, metric_rows, upsert_metrics, process_health_data
+import watermarks
+
+init_db()
+
+
+def _cleanup(metric_type):
+    db = SessionLocal()
+    db.query(HealthMetric).filter(HealthMetric.metric_type == metric_type).delete()
+    db.query(DailyMetricRollup).filter(DailyMetricRollup.metric_type == metric_type).delete()
+    db.commit()
+    db.close()
+
+
+@pytest.fixture
+def metric_type():
+    name = "test_bulk_metric"
+    _cleanup(name)
+    yield name
+    _cleanup(name)
+
+
+def _payload(metric_type, samples):
+    return {"data": {"metrics": [{"name": metric_type, "units": "count", "data": samples}]}}
+
+
+def test_upsert_metrics_reports_inserted_and_updated(metric_type):
+    samples = [{"qty": i, "date": f"2024-03-20 12:{i:02d}:00"} for i in range(10)]
+    db = SessionLocal()
+    try:
+        first = upsert_metrics(db, metric_rows(_payload(metric_type, samples)["data"]["metrics"]), chunk_size=4)
+        db.commit()
+        assert first["inserted"] == 10
+        assert first["updated"] == 0
+        assert [b["rows"] for b in first["batches"]] == [4, 4, 2]
+
+        resent = samples[5:] + [{"qty": 99, "date": "2024-03-20 13:00:00"}]
+        second = upsert_metrics(db, metric_rows(_payload(metric_type, resent)["data"]["metrics"]), chunk_size=4)
+        db.commit()
+        assert second["inserted"] == 1
+        assert second["updated"] == 5
+    finally:
+        db.close()
+
+
+def test_resent_export_updates_values(metric_type):
+    process_health_data(_payload(metric_type, [{"qty": 1, "date": "2024-03-20 12:00:00"}]))
+    result = process_health_data(_payload(metric_type, [{"qty": 2, "date": "2024-03-20 12:00:00"}]))
+    assert result["metrics"]["updated"] == 1
+
+    db = SessionLocal()
+    try:
+        rows = db.query(HealthMetric).filter(HealthMetric.metric_type == metric_type).all()
+        assert [r.value for r in rows] == [2.0]
+        rollups = db.query(DailyMetricRollup).filter(DailyMetricRollup.metric_type == metric_type).all()
+        assert [(r.value_sum, r.sample_count) for r in rollups] == [(2.0, 1)]
+    finally:
+        db.close()
+
+
+def test_identical_payload_is_skipped_unless_backfill(metric_type):
+    payload = _payload(metric_type, [{"qty": 1, "date": "2024-03-20 12:00:00"}])
+    assert process_health_data(payload)["duplicate"] is False
+
+    again = process_health_data(payload)
+    assert again["duplicate"] is True
+    assert again["metrics"]["inserted"] + again["metrics"]["updated"] == 0
+
+    forced = process_health_data(payload, backfill=True)
+    assert forced["duplicate"] is False
+    assert forced["metrics"]["updated"] == 1
+
+
+def test_late_correction_inside_grace_window_is_applied(metric_type, monkeypatch):
+    monkeypatch.setattr(watermarks, "WATERMARK_GRACE_HOURS", 6)
+    hours = [{"qty": 100, "date": f"2024-03-20 {h:02d}:00:00", "source": "iPhone"} for h in range(8, 13)]
+    process_health_data(_payload(metric_type, hours))
+
+    # Watch 晚同步后，HAE 带着修正值重发前几个小时的桶，连同更早的一条
+    corrected = [{"qty": 150, "date": f"2024-03-20 {h:02d}:00:00", "source": "iPhone"} for h in (5, 9, 10)]
+    result = process_health_data(_payload(metric_type, corrected))
+    assert result["metrics"]["updated"] == 2
+    assert result["metrics"]["skipped"] == 1
+
+    db = SessionLocal()
+    try:
+        rows = db.query(HealthMetric.timestamp, HealthMetric.value).filter(
+            HealthMetric.metric_type == metric_type).order_by(HealthMetric.timestamp).all()
+        assert [(ts.hour, v) for ts, v in rows] == [(8, 100), (9, 150), (10, 150), (11, 100), (12, 100)]
+        rollup = db.query(DailyMetricRollup.value_sum).filter(DailyMetricRollup.metric_type == metric_type).scalar()
+        assert rollup == 600
+    finally:
+        db.close()
+
+
+def test_watermarks_are_kept_per_source(metric_type, monkeypatch):
+    monkeypatch.setattr(watermarks, "WATERMARK_GRACE_HOURS", 6)
+    process_health_data(_payload(metric_type, [{"qty": 500, "date": "2024-03-20 12:00:00", "source": "Apple Watch"}]))
+
+    # iPhone 晚了一天才同步，样本比 Watch 的水位线早了 9 小时，仍然要写入
+    late = process_health_data(_payload(metric_type, [{"qty": 40, "date": "2024-03-20 03:00:00", "source": "iPhone"}]))
+    assert (late["metrics"]["inserted"], late["metrics"]["skipped"]) == (1, 0)
+    # 同一设备更早的重发照样跳过
+    stale = process_health_data(_payload(metric_type, [{"qty": 1, "date": "2024-03-20 02:00:00", "source": "Apple Watch"}]))
+    assert stale["metrics"]["skipped"] == 1
+
+    db = SessionLocal()
+    try:
+        rows = db.query(HealthMetric.source, HealthMetric.value).filter(
+            HealthMetric.metric_type == metric_type).order_by(HealthMetric.timestamp).all()
+        assert rows == [("iPhone", 40), ("Apple Watch", 500)]
+        marks = db.query(IngestWatermark.source, IngestWatermark.high_water).filter(
+            IngestWatermark.metric_type == metric_type).order_by(IngestWatermark.source).all()
+        assert [(source, ts.hour) for source, ts in marks] == [("Apple Watch", 12), ("iPhone", 3)]
+    finally:
+        db.close()
+
+
+def test_samples_below_watermark_are_skipped(metric_type, monkeypatch):
+    monkeypatch.setattr(watermarks, "WATERMARK_GRACE_HOURS", 0)
+    day = [{"qty": i, "date": f"2024-03-20 12:{i:02d}:00"} for i in range(10)]
+    process_health_data(_payload(metric_type, day))
+
+    # 重发整段窗口：水位线之前的跳过，水位线那一条和之后的新样本照常写入
+    resent = day + [{"qty": 99, "date": "2024-03-20 12:10:00"}]
+    result = process_health_data(_payload(metric_type, resent))
+    assert result["metrics"]["skipped"] == 9
+    assert result["metrics"]["updated"] == 1
+    assert result["metrics"]["inserted"] == 1
+
+    late = process_health_data(_payload(metric_type, [{"qty": 7, "date": "2024-03-19 08:00:00"}]))
+    assert late["metrics"]["skipped"] == 1
+    backfilled = process_health_data(_payload(metric_type, [{"qty": 7, "date": "2024-03-19 08:00:00"}]), backfill=True)
+    assert backfilled["metrics"]["inserted"] == 1
+
+
+def test_iter_payload_streams_samples_and_workouts():
+    body = {
+        "data": {
+            "metrics": [
+                # data 在 name/units 之前出现时也要能正确归属
+                {"data": [{"qty": 1, "date": "2024-03-20 12:00:00"}], "name": "step_count", "units": "steps"},
+                {"name": "heart_rate", "units": "bpm", "data": [
+                    {"qty": 60, "date": "2024-03-20 12:00:00"},
+                    {"date": "2024-03-20 12:01:00"},
+                ]},
+            ],
+            "workouts": [{"name": "Running", "start": "2024-03-20 07:00:00", "heartRate": {"avg": {"qty": 150}}}],
+        }
+    }
+    events = list(iter_payload(io.BytesIO(json.dumps(body).encode())))
+
+    metrics = [item for kind, item in events if kind == "metric"]
+    workouts = [item for kind, item in events if kind == "workout"]
+    assert [(m["metric_type"], m["unit"], m["value"]) for m in metrics] == [
+        ("step_count", "steps", 1.0),
+        ("heart_rate", "bpm", 60.0),
+    ]
+    assert workouts[0]["heartRate"]["avg"]["qty"] == 150
+
+
+def test_workouts_are_upserted_in_batches():
+    workout = {
+        "name": "Test Upsert Run",
+        "start": "2024-03-21 07:00:00",
+        "end": "2024-03-21 07:30:00",
+        "duration": 1800,
+        "activeEnergyBurned": {"qty": 300, "units": "kcal"},
+        "heartRate": {"avg": {"qty": 150}, "max": {"qty": 175}},
+    }
+    db = SessionLocal()
+    db.query(Workout).filter(Workout.workout_type == workout["name"]).delete()
+    db.commit()
+    try:
+        first = process_health_data({"data": {"workouts": [workout]}})
+        assert first["workouts"]["inserted"] == 1
+
+        second = process_health_data({"data": {"workouts": [dict(workout, duration=2400)]}})
+        assert second["workouts"]["updated"] == 1
+
+        rows = db.query(Workout).filter(Workout.workout_type == workout["name"]).all()
+        assert [(r.duration_minutes, r.active_calories, r.max_heart_rate) for r in rows] == [(40.0, 300, 175)]
+    finally:
+        db.query(Workout).filter(Workout.workout_type == workout["name"]).delete()
+        db.commit()
+        db.close()
+
+
+def test_import_csv_normalizes_offsets_to_utc(tmp_path, metric_type):
+    from import_snapshot import import_csv
+
+    csv_path = tmp_path / "snapshot.csv"
+    csv_path.write_text(
+        "timestamp,metric_type,value,unit\n"
+        f"2024-02-06 14:30:00 -0800,{metric_type},100,count\n"
+        f"2024-02-06 14:31:00 -0800,{metric_type},50,\n"
+        f"2024-02-06 14:31:00 -0800,{metric_type},70,count\n"
+    )
+    assert import_csv(str(csv_path), chunk_rows=2) == 3
+
+    db = SessionLocal()
+    try:
+        rows = db.query(HealthMetric).filter(HealthMetric.metric_type == metric_type).order_by(HealthMetric.timestamp).all()
+        assert [(r.timestamp.hour, r.timestamp.minute, r.value, r.unit) for r in rows] == [(22, 30, 100, "count"), (22, 31, 70, "count")]
+        rollup = db.query(DailyMetricRollup).filter(DailyMetricRollup.metric_type == metric_type).one()
+        assert rollup.value_sum == 170
+    finally:
+        db.close()
+
+
+def test_import_apple_health_export(tmp_path):
+    from import_apple_health import import_export
+
+    xml_path = tmp_path / "export.xml"
+    xml_path.write_text(
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<HealthData locale="en_US">\n'
+        ' <ExportDate value="2024-03-23 09:00:00 +0000"/>\n'
+        ' <Record type="HKQuantityTypeIdentifierTestXmlCount" sourceName="Apple Watch" unit="count"'
+        ' startDate="2024-03-22 08:00:00 +0000" endDate="2024-03-22 08:01:00 +0000" value="120">\n'
+        '  <MetadataEntry key="HKWasUserEntered" value="0"/>\n'
+        ' </Record>\n'
+        ' <Record type="HKQuantityTypeIdentifierTestXmlCount" sourceName="iPhone" unit="count"'
+        ' startDate="2024-03-22 09:00:00 +0000" endDate="2024-03-22 09:01:00 +0000" value="80"/>\n'
+        ' <Workout workoutActivityType="HKWorkoutActivityTypeTestXmlStrengthTraining" duration="45"'
+        ' durationUnit="min" sourceName="Apple Watch"'
+        ' startDate="2024-03-22 18:00:00 +0000" endDate="2024-03-22 18:45:00 +0000">\n'
+        '  <WorkoutStatistics type="HKQuantityTypeIdentifierActiveEnergyBurned" sum="250" unit="kcal"/>\n'
+        '  <WorkoutStatistics type="HKQuantityTypeIdentifierHeartRate" average="130" maximum="165" unit="count/min"/>\n'
+        ' </Workout>\n'
+        '</HealthData>\n'
+    )
+    db = SessionLocal()
+    try:
+        result = import_export(str(xml_path), sources=["Apple Watch"])
+        assert result["metrics"]["inserted"] == 1
+        assert result["workouts"]["inserted"] == 1
+
+        metric = db.query(HealthMetric).filter(HealthMetric.metric_type == "test_xml_count").one()
+        assert (metric.value, metric.unit) == (120, "count")
+        workout = db.query(Workout).filter(Workout.workout_type == "Test Xml Strength Training").one()
+        assert (workout.duration_minutes, workout.active_calories, workout.max_heart_rate) == (45.0, 250, 165)
+    finally:
+        db.query(HealthMetric).filter(HealthMetric.metric_type == "test_xml_count").delete()
+        db.query(DailyMetricRollup).filter(DailyMetricRollup.metric_type == "test_xml_count").delete()
+        db.query(Workout).filter(Workout.workout_type == "Test Xml Strength Training").delete()
+        db.commit()
+        db.close()
+
+
+def test_sleep_records_map_to_stage_minutes():
+    from import_apple_health import record_rows
+
+    rows = list(record_rows({
+        "type": "HKCategoryTypeIdentifierSleepAnalysis",
+        "value": "HKCategoryValueSleepAnalysisAsleepDeep",
+        "startDate": "2024-03-22 01:00:00 +0000",
+        "endDate": "2024-03-22 01:45:00 +0000",
+    }))
+    assert [(r["metric_type"], r["value"]) for r in rows] == [("sleep_deep", 45.0), ("sleep_analysis", 45.0)]
+
+
+def test_compact_raw_data_drops_derived_keys(metric_type):
+    sample = {"qty": 1, "date": "2024-03-20 12:00:00", "source": "Apple Watch"}
+    process_health_data(_payload(metric_type, [sample, {"qty": 2, "date": "2024-03-20 12:01:00"}]))
+
+    db = SessionLocal()
+    try:
+        rows = db.query(HealthMetric).filter(HealthMetric.metric_type == metric_type).order_by(HealthMetric.timestamp).all()
+        assert [r.raw_data for r in rows] == [{"source": "Apple Watch"}, None]
+    finally:
+        db.close()
+
+
+def test_strip_raw_data_migration(metric_type):
+    from migrate import strip_raw_data
+
+    db = SessionLocal()
+    try:
+        # 模拟旧版本写入的完整样本
+        upsert_metrics(db, [
+            dict(row, raw_data={"qty": row["value"], "date": "2024-03-20 12:00:00", "source": "iPhone"})
+            for row in metric_rows(_payload(metric_type, [{"qty": 5, "date": "2024-03-20 12:00:00"}])["data"]["metrics"])
+        ])
+        db.commit()
+
+        report = strip_raw_data("compact", batch_size=1000)
+        assert report["raw_data_bytes_after"] < report["raw_data_bytes_before"]
+
+        db.expire_all()
+        row = db.query(HealthMetric).filter(HealthMetric.metric_type == metric_type).one()
+        assert row.raw_data == {"source": "iPhone"}
+    finally:
+        db.close()
+
+
+def test_async_engine_ingest_path(tmp_path, metric_type, monkeypatch):
+    pytest.importorskip("aiosqlite")
+    import asyncio
+    import database
+    from ingest import process_health_file_async
+    from ingest_queue import IngestQueue
+
+    monkeypatch.setattr(database, "DATABASE_ASYNC", True)
+    monkeypatch.setattr(database, "_async_sessionmaker", None)
+
+    async def scenario():
+        queue = IngestQueue(str(tmp_path))
+        path = queue.new_payload_path()
+        with open(path, "w") as f:
+            json.dump(_payload(metric_type, [{"qty": 3, "date": "2024-03-20 12:00:00 -0700"}]), f)
+        job_id = queue.enqueue(path)
+        try:
+            assert await queue.run_once_async(process_health_file_async)
+        finally:
+            await database.get_async_sessionmaker().kw["bind"].dispose()
+        return queue.get(job_id)
+
+    job = asyncio.run(scenario())
+    assert job["status"] == "done"
+    assert job["result"]["metrics"]["inserted"] == 1
+
+    db = SessionLocal()
+    try:
+        row = db.query(HealthMetric).filter(HealthMetric.metric_type == metric_type).one()
+        # 带偏移量的时间统一换算成 UTC 存储
+        assert (row.timestamp.hour, row.value) == (19, 3)
+    finally:
+        db.close()
+
+
+def test_benchmark_payload_generator_is_deterministic():
+    from datetime import datetime
+    from benchmarks.payloads import generate_days, sample_count
+
+    end = datetime(2024, 3, 21)
+    first, second = generate_days(2, seed=7, end=end), generate_days(2, seed=7, end=end)
+    assert first == second
+    day = first[0]["data"]
+    assert {m["name"] for m in day["metrics"]} >= {"heart_rate", "step_count", "sleep_deep", "sleep_analysis"}
+    assert len(next(m for m in day["metrics"] if m["name"] == "heart_rate")["data"]) == 24 * 60
+    assert day["workouts"][0]["heartRate"]["avg"]["units"] == "bpm"
+    assert sample_count(first[0]) > 24 * 60
+
+
+def test_async_ingest_keeps_event_loop_responsive(tmp_path, metric_type, monkeypatch):
+    pytest.importorskip("aiosqlite")
+    import asyncio
+    import time
+    from datetime import datetime, timedelta
+    import database
+    from ingest import process_health_file_async
+
+    monkeypatch.setattr(database, "DATABASE_ASYNC", True)
+    monkeypatch.setattr(database, "_async_sessionmaker", None)
+    start = datetime(2024, 1, 1)
+    samples = [{"qty": i, "date": (start + timedelta(seconds=i)).strftime("%Y-%m-%d %H:%M:%S +0000"), "source": "Watch"}
+               for i in range(60000)]
+    path = str(tmp_path / "big.json")
+    with open(path, "w") as f:
+        json.dump(_payload(metric_type, samples), f)
+
+    async def scenario():
+        gaps = []
+        done = asyncio.Event()
+
+        async def ticker():
+            # 代表同一事件循环上的其它请求：每次醒来的间隔就是它们要等的时间
+            last = time.perf_counter()
+            while not done.is_set():
+                await asyncio.sleep(0.001)
+                now = time.perf_counter()
+                gaps.append(now - last)
+                last = now
+
+        tick = asyncio.create_task(ticker())
+        try:
+            result = await process_health_file_async(path, backfill=True)
+        finally:
+            done.set()
+            await tick
+            await database.get_async_sessionmaker().kw["bind"].dispose()
+        return result, gaps
+
+    result, gaps = asyncio.run(scenario())
+    assert result["metrics"]["inserted"] == 60000
+    # 解析在线程里进行，写入按小批执行，事件循环最长只被一批写入占住
+    assert len(gaps) > 50
+    assert max(gaps) < 0.25
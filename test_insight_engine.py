@@ -0,0 +1,235 @@
+import time
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from database import SessionLocal, HealthMetric, DailyMetricRollup, InsightCacheEntry, init_db
+from aggregates import metric_summaries
+from rollups import refresh_rollups
+from generations import bump_generation, bump_generations, metric_generation
+import insight_cache
+import insight_engine
+from insight_engine import generate_insight, get_recent_stats, get_sleep_stats
+
+init_db()
+
+_TEST_TYPES = ['step_count', 'heart_rate', 'sleep_deep']
+
+
+@pytest.fixture
+def recent_samples():
+    """Two days of steps, heart rate and deep sleep inside the 7-day window."""
+    db = SessionLocal()
+    today = datetime.now().replace(hour=12, minute=0, second=0, microsecond=0)
+    since = today - timedelta(days=6)
+    db.query(HealthMetric).filter(HealthMetric.metric_type.in_(_TEST_TYPES), HealthMetric.timestamp >= since).delete()
+    rows = [
+        ('step_count', today - timedelta(days=1), 4000), ('step_count', today - timedelta(days=1, hours=1), 1000),
+        ('step_count', today, 3000),
+        ('heart_rate', today, 60), ('heart_rate', today - timedelta(minutes=1), 80), ('heart_rate', today - timedelta(days=1), 70),
+        ('sleep_deep', today, 90),
+    ]
+    for m_type, ts, val in rows:
+        db.add(HealthMetric(timestamp=ts, metric_type=m_type, value=val, unit='count'))
+    db.flush()
+    touched = {(m_type, ts.date()) for m_type, ts, _ in rows}
+    refresh_rollups(db, touched)
+    # 和入库流程一样推进版本号，让统计缓存失效
+    bump_generations(db, [metric_generation(m) for m in _TEST_TYPES])
+    db.commit()
+    yield
+    db.query(HealthMetric).filter(HealthMetric.metric_type.in_(_TEST_TYPES), HealthMetric.timestamp >= since).delete()
+    refresh_rollups(db, touched)
+    bump_generations(db, [metric_generation(m) for m in _TEST_TYPES])
+    db.commit()
+    db.close()
+
+
+def test_metric_summaries_single_pass(recent_samples):
+    summaries = metric_summaries(['step_count', 'heart_rate', 'no_such_metric'])
+    assert set(summaries) == {'step_count', 'heart_rate'}
+    assert summaries['step_count']['weekly_total'] == 8000
+    assert summaries['step_count']['max_day'] == 5000
+    assert summaries['step_count']['days_tracked'] == 2
+    assert summaries['heart_rate']['sample_avg'] == 70
+
+
+def test_recent_and_sleep_stats(recent_samples):
+    stats = get_recent_stats()
+    assert stats['step_count'] == {"daily_avg": 4000, "weekly_total": 8000, "max_day": 5000}
+    assert stats['heart_rate'] == {"avg": 70}
+
+    sleep = get_sleep_stats()
+    assert sleep == {"deep_sleep_minutes": {"daily_avg_minutes": 90, "days_tracked": 1}}
+
+
+def test_refresh_rollups_tracks_raw_samples(recent_samples):
+    db = SessionLocal()
+    try:
+        rollup = db.query(DailyMetricRollup).filter(
+            DailyMetricRollup.metric_type == 'heart_rate', DailyMetricRollup.day == date.today()
+        ).one()
+        assert (rollup.value_sum, rollup.sample_count, rollup.value_min, rollup.value_max, rollup.value_avg) == (140, 2, 60, 80, 70)
+
+        # 删除原始样本后，重算会把过期的汇总行去掉
+        db.query(HealthMetric).filter(HealthMetric.metric_type == 'heart_rate', HealthMetric.timestamp >= date.today()).delete()
+        refresh_rollups(db, {('heart_rate', date.today())})
+        db.commit()
+        assert db.query(DailyMetricRollup).filter(
+            DailyMetricRollup.metric_type == 'heart_rate', DailyMetricRollup.day == date.today()
+        ).count() == 0
+    finally:
+        db.close()
+
+
+class FakeLLM:
+    """Stands in for genai.Client: records prompts and answers with a canned reply."""
+
+    def __init__(self, fail=False):
+        self.prompts = []
+        self.fail = fail
+        self.models = self
+
+    def generate_content(self, model, contents):
+        self.prompts.append(contents)
+        if self.fail:
+            raise RuntimeError("quota exceeded")
+        return type("Response", (), {"text": f"insight #{len(self.prompts)}"})()
+
+
+@pytest.fixture
+def empty_cache():
+    db = SessionLocal()
+    db.query(InsightCacheEntry).delete()
+    db.commit()
+    yield db
+    db.query(InsightCacheEntry).delete()
+    db.commit()
+    db.close()
+
+
+def test_insight_cache_skips_llm_when_nothing_changed(recent_samples, empty_cache):
+    llm = FakeLLM()
+    assert generate_insight(client=llm) == "insight #1"
+    assert "4000" in llm.prompts[0]
+
+    # 没有新数据：直接复用上次的报告
+    assert generate_insight(client=llm) == "insight #1"
+    assert len(llm.prompts) == 1
+
+    # 有写入但统计结果没变：按内容哈希命中
+    bump_generation(empty_cache)
+    empty_cache.commit()
+    assert generate_insight(client=llm) == "insight #1"
+    assert len(llm.prompts) == 1
+
+    assert generate_insight(client=llm, use_cache=False) == "insight #2"
+
+
+def test_insight_cache_does_not_store_errors(recent_samples, empty_cache):
+    assert generate_insight(client=FakeLLM(fail=True)).startswith("AI 离家出走了")
+    assert empty_cache.query(InsightCacheEntry).count() == 0
+
+
+def test_insight_cache_eviction(empty_cache):
+    for i in range(5):
+        insight_cache.store(empty_cache, f"key-{i}", "v1", 1, f"response {i}")
+    assert insight_cache.evict(empty_cache, max_entries=2) == 3
+    empty_cache.commit()
+    assert insight_cache.lookup(empty_cache, "key-4") == "response 4"
+    assert insight_cache.lookup(empty_cache, "key-0") is None
+
+
+class SlowLLM(FakeLLM):
+    def generate_content(self, model, contents):
+        time.sleep(0.5)
+        return super().generate_content(model, contents)
+
+
+def test_llm_deadline_returns_fallback(recent_samples, empty_cache):
+    timings = {}
+    content = generate_insight(client=SlowLLM(), timings=timings, timeout=0.05)
+    assert content.startswith("⏱️")
+    assert "4000" in content
+    assert {"stats", "llm"} <= set(timings)
+    # 兜底消息不进缓存
+    assert empty_cache.query(InsightCacheEntry).count() == 0
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.ok = 200 <= status_code < 300
+        self.headers = headers or {}
+        self.text = str(body)
+        self._body = body
+
+    def json(self):
+        return self._body
+
+
+def test_send_to_discord_honours_retry_after(monkeypatch):
+    responses = [FakeResponse(429, {"retry_after": 0.01}), FakeResponse(204)]
+    calls = []
+
+    def fake_post(url, json, timeout):
+        calls.append(url)
+        return responses.pop(0)
+
+    monkeypatch.setenv("DISCORD_WEBHOOK_URL", "https://discord.example/webhook")
+    monkeypatch.setattr(insight_engine._discord_session, "post", fake_post)
+    assert insight_engine.send_to_discord("hello") is True
+    assert len(calls) == 2
+
+
+def test_stats_cache_invalidated_by_ingest(recent_samples, monkeypatch):
+    from ingest import process_health_data
+
+    calls = []
+    real = insight_engine.metric_summaries
+    monkeypatch.setattr(insight_engine, "metric_summaries", lambda *a, **kw: calls.append(a) or real(*a, **kw))
+    insight_engine.clear_stats_cache()
+
+    assert get_recent_stats()['step_count']['weekly_total'] == 8000
+    assert get_recent_stats()['step_count']['weekly_total'] == 8000
+    assert len(calls) == 1
+
+    # 写入同一天的新样本会推进 step_count 的版本号
+    now = datetime.now().replace(hour=12, minute=30, second=0, microsecond=0)
+    process_health_data({"data": {"metrics": [{"name": "step_count", "units": "count", "data": [
+        {"qty": 500, "date": now.strftime("%Y-%m-%d %H:%M:%S")}
+    ]}]}})
+    assert get_recent_stats()['step_count']['weekly_total'] == 8500
+    assert len(calls) == 2
+
+    # 其他指标的写入不影响这个缓存
+    process_health_data({"data": {"metrics": [{"name": "sleep_deep", "units": "min", "data": [
+        {"qty": 30, "date": now.strftime("%Y-%m-%d %H:%M:%S")}
+    ]}]}})
+    get_recent_stats()
+    assert len(calls) == 2
+
+
+def test_scheduler_fan_out_isolates_failures(monkeypatch):
+    import asyncio
+    import scheduler
+
+    in_flight = []
+    peak = []
+
+    async def fake_pipeline(client, timings=None, user_id=None):
+        in_flight.append(user_id)
+        peak.append(len(in_flight))
+        await asyncio.sleep(0.01)
+        in_flight.remove(user_id)
+        if user_id == 2:
+            raise RuntimeError("boom")
+        return {"content": "report", "delivered": user_id != 3}
+
+    monkeypatch.setattr(scheduler, "run_insight_pipeline", fake_pipeline)
+    summary = asyncio.run(scheduler.run_all([1, 2, 3, 4], concurrency=2, client=object()))
+
+    assert max(peak) == 2
+    assert summary["users"] == 4
+    assert (summary["delivered"], summary["undelivered"], summary["failed"]) == (2, 1, 1)
+    assert summary["failures"] == {2: "boom"}
@@ -1,11 +1,17 @@
 import pytest
 import os
+import time
 
 # 强制使用 SQLite 进行测试，避开 PostgreSQL 的连接问题
 os.environ["DATABASE_URL"] = "sqlite:///./test.db"
 
 from fastapi.testclient import TestClient
+import main
 from main import app, webhook_token
+from ingest import process_health_file
+from ingest_queue import IngestQueue
+from database import SessionLocal, HealthMetric, DailyMetricRollup, DataGeneration, User
+from users import create_user
 
 client = TestClient(app)
 
@@ -33,3 +39,172 @@ def test_webhook_authorized():
     })
     assert response.status_code == 200
     assert response.json()["status"] == "accepted"
+
+    # 入队的任务由 worker 消费后，可以通过 jobs 接口查询结果
+    job_id = response.json()["job_id"]
+    main.ingest_queue.drain(process_health_file)
+    job = client.get(f"/api/health/jobs/{job_id}?token={webhook_token}").json()
+    assert job["status"] == "done"
+    assert job["result"]["metrics"]["inserted"] + job["result"]["metrics"]["updated"] == 1
+
+def test_metrics_endpoint_reports_ingest_stages():
+    assert client.get("/metrics?token=wrong-token").status_code == 403
+    client.post(f"/api/health/webhook?token={webhook_token}", json={
+        "data": {"metrics": [{"name": "step_count", "units": "steps", "data": [{"qty": 5, "date": "2024-03-21 08:00:00"}]}]}
+    })
+    main.ingest_queue.drain(process_health_file)
+
+    response = client.get(f"/metrics?token={webhook_token}")
+    assert response.status_code == 200
+    body = response.text
+    assert 'health_ingest_stage_seconds_count{stage="upsert_metrics"}' in body
+    assert 'health_sql_query_seconds_count{operation="INSERT"}' in body
+    assert "health_ingest_payload_bytes_count" in body
+    assert 'health_ingest_jobs_total{status="done"}' in body
+    assert "health_ingest_queue_depth" in body
+
+
+def test_sql_operation_labels_and_failed_statements():
+    from sqlalchemy import text
+    from database import engine
+
+    with engine.connect() as conn:
+        conn.execute(text("WITH t AS (SELECT 1 AS x) SELECT x FROM t"))
+        with pytest.raises(Exception):
+            conn.execute(text("SELECT * FROM no_such_table"))
+        # 失败的语句不会在连接上留下没结束的计时
+        assert conn.info["query_start"] == []
+    body = client.get(f"/metrics?token={webhook_token}").text
+    assert 'health_sql_query_seconds_count{operation="WITH"}' in body
+
+
+def test_webhook_queue_full(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "ingest_queue", IngestQueue(str(tmp_path), max_pending=1))
+    first = client.post(f"/api/health/webhook?token={webhook_token}", json={"data": {}})
+    assert first.status_code == 200
+    second = client.post(f"/api/health/webhook?token={webhook_token}", json={"data": {}})
+    assert second.status_code == 429
+
+def test_failed_job_is_retried_then_marked_failed(tmp_path):
+    queue = IngestQueue(str(tmp_path), max_attempts=2, retry_delay=0)
+    path = queue.new_payload_path()
+    with open(path, "w") as f:
+        f.write("{not json")
+    job_id = queue.enqueue(path)
+
+    queue.drain(process_health_file)
+    job = queue.get(job_id)
+    assert job["status"] == "failed"
+    assert job["attempts"] == 2
+
+
+def test_webhook_spools_streamed_body_in_batches(tmp_path, monkeypatch):
+    import json
+    monkeypatch.setattr(main, "ingest_queue", IngestQueue(str(tmp_path)))
+    monkeypatch.setattr(main, "SPOOL_FLUSH_BYTES", 16)
+    body = json.dumps({"data": {"metrics": [
+        {"name": "test_spool_batches", "units": "count", "data": [{"qty": 7, "date": "2024-03-22 08:00:00"}]}
+    ]}}).encode()
+    # 分块上传，请求体会分好几批写盘
+    chunks = (body[i:i + 10] for i in range(0, len(body), 10))
+    response = client.post(f"/api/health/webhook?token={webhook_token}", content=chunks)
+    assert response.status_code == 200
+
+    main.ingest_queue.drain(process_health_file)
+    job = main.ingest_queue.get(response.json()["job_id"])
+    assert job["status"] == "done"
+    db = SessionLocal()
+    try:
+        row = db.query(HealthMetric).filter(HealthMetric.metric_type == "test_spool_batches").one()
+        assert row.value == 7
+        db.delete(row)
+        db.query(DailyMetricRollup).filter(DailyMetricRollup.metric_type == "test_spool_batches").delete()
+        db.commit()
+    finally:
+        db.close()
+
+
+def test_running_job_is_reclaimed_only_after_its_lease(tmp_path):
+    queue = IngestQueue(str(tmp_path), lease_seconds=60)
+    path = queue.new_payload_path()
+    with open(path, "w") as f:
+        f.write("{}")
+    job_id = queue.enqueue(path)
+    assert queue.claim()["id"] == job_id
+
+    # 另一个进程启动时任务还在租约内，不会被重新排队或领取
+    other = IngestQueue(str(tmp_path), lease_seconds=60)
+    assert other.get(job_id)["status"] == "running"
+    assert other.claim() is None
+
+    # 领取它的进程退出后不再续期，租约过期后重新排队
+    with other._connect() as conn:
+        conn.execute("UPDATE jobs SET updated_at = updated_at - 120 WHERE id = ?", (job_id,))
+    restarted = IngestQueue(str(tmp_path), lease_seconds=60)
+    assert restarted.get(job_id)["status"] == "pending"
+
+    # 处理期间 worker 一直续期，租约短于处理时间也不会被别人领走
+    short = IngestQueue(str(tmp_path), lease_seconds=0.3)
+
+    def slow_handler(path):
+        time.sleep(0.6)
+        assert short.claim() is None
+        return {}
+
+    assert short.run_once(slow_handler)
+    assert short.get(job_id)["status"] == "done"
+
+
+def test_analyze_returns_job_with_stage_timings(monkeypatch):
+    monkeypatch.delenv("GEMINI_API_KEY", raising=False)
+    monkeypatch.delenv("DISCORD_WEBHOOK_URL", raising=False)
+    response = client.post(f"/api/health/analyze?token={webhook_token}")
+    assert response.status_code == 200
+    job_id = response.json()["job_id"]
+
+    # TestClient 会在返回前跑完后台任务
+    job = client.get(f"/api/health/analyze/{job_id}?token={webhook_token}").json()
+    assert job["status"] == "done"
+    assert job["delivered"] is False
+    assert {"discord", "total"} <= set(job["timings"])
+    assert client.get(f"/api/health/analyze/nope?token={webhook_token}").status_code == 404
+
+@pytest.fixture
+def second_user():
+    def cleanup():
+        db = SessionLocal()
+        user_id = db.query(User.id).filter(User.name == "test-second-user").scalar()
+        if user_id is not None:
+            for model in (HealthMetric, DailyMetricRollup, DataGeneration):
+                db.query(model).filter(model.user_id == user_id).delete()
+            db.query(User).filter(User.id == user_id).delete()
+        db.commit()
+        db.close()
+
+    cleanup()
+    db = SessionLocal()
+    user, token = create_user(db, "test-second-user")
+    user_id = user.id
+    db.close()
+    yield user_id, token
+    cleanup()
+
+def test_users_only_see_their_own_data(second_user):
+    user_id, token = second_user
+    response = client.post(f"/api/health/webhook?token={token}", json={
+        "data": {"metrics": [{"name": "step_count", "units": "steps", "data": [{"qty": 42, "date": "2024-03-22 10:00:00"}]}]}
+    })
+    job_id = response.json()["job_id"]
+    main.ingest_queue.drain(process_health_file)
+
+    assert client.get(f"/api/health/jobs/{job_id}?token={token}").json()["status"] == "done"
+    # 别人的任务对默认用户不可见
+    assert client.get(f"/api/health/jobs/{job_id}?token={webhook_token}").status_code == 404
+
+    query = "/api/metrics/step_count/series?start=2024-03-22T00:00:00&end=2024-03-23T00:00:00&bucket=1d"
+    mine = client.get(f"{query}&token={token}").json()
+    assert [p["sum"] for p in mine["points"]] == [42]
+    theirs = client.get(f"{query}&token={webhook_token}").json()
+    assert 42 not in [p["sum"] for p in theirs["points"]]
+
+    assert client.get(f"/metrics?token={token}").status_code == 403
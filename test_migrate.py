@@ -0,0 +1,37 @@
+from sqlalchemy import create_engine, inspect, text
+
+from database import Base
+from migrate import add_user_columns
+
+
+def _indexes(engine, table):
+    return {i["name"] for i in inspect(engine).get_indexes(table)}
+
+
+def test_upgrade_drops_legacy_metric_type_index(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as conn:
+        # 单用户版本的表结构，带着早期的 metric_type 单列索引
+        conn.execute(text(
+            "CREATE TABLE health_metrics (id INTEGER PRIMARY KEY, timestamp DATETIME, metric_type VARCHAR, "
+            "value FLOAT, unit VARCHAR, source VARCHAR, raw_data JSON, "
+            "CONSTRAINT _timestamp_metric_uc UNIQUE (timestamp, metric_type))"
+        ))
+        conn.execute(text("CREATE INDEX ix_health_metrics_metric_type ON health_metrics (metric_type)"))
+        conn.execute(text("CREATE INDEX ix_health_metrics_type_timestamp ON health_metrics (metric_type, timestamp)"))
+        conn.execute(text("INSERT INTO health_metrics (timestamp, metric_type, value) VALUES ('2024-01-01 00:00:00', 'x', 1)"))
+
+    assert "health_metrics" in add_user_columns(engine)
+    Base.metadata.create_all(bind=engine)
+    indexes = _indexes(engine, "health_metrics")
+    assert "ix_health_metrics_metric_type" not in indexes
+    assert "ix_health_metrics_type_timestamp" not in indexes
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT user_id, value FROM health_metrics")).all() == [(1, 1.0)]
+
+    # 已经加过 user_id 的库里残留的旧索引也会被清掉
+    with engine.begin() as conn:
+        conn.execute(text("CREATE INDEX ix_health_metrics_metric_type ON health_metrics (metric_type)"))
+    assert add_user_columns(engine) == ["ix_health_metrics_metric_type"]
+    assert "ix_health_metrics_metric_type" not in _indexes(engine, "health_metrics")
+    assert add_user_columns(engine) == []
@@ -0,0 +1,126 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from database import SessionLocal, HealthMetric, MetricAggregate, DailyMetricRollup
+from ingest import process_health_data
+import retention
+import series
+
+_METRIC = "test_retention_hr"
+
+
+def _payload(times, values):
+    return {"data": {"metrics": [{"name": _METRIC, "units": "count/min", "data": [
+        {"qty": v, "date": t.strftime("%Y-%m-%d %H:%M:%S +0000")} for t, v in zip(times, values)
+    ]}]}}
+
+
+def _rollup(db, day):
+    return db.query(DailyMetricRollup.value_sum, DailyMetricRollup.sample_count).filter(
+        DailyMetricRollup.metric_type == _METRIC, DailyMetricRollup.day == day,
+    ).one()
+
+
+@pytest.fixture
+def samples():
+    def cleanup():
+        db = SessionLocal()
+        for model in (HealthMetric, MetricAggregate, DailyMetricRollup):
+            db.query(model).filter(model.metric_type == _METRIC).delete()
+        db.commit()
+        db.close()
+
+    cleanup()
+    old = retention.retention_cutoff(30) - timedelta(days=10) + timedelta(hours=10)
+    recent = datetime.utcnow().replace(microsecond=0) - timedelta(hours=1)
+    times = [old, old + timedelta(minutes=1), old + timedelta(minutes=7), recent]
+    process_health_data(_payload(times, [60, 80, 100, 70]), backfill=True)
+    yield old
+    cleanup()
+
+
+def test_compact_moves_old_samples_into_buckets(samples):
+    old = samples
+    report = retention.compact([_METRIC], older_than_days=30, bucket="5m")
+    assert report["metrics"][_METRIC] == {"days": 1, "samples": 3, "buckets": 2, "skipped": 0}
+
+    db = SessionLocal()
+    try:
+        assert db.query(HealthMetric).filter(HealthMetric.metric_type == _METRIC).count() == 1
+        buckets = db.query(MetricAggregate).filter(MetricAggregate.metric_type == _METRIC).order_by(
+            MetricAggregate.bucket_start).all()
+        assert [(b.bucket_start, b.sample_count, b.value_min, b.value_max, b.value_avg) for b in buckets] == [
+            (old, 2, 60, 80, 70), (old + timedelta(minutes=5), 1, 100, 100, 100),
+        ]
+        # 日汇总和按小时分桶的序列都同时读两层，结果不变
+        assert _rollup(db, old.date()) == (240, 3)
+        hourly = series.load_series(db, _METRIC, old - timedelta(hours=1), old + timedelta(hours=1), "1h", "avg")
+        assert [(p["sum"], p["count"], p["min"], p["max"]) for p in hourly["points"]] == [(240, 3, 60, 100)]
+    finally:
+        db.close()
+
+    # 已经没有旧的原始样本，再跑一次什么都不做
+    assert retention.compact([_METRIC], older_than_days=30)["metrics"][_METRIC]["samples"] == 0
+
+
+def test_reimported_history_is_not_double_counted(samples):
+    old = samples
+    retention.compact([_METRIC], older_than_days=30, bucket="5m")
+    # 补传整天的历史后，两层暂时重叠
+    process_health_data(_payload([old, old + timedelta(minutes=1), old + timedelta(minutes=7)], [60, 80, 100]),
+                        backfill=True)
+    db = SessionLocal()
+    try:
+        assert _rollup(db, old.date()) == (480, 6)
+    finally:
+        db.close()
+
+    retention.compact([_METRIC], older_than_days=30, bucket="5m")
+    db = SessionLocal()
+    try:
+        assert _rollup(db, old.date()) == (240, 3)
+        assert db.query(MetricAggregate).filter(MetricAggregate.metric_type == _METRIC).count() == 2
+    finally:
+        db.close()
+
+
+def test_partial_reimport_does_not_shrink_buckets(samples):
+    old = samples
+    retention.compact([_METRIC], older_than_days=30, bucket="5m")
+    # 从当天中途开始的导出：一条已压缩过的样本，外加一条新时间段的样本
+    process_health_data(_payload([old + timedelta(minutes=1), old + timedelta(minutes=20)], [80, 90]), backfill=True)
+    report = retention.compact([_METRIC], older_than_days=30, bucket="5m")
+    assert report["metrics"][_METRIC]["skipped"] == 1
+
+    db = SessionLocal()
+    try:
+        buckets = db.query(MetricAggregate).filter(MetricAggregate.metric_type == _METRIC).order_by(
+            MetricAggregate.bucket_start).all()
+        assert [(b.bucket_start, b.sample_count, b.value_sum) for b in buckets] == [
+            (old, 2, 140), (old + timedelta(minutes=5), 1, 100), (old + timedelta(minutes=20), 1, 90),
+        ]
+        assert _rollup(db, old.date()) == (330, 4)
+    finally:
+        db.close()
+
+
+def test_coarser_bucket_merges_existing_day(samples):
+    old = samples
+    retention.compact([_METRIC], older_than_days=30, bucket="5m")
+    process_health_data(_payload([old, old + timedelta(minutes=30)], [60, 50]), backfill=True)
+    retention.compact([_METRIC], older_than_days=30, bucket="1h")
+    # 再要求 5m 也不会把已经是 1h 的一天拆开；落在已压缩的 1h 桶里的样本按重复导入处理
+    process_health_data(_payload([old + timedelta(minutes=40)], [40]), backfill=True)
+    retention.compact([_METRIC], older_than_days=30, bucket="5m")
+
+    db = SessionLocal()
+    try:
+        buckets = db.query(MetricAggregate).filter(MetricAggregate.metric_type == _METRIC).all()
+        assert [(b.bucket_start, b.bucket_seconds, b.sample_count, b.value_sum, b.value_min, b.value_max)
+                for b in buckets] == [(old.replace(minute=0), 3600, 4, 290, 50, 100)]
+        assert _rollup(db, old.date()) == (290, 4)
+        hourly = series.load_series(db, _METRIC, old - timedelta(hours=1), old + timedelta(hours=1), "1h", "avg")
+        assert [(p["sum"], p["count"]) for p in hourly["points"]] == [(290, 4)]
+    finally:
+        db.close()
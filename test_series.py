@@ -0,0 +1,86 @@
+import io
+import json
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+from database import SessionLocal, HealthMetric, DailyMetricRollup, init_db
+from ingest import process_health_data
+from series import lttb, load_series, pick_bucket
+from main import app, webhook_token
+
+init_db()
+
+client = TestClient(app)
+_TYPE = "test_series_hr"
+
+
+@pytest.fixture
+def samples():
+    def cleanup():
+        db = SessionLocal()
+        db.query(HealthMetric).filter(HealthMetric.metric_type == _TYPE).delete()
+        db.query(DailyMetricRollup).filter(DailyMetricRollup.metric_type == _TYPE).delete()
+        db.commit()
+        db.close()
+
+    cleanup()
+    start = datetime(2024, 3, 20, 10, 0)
+    # 每分钟一个点，两个小时，第一个小时 60，第二个小时 100
+    data = [
+        {"qty": 60 if i < 60 else 100, "date": (start + timedelta(minutes=i)).strftime("%Y-%m-%d %H:%M:%S")}
+        for i in range(120)
+    ]
+    process_health_data({"data": {"metrics": [{"name": _TYPE, "units": "bpm", "data": data}]}})
+    yield start
+    cleanup()
+
+
+def test_lttb_keeps_endpoints_and_peaks():
+    x = np.arange(1000, dtype=float)
+    y = np.sin(x / 50)
+    y[500] = 10
+    idx = lttb(x, y, 50)
+    assert len(idx) == 50
+    assert idx[0] == 0 and idx[-1] == 999
+    assert 500 in idx
+    assert list(idx) == sorted(idx)
+
+
+def test_hourly_buckets_from_sql(samples):
+    db = SessionLocal()
+    try:
+        result = load_series(db, _TYPE, samples, samples + timedelta(hours=2), bucket="1h")
+    finally:
+        db.close()
+    assert [(p["t"], p["avg"], p["count"]) for p in result["points"]] == [
+        (samples, 60, 60),
+        (samples + timedelta(hours=1), 100, 60),
+    ]
+
+
+def test_series_endpoint_formats(samples):
+    params = f"start={samples.isoformat()}&end={(samples + timedelta(hours=2)).isoformat()}&token={webhook_token}"
+
+    body = client.get(f"/api/metrics/{_TYPE}/series?{params}&bucket=raw&points=10").json()
+    assert body["source_points"] == 120
+    assert len(body["points"]) == 10
+
+    lines = client.get(f"/api/metrics/{_TYPE}/series?{params}&bucket=1d&format=ndjson").text.splitlines()
+    assert [json.loads(line)["sum"] for line in lines] == [60 * 60 + 100 * 60]
+
+    import pyarrow as pa
+    response = client.get(f"/api/metrics/{_TYPE}/series?{params}&bucket=15m&format=arrow")
+    table = pa.ipc.open_stream(io.BytesIO(response.content)).read_all()
+    assert table.num_rows == 8
+    assert table.column("max").to_pylist()[-1] == 100
+
+    assert client.get(f"/api/metrics/{_TYPE}/series?{params}&bucket=2d").status_code == 400
+
+
+def test_auto_bucket_scales_with_range():
+    start = datetime(2024, 1, 1)
+    assert pick_bucket(start, start + timedelta(hours=6), 1000) == "1m"
+    assert pick_bucket(start, start + timedelta(days=365), 1000) == "6h"
@@ -0,0 +1,34 @@
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+from timeparse import TimestampParser, parse_column, parse_many, parse_timestamp
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("2024-02-06 14:30:00 -0800", datetime(2024, 2, 6, 22, 30)),
+    ("2024-02-06 14:30:00 +0530", datetime(2024, 2, 6, 9, 0)),
+    ("2024-02-06 14:30:00", datetime(2024, 2, 6, 14, 30)),
+    ("2024-02-06T14:30:00Z", datetime(2024, 2, 6, 14, 30)),
+    ("2024-02-06T14:30:00.250+01:00", datetime(2024, 2, 6, 13, 30, 0, 250000)),
+])
+def test_parse_timestamp_normalizes_to_naive_utc(value, expected):
+    assert parse_timestamp(value) == expected
+
+
+def test_parser_resniffs_when_series_changes_format():
+    parse = TimestampParser()
+    assert parse("2024-02-06 14:30:00 -0800") == datetime(2024, 2, 6, 22, 30)
+    assert parse.format.name == "hae"
+    assert parse("2024-02-06T14:30:00Z") == datetime(2024, 2, 6, 14, 30)
+    assert parse.format.name == "iso8601"
+    with pytest.raises(ValueError):
+        parse("not a date")
+
+
+def test_parse_many_matches_parse_column():
+    values = ["2024-02-06 14:30:00 -0800", "2024-02-07 01:00:00 +0000", "2024-02-07T03:00:00Z"]
+    parsed = parse_column(pd.Series(values + [None, "garbage"]))
+    assert list(parsed[:3]) == parse_many(values)
+    assert parsed[3:].isna().all()
@@ -0,0 +1,98 @@
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pytest
+
+from database import SessionLocal, HealthMetric, DailyMetricRollup, MetricBaseline
+from ingest import process_health_data
+import trends
+
+_METRIC = "test_trends_steps"
+_TODAY = date(2024, 6, 1)
+_DIP = _TODAY - timedelta(days=3)
+
+
+def _payload(days_values):
+    return {"data": {"metrics": [{"name": _METRIC, "units": "count", "data": [
+        {"qty": v, "date": datetime.combine(d, datetime.min.time()).replace(hour=12).strftime("%Y-%m-%d %H:%M:%S +0000")}
+        for d, v in days_values
+    ]}]}}
+
+
+def _state(db):
+    return db.query(MetricBaseline).filter(MetricBaseline.metric_type == _METRIC).one()
+
+
+@pytest.fixture
+def history(monkeypatch):
+    monkeypatch.setitem(trends.TREND_METRICS, _METRIC, "sum")
+
+    def cleanup():
+        db = SessionLocal()
+        for model in (HealthMetric, DailyMetricRollup, MetricBaseline):
+            db.query(model).filter(model.metric_type == _METRIC).delete()
+        db.commit()
+        db.close()
+
+    cleanup()
+    # 100 天左右交替的 9500 / 10500 步，三天前只有 2000 步，本周其余几天稍多
+    days = [_TODAY - timedelta(days=i) for i in range(1, 101)]
+    values = [2000 if d == _DIP else 11000 if d >= _TODAY - timedelta(days=7) else 9500 + 1000 * (d.toordinal() % 2)
+              for d in days]
+    process_health_data(_payload(zip(days, values)), backfill=True)
+    yield
+    cleanup()
+
+
+def test_trend_report_flags_dip_against_baseline(history):
+    db = SessionLocal()
+    try:
+        report = trends.trend_report(db, metrics={_METRIC: "sum"}, today=_TODAY)
+        db.commit()
+    finally:
+        db.close()
+
+    entry = report["metrics"][_METRIC]
+    assert entry["base28"]["avg"] == 10000
+    assert entry["base90"]["p10_p50_p90"] == [9500, 10000, 10500]
+    assert entry["week_avg"] == pytest.approx((6 * 11000 + 2000) / 7, abs=0.1)
+    assert -4 < entry["wow_pct"] < -2
+    assert entry["z"] < 0
+    # 多出的 1000 步不到两个标准差，只有那天的 2000 步算异常
+    [anomaly] = report["anomalies"]
+    assert (anomaly["metric"], anomaly["day"], anomaly["value"]) == (_METRIC, _DIP.isoformat(), 2000)
+    assert anomaly["z"] < -10
+
+
+def test_ewma_is_folded_incrementally_and_rewound_on_backfill(history):
+    db = SessionLocal()
+    try:
+        trends.trend_report(db, metrics={_METRIC: "sum"}, today=_TODAY - timedelta(days=1))
+        db.commit()
+        assert _state(db).through_day == _TODAY - timedelta(days=2)
+
+        # 第二天只需要折算新完成的一天，结果和从头算一遍相同
+        report = trends.trend_report(db, metrics={_METRIC: "sum"}, today=_TODAY)
+        db.commit()
+        state = _state(db)
+        assert state.through_day == _TODAY - timedelta(days=1)
+        first = _TODAY - timedelta(days=1 + 7 + 90)
+        matrix = trends.daily_matrix(db, {_METRIC: "sum"}, first, _TODAY - timedelta(days=1))
+        ewma, ewm_var = trends.fold_ewma(np.array([np.nan]), np.array([np.nan]), matrix,
+                                         trends.TRENDS_EWMA_HALFLIFE)
+        assert state.ewma == pytest.approx(ewma[0])
+        assert state.ewm_var == pytest.approx(ewm_var[0])
+        assert report["metrics"][_METRIC]["ewma"] == round(ewma[0], 1)
+    finally:
+        db.close()
+
+    # 补传了已折算过的日期，状态被回退，下次从窗口重新起算
+    process_health_data(_payload([(_DIP, 3000)]), backfill=True)
+    db = SessionLocal()
+    try:
+        assert _state(db).through_day is None
+        trends.trend_report(db, metrics={_METRIC: "sum"}, today=_TODAY)
+        db.commit()
+        assert _state(db).through_day == _TODAY - timedelta(days=1)
+    finally:
+        db.close()
@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+from database import SessionLocal, Workout
+from main import app, webhook_token
+from workout_analytics import workout_summary
+
+client = TestClient(app)
+_TYPES = ("Test Zone Run", "Test Zone Ride")
+
+
+@pytest.fixture
+def workouts():
+    def cleanup():
+        db = SessionLocal()
+        db.query(Workout).filter(Workout.workout_type.in_(_TYPES)).delete()
+        db.commit()
+        db.close()
+
+    cleanup()
+    now = datetime.utcnow()
+    db = SessionLocal()
+    # 最大心率 200：100 → z1，130 → z2，185 → z5；40 天前那次不在 28 天窗口里
+    for hours, kind, hr, duration, calories in [
+        (2, _TYPES[0], 130, 30, 300),
+        (26, _TYPES[0], 185, 40, 500),
+        (50, _TYPES[1], 100, 90, 600),
+        (40 * 24, _TYPES[1], 150, 60, 400),
+    ]:
+        db.add(Workout(
+            start_timestamp=now - timedelta(hours=hours), workout_type=kind, duration_minutes=duration,
+            active_calories=calories, avg_heart_rate=hr, max_heart_rate=hr + 10,
+            raw_data={"route": [[0, 0]] * 100},
+        ))
+    db.commit()
+    db.close()
+    yield
+    cleanup()
+
+
+def test_workout_summary_groups_by_type_with_zones(workouts):
+    db = SessionLocal()
+    try:
+        summary = workout_summary(db, days=28, detail_limit=2, max_heart_rate=200)
+    finally:
+        db.close()
+
+    run = summary["by_type"][_TYPES[0]]
+    assert run["count"] == 2
+    assert run["total_duration_minutes"] == 70
+    assert run["avg_active_calories"] == 400
+    assert run["max_heart_rate"] == 195
+    assert run["heart_rate_zones"] == {"z1": 0, "z2": 1, "z3": 0, "z4": 0, "z5": 1}
+    assert summary["by_type"][_TYPES[1]]["count"] == 1
+    assert summary["by_type"][_TYPES[1]]["heart_rate_zones"]["z1"] == 1
+
+    assert len(summary["sessions"]) == 2
+    assert summary["sessions_omitted"] == summary["total_workouts"] - 2
+    assert summary["sessions"][0]["type"] == _TYPES[0]
+
+
+def test_workouts_summary_endpoint(workouts):
+    body = client.get(f"/api/workouts/summary?days=90&limit=0&token={webhook_token}").json()
+    assert body["by_type"][_TYPES[1]]["count"] == 2
+    assert body["sessions"] == []
+    assert client.get(f"/api/workouts/summary?days=0&token={webhook_token}").status_code == 400
@@ -0,0 +1,133 @@
+"""
+Timestamp parsing for sample-heavy payloads.
+
+The format of a series is sniffed from its first timestamp; the rest go through a parser
+precompiled for that format and only trigger another sniff when one doesn't fit. Results
+are naive UTC, which is how timestamps are stored (see `ingest.metric_row`).
+"""
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+
+# "+0800" / "-0730" → timedelta，一个导出里通常只有一两个不同的偏移量
+_OFFSETS: Dict[str, timedelta] = {}
+
+
+def _offset(text: str) -> timedelta:
+    if len(text) != 5 or text[0] not in "+-" or not text[1:].isdigit():
+        raise ValueError(f"Invalid UTC offset: {text!r}")
+    minutes = int(text[1:3]) * 60 + int(text[3:5])
+    offset = _OFFSETS[text] = timedelta(minutes=-minutes if text[0] == "-" else minutes)
+    return offset
+
+
+def _parse_hae(s: str) -> datetime:
+    # Health Auto Export / Apple Health XML："2024-02-06 14:30:00 -0800"
+    # 本地时间部分交给 C 实现的 fromisoformat，偏移量查表后直接减掉，不构造 tzinfo
+    if len(s) != 25 or s[19] != " ":
+        raise ValueError(f"Not a 'YYYY-MM-DD HH:MM:SS ±HHMM' timestamp: {s!r}")
+    offset = _OFFSETS.get(s[20:]) or _offset(s[20:])
+    return datetime.fromisoformat(s[:19]) - offset
+
+
+def _parse_naive(s: str) -> datetime:
+    # 没有偏移量的按 UTC 处理
+    if len(s) != 19:
+        raise ValueError(f"Not a 'YYYY-MM-DD HH:MM:SS' timestamp: {s!r}")
+    return datetime.fromisoformat(s)
+
+
+def _parse_iso(s: str) -> datetime:
+    ts = datetime.fromisoformat(s[:-1] + "+00:00" if s.endswith("Z") else s)
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+class TimestampFormat(NamedTuple):
+    name: str
+    pattern: "re.Pattern"
+    parse: Callable[[str], datetime]
+    # 给 pandas.to_datetime 用的格式；None 表示交给 ISO8601 解析
+    strptime: Optional[str]
+
+
+# 按从具体到宽泛的顺序匹配
+FORMATS = (
+    TimestampFormat("hae", re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2} [+-]\d{4}$"), _parse_hae, "%Y-%m-%d %H:%M:%S %z"),
+    TimestampFormat("naive", re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$"), _parse_naive, "%Y-%m-%d %H:%M:%S"),
+    TimestampFormat("iso8601", re.compile(r"\d{4}-\d{2}-\d{2}"), _parse_iso, None),
+)
+
+
+def sniff(value: str) -> TimestampFormat:
+    for fmt in FORMATS:
+        if fmt.pattern.match(value):
+            return fmt
+    raise ValueError(f"Unrecognized timestamp format: {value!r}")
+
+
+class TimestampParser:
+    """
+    Parses one series of timestamps, sniffing the format on first use.
+
+    Use one instance per metric series; a value that doesn't fit the current format
+    re-sniffs, so mixed series are still parsed correctly, just without the fast path.
+    """
+
+    def __init__(self):
+        self.format: Optional[TimestampFormat] = None
+
+    def __call__(self, value: str) -> datetime:
+        if self.format is not None:
+            try:
+                return self.format.parse(value)
+            except ValueError:
+                pass
+        self.format = sniff(value)
+        return self.format.parse(value)
+
+
+def parse_timestamp(value: str) -> datetime:
+    """Parse a single timestamp of any supported format to naive UTC."""
+    return sniff(value).parse(value)
+
+
+def parse_many(values: Iterable[str]) -> List[datetime]:
+    """Parse a whole series, sniffing the format once."""
+    parse = TimestampParser()
+    return [parse(v) for v in values]
+
+
+# "2024-02-06 14:30:00 -0800" 里偏移量前的空格，ISO8601 解析不接受
+_SPACED_OFFSET = r"\s+(?=[+-]\d{2}:?\d{2}$)"
+
+
+def parse_column(values):
+    """
+    Vectorized parse of a pandas Series of timestamp strings to naive UTC.
+
+    The format is sniffed from the first value and handed to `pandas.to_datetime` as an
+    explicit format; values that don't match are retried as ISO 8601. Anything still
+    unparseable becomes NaT.
+    """
+    import pandas as pd
+
+    values = values.astype("string").str.strip()
+    present = values.dropna()
+    fmt = None
+    if len(present):
+        try:
+            fmt = sniff(present.iloc[0])
+        except ValueError:
+            pass
+
+    if fmt is not None and fmt.strptime:
+        out = pd.to_datetime(values, format=fmt.strptime, utc=True, errors="coerce")
+    else:
+        out = pd.Series(pd.NaT, index=values.index, dtype="datetime64[ns, UTC]")
+    rest = out.isna() & values.notna()
+    if rest.any():
+        iso = values[rest].str.replace(_SPACED_OFFSET, "", regex=True)
+        out[rest] = pd.to_datetime(iso, format="ISO8601", utc=True, errors="coerce")
+    return out.dt.tz_localize(None)
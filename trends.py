@@ -0,0 +1,227 @@
+"""
+Personal baselines and anomalies for the insight prompt.
+
+    uv run trends.py [--user alice]
+
+For every TREND_METRICS metric the last `week_days` completed days are compared with the
+user's own 28- and 90-day baselines just before them: rolling mean / std, p10 / p50 / p90,
+the z-score of the week and of each day, and the week-over-week change. All of it is
+computed with NumPy from one read of `daily_metric_rollups` over a fixed window, so the
+query cost and the size of the prompt section do not grow with the history.
+
+The EWMA (and its variance) remembers further back than the window. Its state is kept per
+(user, metric) in `metric_baselines`, and each run only folds in the days completed since
+the previous one. When an ingest rewrites a day that was already folded, `refresh_rollups`
+rewinds the state and the next run re-seeds it from the window.
+"""
+import os
+import math
+import argparse
+import warnings
+from datetime import date, datetime, timedelta
+from typing import TYPE_CHECKING, Dict, List, Mapping, Optional
+
+from sqlalchemy import and_, or_
+
+from database import DEFAULT_USER_ID, SessionLocal, DailyMetricRollup, MetricBaseline, dialect_insert
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# 指标 -> 每天取的值：sum 是当天总量，avg 是当天样本均值
+TREND_METRICS = {
+    "step_count": "sum",
+    "active_energy": "sum",
+    "walking_running_distance": "sum",
+    "flights_climbed": "sum",
+    "sleep_analysis": "sum",
+    "heart_rate": "avg",
+    "resting_heart_rate": "avg",
+    "heart_rate_variability": "avg",
+}
+
+BASELINE_WINDOWS = (28, 90)
+TRENDS_EWMA_HALFLIFE = float(os.getenv("TRENDS_EWMA_HALFLIFE", "14"))
+TRENDS_Z_THRESHOLD = float(os.getenv("TRENDS_Z_THRESHOLD", "2"))
+# 基线里少于这么多天有数据就不给均值和 z 分数
+TRENDS_MIN_DAYS = int(os.getenv("TRENDS_MIN_DAYS", "7"))
+TRENDS_MAX_ANOMALIES = int(os.getenv("TRENDS_MAX_ANOMALIES", "5"))
+
+
+def rewind_baselines(db, first_days: Mapping[str, date], user_id: int = DEFAULT_USER_ID):
+    """Mark EWMA states that already folded one of the rewritten days as stale; the caller commits."""
+    stale = [
+        and_(MetricBaseline.metric_type == metric_type, MetricBaseline.through_day >= day)
+        for metric_type, day in first_days.items() if metric_type in TREND_METRICS
+    ]
+    if not stale:
+        return
+    db.query(MetricBaseline).filter(MetricBaseline.user_id == user_id, or_(*stale)).update(
+        {MetricBaseline.through_day: None}, synchronize_session=False,
+    )
+
+
+def daily_matrix(db, metrics: Mapping[str, str], first: date, last: date,
+                 user_id: int = DEFAULT_USER_ID) -> "np.ndarray":
+    """One row per metric and one column per day in [first, last]; days without data are NaN."""
+    import numpy as np
+
+    names = list(metrics)
+    matrix = np.full((len(names), (last - first).days + 1), np.nan)
+    rows = db.query(
+        DailyMetricRollup.metric_type, DailyMetricRollup.day, DailyMetricRollup.value_sum,
+        DailyMetricRollup.value_avg,
+    ).filter(
+        DailyMetricRollup.user_id == user_id,
+        DailyMetricRollup.metric_type.in_(names),
+        DailyMetricRollup.day >= first,
+        DailyMetricRollup.day <= last,
+    ).all()
+    index = {name: i for i, name in enumerate(names)}
+    for metric_type, day, value_sum, value_avg in rows:
+        value = value_sum if metrics[metric_type] == "sum" else value_avg
+        if value is not None:
+            matrix[index[metric_type], (day - first).days] = value
+    return matrix
+
+
+def fold_ewma(ewma: "np.ndarray", ewm_var: "np.ndarray", values: "np.ndarray", halflife: float):
+    """
+    Fold the columns of `values` (metrics x days) into the EWMA state, all metrics at once.
+    NaN days are skipped; a NaN state starts at the first value it sees.
+    """
+    import numpy as np
+
+    alpha = 1 - 0.5 ** (1 / halflife)
+    ewma, ewm_var = ewma.copy(), ewm_var.copy()
+    for column in values.T:
+        seen = ~np.isnan(column)
+        fresh = seen & np.isnan(ewma)
+        ewma[fresh], ewm_var[fresh] = column[fresh], 0.0
+        step = seen & ~fresh
+        diff = column[step] - ewma[step]
+        increment = alpha * diff
+        ewma[step] += increment
+        ewm_var[step] = (1 - alpha) * (ewm_var[step] + diff * increment)
+    return ewma, ewm_var
+
+
+def _update_ewma(db, names: List[str], matrix: "np.ndarray", first: date, user_id: int):
+    import numpy as np
+
+    states = {s.metric_type: s for s in db.query(MetricBaseline).filter(
+        MetricBaseline.user_id == user_id, MetricBaseline.metric_type.in_(names),
+    )}
+    ewma = np.full(len(names), np.nan)
+    ewm_var = np.full(len(names), np.nan)
+    # 每个指标从自己上次折算到的那天之后开始；没有状态或已被回退的从窗口开头重新起算
+    start = np.zeros(len(names), dtype=np.int64)
+    for i, name in enumerate(names):
+        s = states.get(name)
+        if s is not None and s.through_day is not None and s.through_day >= first and s.ewma is not None:
+            ewma[i], ewm_var[i] = s.ewma, s.ewm_var
+            start[i] = (s.through_day - first).days + 1
+    pending = np.where(np.arange(matrix.shape[1])[None, :] >= start[:, None], matrix, np.nan)
+    ewma, ewm_var = fold_ewma(ewma, ewm_var, pending, TRENDS_EWMA_HALFLIFE)
+
+    through_day = first + timedelta(days=matrix.shape[1] - 1)
+    now = datetime.utcnow()
+    rows = [
+        {"user_id": user_id, "metric_type": name, "through_day": through_day,
+         "ewma": float(ewma[i]), "ewm_var": float(ewm_var[i]), "updated_at": now}
+        for i, name in enumerate(names) if not np.isnan(ewma[i])
+    ]
+    if rows:
+        stmt = dialect_insert(db)(MetricBaseline).values(rows)
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=["user_id", "metric_type"],
+            set_={c: stmt.excluded[c] for c in ("through_day", "ewma", "ewm_var", "updated_at")},
+        ))
+    return ewma, ewm_var
+
+
+def _num(value, digits: int = 1) -> Optional[float]:
+    return None if value is None or math.isnan(value) else round(float(value), digits)
+
+
+def trend_report(db, user_id: int = DEFAULT_USER_ID, week_days: int = 7, metrics: Mapping[str, str] = None,
+                 today: date = None) -> Optional[Dict]:
+    """
+    Compact baseline comparison of the last `week_days` completed days, or None without data.
+    Also brings the stored EWMA states up to yesterday; the caller commits.
+    """
+    import numpy as np
+
+    metrics = metrics or TREND_METRICS
+    names = list(metrics)
+    last = (today or date.today()) - timedelta(days=1)
+    first = last - timedelta(days=week_days + max(BASELINE_WINDOWS) - 1)
+    matrix = daily_matrix(db, metrics, first, last, user_id)
+    if np.isnan(matrix).all():
+        return None
+    ewma, ewm_var = _update_ewma(db, names, matrix, first, user_id)
+
+    week, baseline = matrix[:, -week_days:], matrix[:, :-week_days]
+    with warnings.catch_warnings():
+        # 整行都是 NaN 的指标会触发 "Mean of empty slice"，结果本来就是 NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        week_avg = np.nanmean(week, axis=1)
+        prev_avg = np.nanmean(baseline[:, -week_days:], axis=1)
+        stats = {}
+        for window in BASELINE_WINDOWS:
+            b = baseline[:, -window:]
+            enough = (~np.isnan(b)).sum(axis=1) >= TRENDS_MIN_DAYS
+            mean = np.where(enough, np.nanmean(b, axis=1), np.nan)
+            std = np.where(enough, np.nanstd(b, axis=1, ddof=1), np.nan)
+            p10, p50, p90 = np.nanpercentile(np.where(enough[:, None], b, np.nan), [10, 50, 90], axis=1)
+            stats[window] = (mean, std, p10, p50, p90)
+
+    mean, std = stats[BASELINE_WINDOWS[0]][:2]
+    std = np.where(std > 0, std, np.nan)
+    week_z = (week_avg - mean) / std
+    day_z = (week - mean[:, None]) / std[:, None]
+    wow_pct = np.where(prev_avg > 0, (week_avg - prev_avg) / np.where(prev_avg > 0, prev_avg, 1) * 100, np.nan)
+
+    report = {"metrics": {}, "anomalies": []}
+    for i, name in enumerate(names):
+        if np.isnan(week_avg[i]) and np.isnan(ewma[i]):
+            continue
+        entry = {"week_avg": _num(week_avg[i]), "wow_pct": _num(wow_pct[i]), "z": _num(week_z[i], 2)}
+        for window, (w_mean, w_std, p10, p50, p90) in stats.items():
+            if not np.isnan(w_mean[i]):
+                entry[f"base{window}"] = {"avg": _num(w_mean[i]), "std": _num(w_std[i]),
+                                          "p10_p50_p90": [_num(p10[i]), _num(p50[i]), _num(p90[i])]}
+        entry["ewma"] = _num(ewma[i])
+        entry["ewm_std"] = _num(math.sqrt(ewm_var[i]) if not np.isnan(ewm_var[i]) else None)
+        report["metrics"][name] = {k: v for k, v in entry.items() if v is not None}
+
+    # 本周单日偏离超过阈值的，按偏离程度取前几条
+    rows, cols = np.nonzero(np.abs(np.nan_to_num(day_z)) >= TRENDS_Z_THRESHOLD)
+    order = np.argsort(-np.abs(day_z[rows, cols]))[:TRENDS_MAX_ANOMALIES]
+    week_start = last - timedelta(days=week_days - 1)
+    for k in order:
+        i, j = rows[k], cols[k]
+        report["anomalies"].append({
+            "metric": names[i], "day": (week_start + timedelta(days=int(j))).isoformat(),
+            "value": _num(week[i, j]), "z": _num(day_z[i, j], 2),
+        })
+    return report if report["metrics"] else None
+
+
+if __name__ == "__main__":
+    import json
+    from users import user_id_for
+
+    parser = argparse.ArgumentParser(description="Print a user's baselines and anomalies as sent to the insight prompt.")
+    parser.add_argument("--user", help="report for this user (default: the default user)")
+    parser.add_argument("--week-days", type=int, default=7)
+    args = parser.parse_args()
+
+    user_id = user_id_for(args.user)
+    db = SessionLocal()
+    try:
+        result = trend_report(db, user_id, args.week_days)
+        db.commit()
+    finally:
+        db.close()
+    print(json.dumps(result, ensure_ascii=False, indent=2))
@@ -0,0 +1,128 @@
+"""
+Users and their API tokens.
+
+    uv run users.py add alice [--discord-webhook https://discord.com/api/webhooks/...]
+    uv run users.py list
+    uv run users.py rotate alice
+    uv run users.py disable alice
+
+Tokens are shown once when created or rotated; only their SHA-256 is stored. The
+default user (id 1) owns all data from before multi-user support and is the one
+`WEBHOOK_TOKEN` authenticates as.
+"""
+import os
+import hashlib
+import secrets
+import argparse
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from sqlalchemy import text
+
+from database import DEFAULT_USER_ID, SessionLocal, User, dialect_insert
+
+DEFAULT_USER_NAME = "default"
+
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def new_token() -> str:
+    return secrets.token_urlsafe(32)
+
+
+def ensure_default_user(bind):
+    """Create the default user if missing (called from `init_db`)."""
+    with bind.begin() as conn:
+        stmt = dialect_insert(conn)(User).values(
+            id=DEFAULT_USER_ID, name=DEFAULT_USER_NAME, active=True, created_at=datetime.utcnow(),
+        ).on_conflict_do_nothing(index_elements=["id"])
+        conn.execute(stmt)
+        if conn.dialect.name == "postgresql":
+            # 显式插入 id 不会推进序列，之后新建用户时要从最大 id 往后分配
+            conn.execute(text(
+                "SELECT setval(pg_get_serial_sequence('users', 'id'), (SELECT max(id) FROM users))"
+            ))
+
+
+def create_user(db, name: str, discord_webhook_url: str = None) -> Tuple[User, str]:
+    token = new_token()
+    user = User(name=name, token_hash=hash_token(token), discord_webhook_url=discord_webhook_url,
+                active=True, created_at=datetime.utcnow())
+    db.add(user)
+    db.commit()
+    return user, token
+
+
+def rotate_token(db, name: str) -> str:
+    user = db.query(User).filter(User.name == name).one()
+    token = new_token()
+    user.token_hash = hash_token(token)
+    db.commit()
+    return token
+
+
+def resolve_token(db, token: str) -> Optional[int]:
+    """Id of the active user owning `token`, or None."""
+    return db.query(User.id).filter(User.token_hash == hash_token(token), User.active.is_(True)).scalar()
+
+
+def active_user_ids(db) -> List[int]:
+    return [user_id for (user_id,) in db.query(User.id).filter(User.active.is_(True)).order_by(User.id)]
+
+
+def user_id_for(name: Optional[str]) -> int:
+    """Id of the user called `name` (the default user when None), for CLI `--user` options."""
+    if not name:
+        return DEFAULT_USER_ID
+    db = SessionLocal()
+    try:
+        user_id = db.query(User.id).filter(User.name == name).scalar()
+    finally:
+        db.close()
+    if user_id is None:
+        raise SystemExit(f"Unknown user '{name}' (see `uv run users.py list`)")
+    return user_id
+
+
+def discord_webhook_for(db, user_id: int) -> Optional[str]:
+    url = db.query(User.discord_webhook_url).filter(User.id == user_id).scalar()
+    # 只有默认用户回落到全局的 DISCORD_WEBHOOK_URL，别人的报告不能发到共享频道
+    if not url and user_id == DEFAULT_USER_ID:
+        url = os.getenv("DISCORD_WEBHOOK_URL")
+    return url
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage Health Buddy users and API tokens.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("add")
+    p.add_argument("name")
+    p.add_argument("--discord-webhook", help="where this user's daily report is posted")
+    sub.add_parser("list")
+    for name in ("rotate", "disable"):
+        sub.add_parser(name).add_argument("name")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.command == "add":
+            user, token = create_user(db, args.name, args.discord_webhook)
+            print(f"✅ Created user {user.name} (id {user.id}). Token (shown once): {token}")
+        elif args.command == "rotate":
+            print(f"🔑 New token for {args.name} (shown once): {rotate_token(db, args.name)}")
+        elif args.command == "disable":
+            db.query(User).filter(User.name == args.name).update({"active": False})
+            db.commit()
+            print(f"🚫 Disabled {args.name}")
+        else:
+            # 从日汇总数样本数，不扫原始表
+            counts = dict(db.execute(text(
+                "SELECT user_id, sum(sample_count) FROM daily_metric_rollups GROUP BY user_id"
+            )).all())
+            for user in db.query(User).order_by(User.id):
+                status = "active" if user.active else "disabled"
+                print(f"{user.id:>4}  {user.name:<20} {status:<9} {counts.get(user.id, 0):>10} samples")
+    finally:
+        db.close()
@@ -0,0 +1,104 @@
+"""
+Incremental ingestion state.
+
+Health Auto Export re-sends overlapping windows (the whole day or week) on every run.
+Two checks keep the steady-state cost proportional to new data:
+
+- payload fingerprints: a byte-identical body seen recently is skipped without parsing
+- high-water marks: per (user, metric_type, source), samples more than WATERMARK_GRACE_HOURS
+  older than the newest one already stored are dropped before the upsert. Samples inside
+  the grace window are re-written, since HAE keeps updating the current aggregation bucket
+  and re-sends earlier buckets with corrected values when a second device syncs late
+
+Backfills (`backfill=True`) ignore both checks but still advance the watermarks.
+"""
+import os
+import json
+import hashlib
+from datetime import datetime, timedelta
+from typing import Any, BinaryIO, Dict, Tuple
+
+from sqlalchemy import case
+
+from database import DEFAULT_USER_ID, IngestWatermark, PayloadFingerprint, dialect_insert
+
+INGEST_FINGERPRINT_TTL_HOURS = float(os.getenv("INGEST_FINGERPRINT_TTL_HOURS", "168"))
+# 水位线往前留的回看窗口：Watch / iPhone 晚同步时，HAE 会带着修正值重发之前的聚合桶
+WATERMARK_GRACE_HOURS = float(os.getenv("WATERMARK_GRACE_HOURS", "6"))
+
+_READ_BLOCK = 1 << 20
+
+Watermarks = Dict[Tuple[str, str], datetime]
+
+
+def file_fingerprint(fp: BinaryIO) -> str:
+    """SHA-256 of a spooled body; rewinds `fp` afterwards."""
+    digest = hashlib.sha256()
+    for block in iter(lambda: fp.read(_READ_BLOCK), b""):
+        digest.update(block)
+    fp.seek(0)
+    return digest.hexdigest()
+
+
+def payload_fingerprint(payload: Dict[str, Any]) -> str:
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def seen_recently(db, digest: str, user_id: int = DEFAULT_USER_ID) -> bool:
+    cutoff = datetime.utcnow() - timedelta(hours=INGEST_FINGERPRINT_TTL_HOURS)
+    return db.query(PayloadFingerprint.digest).filter(
+        PayloadFingerprint.user_id == user_id, PayloadFingerprint.digest == digest,
+        PayloadFingerprint.created_at >= cutoff,
+    ).first() is not None
+
+
+def record_fingerprint(db, digest: str, samples: int, user_id: int = DEFAULT_USER_ID):
+    """Remember `digest` inside the caller's transaction and drop expired fingerprints."""
+    now = datetime.utcnow()
+    stmt = dialect_insert(db)(PayloadFingerprint).values(
+        user_id=user_id, digest=digest, samples=samples, created_at=now,
+    )
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=["user_id", "digest"], set_={"samples": stmt.excluded.samples, "created_at": stmt.excluded.created_at},
+    ))
+    cutoff = now - timedelta(hours=INGEST_FINGERPRINT_TTL_HOURS)
+    db.query(PayloadFingerprint).filter(PayloadFingerprint.created_at < cutoff).delete(synchronize_session=False)
+
+
+def load_watermarks(db, user_id: int = DEFAULT_USER_ID) -> Watermarks:
+    # 每个用户每个 (指标, 来源) 一行，读出来也很小
+    rows = db.query(IngestWatermark.metric_type, IngestWatermark.source, IngestWatermark.high_water).filter(
+        IngestWatermark.user_id == user_id,
+    ).all()
+    return {(metric_type, source): high_water for metric_type, source, high_water in rows}
+
+
+def skip_cutoffs(db, user_id: int = DEFAULT_USER_ID) -> Watermarks:
+    """Per (metric_type, source), samples older than this are dropped: the watermark minus the grace window."""
+    grace = timedelta(hours=WATERMARK_GRACE_HOURS)
+    return {key: mark - grace for key, mark in load_watermarks(db, user_id).items()}
+
+
+def advance_watermarks(db, marks: Watermarks, user_id: int = DEFAULT_USER_ID):
+    """Raise stored watermarks to `marks` (never lowers them), inside the caller's transaction."""
+    if not marks:
+        return
+    now = datetime.utcnow()
+    # 固定顺序写入，避免并发 worker 互相死锁
+    values = [
+        {"user_id": user_id, "metric_type": metric_type, "source": source, "high_water": ts, "updated_at": now}
+        for (metric_type, source), ts in sorted(marks.items())
+    ]
+    stmt = dialect_insert(db)(IngestWatermark).values(values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["user_id", "metric_type", "source"],
+        set_={
+            "high_water": case(
+                (stmt.excluded.high_water > IngestWatermark.high_water, stmt.excluded.high_water),
+                else_=IngestWatermark.high_water,
+            ),
+            "updated_at": stmt.excluded.updated_at,
+        },
+    )
+    db.execute(stmt)
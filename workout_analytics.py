@@ -0,0 +1,122 @@
+"""
+Workout summaries computed in SQL.
+
+Only scalar columns are selected, never `workouts.raw_data` (routes and per-second heart
+rate arrays). Per-type counts, duration/calorie totals and averages and heart-rate zone
+counts come from one grouped query; at most `WORKOUT_DETAIL_LIMIT` sessions are returned
+individually.
+"""
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from sqlalchemy import and_, case, func
+
+from database import DEFAULT_USER_ID, Workout
+
+# 常用的统计窗口（天）；任意正整数都可以
+WORKOUT_WINDOWS = (7, 28, 90)
+WORKOUT_DETAIL_LIMIT = int(os.getenv("WORKOUT_DETAIL_LIMIT", "20"))
+# 没有个人数据时按 190 估算最大心率
+WORKOUT_MAX_HEART_RATE = float(os.getenv("WORKOUT_MAX_HEART_RATE", "190"))
+
+# 按训练平均心率占最大心率的比例分区：(名称, 下限, 上限)
+HR_ZONES = (
+    ("z1", None, 0.6),
+    ("z2", 0.6, 0.7),
+    ("z3", 0.7, 0.8),
+    ("z4", 0.8, 0.9),
+    ("z5", 0.9, None),
+)
+
+
+def _zone_count(lo: Optional[float], hi: Optional[float], max_hr: float):
+    hr = Workout.avg_heart_rate
+    conditions = [hr.isnot(None)]
+    if lo is not None:
+        conditions.append(hr >= lo * max_hr)
+    if hi is not None:
+        conditions.append(hr < hi * max_hr)
+    return func.sum(case((and_(*conditions), 1), else_=0))
+
+
+def _round(value, digits: int = 1):
+    return round(float(value), digits) if value is not None else None
+
+
+def workout_summary(db, days: int = 7, detail_limit: int = None, max_heart_rate: float = None,
+                    user_id: int = DEFAULT_USER_ID) -> Optional[Dict]:
+    """Per-type and overall workout figures for one user's last `days` days; None when there are no workouts."""
+    if days < 1:
+        raise ValueError("days must be positive")
+    detail_limit = WORKOUT_DETAIL_LIMIT if detail_limit is None else detail_limit
+    max_hr = max_heart_rate or WORKOUT_MAX_HEART_RATE
+    # 时间戳按 naive UTC 存储
+    since = datetime.utcnow() - timedelta(days=days)
+    in_window = and_(Workout.user_id == user_id, Workout.start_timestamp >= since)
+
+    zone_columns = [_zone_count(lo, hi, max_hr).label(name) for name, lo, hi in HR_ZONES]
+    rows = db.query(
+        Workout.workout_type,
+        func.count().label("count"),
+        func.sum(Workout.duration_minutes).label("total_duration"),
+        func.avg(Workout.duration_minutes).label("avg_duration"),
+        func.sum(Workout.active_calories).label("total_calories"),
+        func.avg(Workout.active_calories).label("avg_calories"),
+        func.avg(Workout.avg_heart_rate).label("avg_hr"),
+        func.max(Workout.max_heart_rate).label("max_hr"),
+        *zone_columns,
+    ).filter(in_window).group_by(Workout.workout_type).order_by(func.count().desc(), Workout.workout_type).all()
+
+    if not rows:
+        return None
+
+    by_type = {}
+    zones = {name: 0 for name, _, _ in HR_ZONES}
+    for r in rows:
+        type_zones = {name: int(getattr(r, name) or 0) for name, _, _ in HR_ZONES}
+        for name, n in type_zones.items():
+            zones[name] += n
+        by_type[r.workout_type] = {
+            "count": r.count,
+            "total_duration_minutes": _round(r.total_duration),
+            "avg_duration_minutes": _round(r.avg_duration),
+            "total_active_calories": _round(r.total_calories),
+            "avg_active_calories": _round(r.avg_calories),
+            "avg_heart_rate": _round(r.avg_hr),
+            "max_heart_rate": _round(r.max_hr),
+            "heart_rate_zones": type_zones,
+        }
+
+    sessions = db.query(
+        Workout.workout_type,
+        Workout.start_timestamp,
+        Workout.duration_minutes,
+        Workout.active_calories,
+        Workout.avg_heart_rate,
+        Workout.max_heart_rate,
+    ).filter(in_window).order_by(Workout.start_timestamp.desc()).limit(detail_limit).all() if detail_limit else []
+
+    total = sum(t["count"] for t in by_type.values())
+    return {
+        "days": days,
+        "total_workouts": total,
+        "total_duration_minutes": _round(sum(t["total_duration_minutes"] or 0 for t in by_type.values())),
+        "total_active_calories": _round(sum(t["total_active_calories"] or 0 for t in by_type.values())),
+        "workout_types": {name: t["count"] for name, t in by_type.items()},
+        "by_type": by_type,
+        "heart_rate_zones": zones,
+        "max_heart_rate_basis": max_hr,
+        "sessions": [
+            {
+                "type": s.workout_type,
+                "date": s.start_timestamp.strftime("%Y-%m-%d %H:%M"),
+                "duration_minutes": s.duration_minutes,
+                "active_calories": s.active_calories,
+                "avg_heart_rate": s.avg_heart_rate,
+                "max_heart_rate": s.max_heart_rate,
+            }
+            for s in sessions
+        ],
+        "sessions_omitted": total - len(sessions),
+    }